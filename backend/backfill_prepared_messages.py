@@ -0,0 +1,41 @@
+#!/usr/bin/env python3
+"""
+Store the model-ready form of every message whose prepared form is missing or older than
+PREPARED_VERSION (run after bumping it in routes/common.py, or once for messages saved before
+prepared forms existed). Messages are rewritten in bulk, a batch at a time; safe to re-run.
+Until a message is backfilled it is simply prepared on the fly when used.
+"""
+
+import asyncio
+import argparse
+import repositories
+from database import close_database
+from routes.common import PREPARED_VERSION, prepared_document
+
+async def backfill(batch_size: int):
+    updated = 0
+    after = None
+    while True:
+        documents = await repositories.messages.outdated_prepared(PREPARED_VERSION, batch_size, after)
+        if not documents:
+            break
+        prepared = await asyncio.to_thread(
+            lambda: {document["_id"]: prepared_document(document["message"]) for document in documents}
+        )
+        await repositories.messages.set_prepared(prepared)
+        updated += len(documents)
+        after = documents[-1]["_id"]
+        print(f"{updated} messages")
+    print(f"✅ {updated} messages prepared with version {PREPARED_VERSION}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Backfill the model-ready form of stored messages")
+    parser.add_argument("--batch-size", type=int, default=500)
+    args = parser.parse_args()
+    try:
+        asyncio.run(backfill(args.batch_size))
+    finally:
+        close_database()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+"""
+Offline batch inference over a JSONL file of prompts
+Each input line is {"id": ..., "prompt": ..., "image_paths": [...], "system_message": ...};
+results are appended to the output JSONL as they finish, and a rerun skips ids already completed
+"""
+
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+from dotenv import load_dotenv
+from model_registry import ModelRegistry, DEFAULT_MODEL
+
+load_dotenv()
+
+# Gemma 3 expands every image to 256 soft tokens plus its markers
+IMAGE_TOKENS = 260
+
+def read_jsonl(path):
+    with open(path, "r", encoding="utf-8") as f:
+        for line_number, line in enumerate(f, 1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                yield json.loads(line)
+            except json.JSONDecodeError:
+                print(f"⚠️ Skipping malformed line {line_number} of {path}")
+
+def completed_ids(path):
+    """Ids with a response in a previous run's output; items that failed are retried"""
+    if not os.path.exists(path):
+        return set()
+    return {str(result["id"]) for result in read_jsonl(path) if "response" in result}
+
+def to_messages(item):
+    content = [{"type": "text", "text": item["prompt"]}]
+    content += [{"type": "image", "path": path} for path in item.get("image_paths", [])]
+    return [{"role": "user", "content": content}]
+
+def bucket_by_length(items, tokenizer, batch_size):
+    """Sort by prompt length and cut into batches, so rows of a batch need little padding"""
+    def length(item):
+        return len(tokenizer(item["prompt"])["input_ids"]) + IMAGE_TOKENS * len(item.get("image_paths", []))
+    items = sorted(items, key=length)
+    return [items[start:start + batch_size] for start in range(0, len(items), batch_size)]
+
+async def run_item(engine, adapter, item, args):
+    text = ""
+    async for chunk in engine.agenerate(
+        to_messages(item),
+        item.get("system_message", args.system),
+        temperature=args.temperature,
+        max_new_tokens=item.get("max_new_tokens", args.max_new_tokens),
+        adapter=adapter
+    ):
+        if isinstance(chunk, str):
+            text += chunk
+        else:
+            return {"id": item["id"], "response": text, "input_tokens": chunk["input_tokens"], "output_tokens": chunk["output_tokens"]}
+
+async def run(args):
+    registry = ModelRegistry()
+    engine = await asyncio.to_thread(registry.acquire, args.model)
+    adapter = registry.adapter_name(args.model)
+    engine.max_batch_size = args.batch_size
+
+    done = completed_ids(args.output)
+    items = []
+    for index, item in enumerate(read_jsonl(args.input)):
+        item.setdefault("id", index)
+        if str(item["id"]) in done:
+            continue
+        if not str(item.get("prompt", "")).strip():
+            print(f"⚠️ Skipping item {item['id']}: empty prompt")
+            continue
+        items.append(item)
+    print(f"{len(done)} items already completed, {len(items)} to run")
+
+    start = time.perf_counter()
+    finished = 0
+    output_tokens = 0
+    with open(args.output, "a", encoding="utf-8") as out:
+        for batch in bucket_by_length(items, engine.processor.tokenizer, args.batch_size):
+            results = await asyncio.gather(*(run_item(engine, adapter, item, args) for item in batch), return_exceptions=True)
+            for item, result in zip(batch, results):
+                if isinstance(result, Exception):
+                    result = {"id": item["id"], "error": str(result)}
+                else:
+                    output_tokens += result["output_tokens"]
+                out.write(json.dumps(result, ensure_ascii=False) + "\n")
+            # Flushed per batch so a crash loses at most the batch in flight
+            out.flush()
+            os.fsync(out.fileno())
+
+            finished += len(batch)
+            elapsed = time.perf_counter() - start
+            print(f"{finished}/{len(items)} items | {finished / elapsed:.2f} items/s | {output_tokens / elapsed:.1f} output tokens/s")
+
+    registry.release(args.model)
+
+def main():
+    parser = argparse.ArgumentParser(description="Run MedGemma over a JSONL file of prompts")
+    parser.add_argument("input", help="Input JSONL, one {\"id\", \"prompt\", \"image_paths\"?} per line")
+    parser.add_argument("output", help="Output JSONL; results are appended and completed ids skipped on rerun")
+    parser.add_argument("--model", default=DEFAULT_MODEL, help="Local model name from models.json")
+    parser.add_argument("--batch-size", type=int, default=8)
+    parser.add_argument("--max-new-tokens", type=int, default=512)
+    parser.add_argument("--temperature", type=float, default=0.0)
+    parser.add_argument("--system", default=None, help="System message for items without their own")
+    args = parser.parse_args()
+
+    if not os.path.exists(args.input):
+        print(f"❌ Input file not found: {args.input}")
+        sys.exit(1)
+    asyncio.run(run(args))
+
+if __name__ == "__main__":
+    main()
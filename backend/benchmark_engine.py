@@ -0,0 +1,218 @@
+#!/usr/bin/env python3
+"""
+Inference benchmark for MedGemmaEngine
+Runs the engine on CPU against a tiny randomly initialized model with the MedGemma (Gemma 3)
+architecture and tokenizer, sweeps prompt length, output length and concurrency, and prints
+time-to-first-token, inter-token latency, throughput and peak memory as JSON.
+Save the output per commit and compare.
+"""
+
+import os
+import json
+import time
+import argparse
+import threading
+import statistics
+import subprocess
+import torch
+from dotenv import load_dotenv
+from transformers import AutoProcessor, Gemma3Config, Gemma3ForConditionalGeneration
+from medgemma_engine import MedGemmaEngine, GenerationRequest, MEDGEMMA_MODEL_ID
+
+load_dotenv()
+
+def tiny_model(processor, seed: int, sliding_window: int = 512):
+    """Two-layer Gemma 3 with the real vocabulary and special tokens, random weights"""
+    tokenizer = processor.tokenizer
+    config = Gemma3Config(
+        text_config={
+            "vocab_size": len(tokenizer),
+            "hidden_size": 64,
+            "intermediate_size": 128,
+            "num_hidden_layers": 2,
+            "num_attention_heads": 4,
+            "num_key_value_heads": 1,
+            "head_dim": 16,
+            "sliding_window": sliding_window,
+            "max_position_embeddings": 8192
+        },
+        vision_config={
+            "hidden_size": 32,
+            "intermediate_size": 64,
+            "num_hidden_layers": 1,
+            "num_attention_heads": 2,
+            "image_size": 896,
+            "patch_size": 14
+        },
+        mm_tokens_per_image=256,
+        boi_token_index=tokenizer.convert_tokens_to_ids(processor.boi_token),
+        eoi_token_index=tokenizer.convert_tokens_to_ids(processor.eoi_token),
+        image_token_index=processor.image_token_id
+    )
+    torch.manual_seed(seed)
+    return Gemma3ForConditionalGeneration(config).to(torch.float32)
+
+def percentiles(values):
+    if not values:
+        return None
+    values = sorted(values)
+    pick = lambda q: values[min(len(values) - 1, int(q * len(values)))]
+    return {"p50": round(pick(0.5), 3), "p90": round(pick(0.9), 3), "p99": round(pick(0.99), 3)}
+
+def current_rss_bytes():
+    with open("/proc/self/statm") as f:
+        return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+
+class PeakMemory:
+    """Samples the process RSS while a run is in progress, and also tracks the CUDA allocator
+    peak when the engine runs on CUDA"""
+
+    def __init__(self, device: str, interval: float = 0.005):
+        self.cuda = device == "cuda"
+        self.interval = interval
+        self.peak_rss = 0
+        self.peak_cuda = None
+        self.stop = threading.Event()
+
+    def sample(self):
+        while not self.stop.is_set():
+            self.peak_rss = max(self.peak_rss, current_rss_bytes())
+            self.stop.wait(self.interval)
+
+    def __enter__(self):
+        if self.cuda:
+            torch.cuda.reset_peak_memory_stats()
+        self.thread = threading.Thread(target=self.sample, daemon=True)
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stop.set()
+        self.thread.join()
+        if self.cuda:
+            self.peak_cuda = torch.cuda.max_memory_allocated()
+
+def run_once(engine, prompt: str, output_tokens: int, concurrency: int):
+    """Submit concurrency identical requests at once; returns per-request token timestamps"""
+    done = threading.Semaphore(0)
+    runs = []
+    for _ in range(concurrency):
+        run = {"tokens": [], "usage": None, "error": None}
+
+        def emit(item, run=run):
+            if isinstance(item, dict):
+                run["usage"] = item
+            elif isinstance(item, Exception):
+                run["error"] = str(item)
+            else:
+                return
+            done.release()
+
+        runs.append(run)
+        run["start"] = time.perf_counter()
+        engine.submit(GenerationRequest(
+            [{"role": "user", "content": prompt}],
+            temperature=0.0,
+            max_new_tokens=output_tokens,
+            emit=emit,
+            on_token=lambda run=run: run["tokens"].append(time.perf_counter())
+        ))
+    for _ in runs:
+        done.acquire()
+    return runs
+
+def benchmark(engine, prompt_tokens: int, output_tokens: int, concurrency: int, repeats: int):
+    # About one token per word; the exact prompt size is reported from the engine's usage
+    prompt = " ".join(["patient"] * prompt_tokens)
+    run_once(engine, prompt, 2, concurrency)  # warm-up
+
+    ttft, itl, runs = [], [], []
+    elapsed = 0.0
+    with PeakMemory(engine.device) as memory:
+        for _ in range(repeats):
+            start = time.perf_counter()
+            batch = run_once(engine, prompt, output_tokens, concurrency)
+            elapsed += time.perf_counter() - start
+            runs += batch
+
+    errors = [run["error"] for run in runs if run["error"]]
+    for run in runs:
+        if run["tokens"]:
+            ttft.append((run["tokens"][0] - run["start"]) * 1000)
+            itl += [(b - a) * 1000 for a, b in zip(run["tokens"], run["tokens"][1:])]
+    generated = sum(len(run["tokens"]) for run in runs)
+    usages = [run["usage"] for run in runs if run["usage"]]
+
+    return {
+        "prompt_tokens": statistics.mean(usage["input_tokens"] for usage in usages) if usages else None,
+        "output_tokens": output_tokens,
+        "concurrency": concurrency,
+        "requests": len(runs),
+        "errors": len(errors),
+        "ttft_ms": percentiles(ttft),
+        "itl_ms": percentiles(itl),
+        "output_tokens_per_s": round(generated / elapsed, 2) if elapsed else None,
+        "requests_per_s": round(len(runs) / elapsed, 3) if elapsed else None,
+        "peak_rss_mb": round(memory.peak_rss / 1024**2, 1),
+        "peak_cuda_mb": round(memory.peak_cuda / 1024**2, 1) if memory.peak_cuda is not None else None
+    }
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=os.path.dirname(os.path.abspath(__file__)), text=True).strip()
+    except Exception:
+        return None
+
+def int_list(value: str):
+    return [int(item) for item in value.split(",") if item]
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark MedGemmaEngine on a tiny random model")
+    parser.add_argument(
+        "--prompt-lengths", type=int_list, default=[32, 256, 1024],
+        help="1024 is past the tiny model's sliding window, so the default sweep also checks long prompts (errors > 0 means a regression)"
+    )
+    parser.add_argument("--output-lengths", type=int_list, default=[16, 64])
+    parser.add_argument("--concurrency", type=int_list, default=[1, 4, 8])
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--processor", default=MEDGEMMA_MODEL_ID, help="Repository to take the processor/tokenizer from")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--sliding-window", type=int, default=512, help="The tiny model's Gemma 3 sliding window")
+    parser.add_argument("--threads", type=int, default=4, help="torch CPU threads, fixed for comparable numbers")
+    parser.add_argument("--output", help="Write the JSON report here instead of stdout")
+    args = parser.parse_args()
+
+    torch.set_num_threads(args.threads)
+    processor = AutoProcessor.from_pretrained(args.processor, token=os.getenv('HUGGINGFACE_TOKEN'))
+    engine = MedGemmaEngine(args.processor)
+    engine.max_batch_size = max(args.concurrency)
+    engine.attach(tiny_model(processor, args.seed, args.sliding_window), processor, device="cpu")
+    # Random weights emit EOS at random; disable it so every request produces exactly output_tokens
+    engine.eos_token_ids = set()
+
+    results = []
+    for prompt_tokens in args.prompt_lengths:
+        for output_tokens in args.output_lengths:
+            for concurrency in args.concurrency:
+                results.append(benchmark(engine, prompt_tokens, output_tokens, concurrency, args.repeats))
+
+    report = {
+        "commit": git_commit(),
+        "torch": torch.__version__,
+        "threads": args.threads,
+        "max_batch_size": engine.max_batch_size,
+        "batch_window_ms": engine.batch_window * 1000,
+        "sliding_window": args.sliding_window,
+        "kv_window": engine.kv_window,
+        "results": results
+    }
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(text)
+    else:
+        print(text)
+    engine.unload()
+
+if __name__ == "__main__":
+    main()
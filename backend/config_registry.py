@@ -0,0 +1,75 @@
+import os
+import json
+import time
+import logging
+import threading
+
+# Same logger as logging_util, without importing the web app
+logger = logging.getLogger("devochat")
+
+BASE_DIR = os.path.dirname(__file__)
+POLL_SECONDS = float(os.getenv('CONFIG_POLL_SECONDS', '2'))
+
+class JsonConfig:
+    """A JSON file parsed once and served from memory. A watcher thread polls its mtime and swaps in
+    a freshly built value when it changes; a file that fails to parse keeps the previous value."""
+
+    def __init__(self, path: str, build=None):
+        self.path = path
+        self.build = build or (lambda data: data)
+        self.mtime = None
+        self.value = None
+        self.error = None
+        self.reload()
+        watched.append(self)
+        start_watcher()
+
+    def reload(self):
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+        except OSError as ex:
+            if self.value is None:
+                self.error = ex
+            return
+        if mtime == self.mtime:
+            return
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                value = self.build(json.load(f))
+        except Exception as ex:
+            # Often a half-written file; mtime is left alone so the next poll tries again
+            logger.error(f"CONFIG_ERROR: {self.path}: {str(ex)}")
+            if self.value is None:
+                self.error = ex
+            return
+        self.value, self.mtime, self.error = value, mtime, None
+        logger.info(f"CONFIG_LOADED: {self.path}")
+
+    def get(self):
+        """Current value; raises the load error if the file has never been read successfully"""
+        value = self.value
+        if value is None:
+            raise self.error or FileNotFoundError(self.path)
+        return value
+
+watched = []
+watcher = None
+
+def watch_configs():
+    while True:
+        time.sleep(POLL_SECONDS)
+        for config in list(watched):
+            config.reload()
+
+def start_watcher():
+    global watcher
+    if watcher is None:
+        watcher = threading.Thread(target=watch_configs, name="config-watcher", daemon=True)
+        watcher.start()
+
+def index_models(data: dict):
+    models = data["models"]
+    return {"models": models, "by_name": {model["model_name"]: model for model in models}}
+
+models_config = JsonConfig(os.path.join(BASE_DIR, "models.json"), index_models)
+mcp_servers_config = JsonConfig(os.path.join(BASE_DIR, "mcp_servers.json"))
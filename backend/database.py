@@ -0,0 +1,21 @@
+import os
+from dotenv import load_dotenv
+from motor.motor_asyncio import AsyncIOMotorClient
+
+load_dotenv()
+
+# One pooled async client per worker process, shared by every route; motor runs round trips
+# without blocking the event loop and the pool bounds connections per worker
+mongo_client = AsyncIOMotorClient(
+    os.getenv('MONGODB_URI'),
+    maxPoolSize=int(os.getenv('MONGODB_MAX_POOL_SIZE', '50')),
+    minPoolSize=int(os.getenv('MONGODB_MIN_POOL_SIZE', '2')),
+    maxIdleTimeMS=int(os.getenv('MONGODB_MAX_IDLE_TIME_MS', '300000')),
+    waitQueueTimeoutMS=int(os.getenv('MONGODB_WAIT_QUEUE_TIMEOUT_MS', '10000')),
+    serverSelectionTimeoutMS=int(os.getenv('MONGODB_SERVER_SELECTION_TIMEOUT_MS', '5000')),
+    retryWrites=True
+)
+db = mongo_client.chat_db
+
+def close_database():
+    mongo_client.close()
@@ -0,0 +1,114 @@
+import os
+import json
+import logging
+import threading
+import numpy as np
+
+# Same logger as logging_util, without importing the web app
+logger = logging.getLogger("devochat")
+
+INDEX_DIR = os.path.join(os.path.dirname(__file__), "document_index")
+EMBEDDING_MODEL_ID = os.getenv('DOCUMENT_EMBEDDING_MODEL', "intfloat/multilingual-e5-small")
+
+# Documents shorter than this are still inlined whole; retrieval only pays off for long ones
+MIN_INDEXED_CHARS = int(os.getenv('RETRIEVAL_MIN_CHARS', '4000'))
+TOP_K = int(os.getenv('RETRIEVAL_TOP_K', '4'))
+CHUNK_CHARS = 1200
+CHUNK_OVERLAP = 200
+
+os.makedirs(INDEX_DIR, exist_ok=True)
+
+def chunk_text(text: str, chunk_chars: int = CHUNK_CHARS, overlap: int = CHUNK_OVERLAP):
+    """Split on paragraph boundaries into chunks of about chunk_chars, carrying overlap characters
+    of context over; paragraphs longer than a chunk are cut hard"""
+    chunks = []
+    current = ""
+    for paragraph in text.split("\n"):
+        if current and len(current) + len(paragraph) + 1 > chunk_chars:
+            chunks.append(current)
+            current = current[-overlap:]
+        current = f"{current}\n{paragraph}" if current else paragraph
+        while len(current) > chunk_chars:
+            chunks.append(current[:chunk_chars])
+            current = current[chunk_chars - overlap:]
+    if current.strip():
+        chunks.append(current)
+    return [chunk.strip() for chunk in chunks if chunk.strip()]
+
+class DocumentEmbedder:
+    """Small sentence-embedding model (mean pooled, L2 normalized), loaded on first use"""
+
+    def __init__(self, model_id: str = EMBEDDING_MODEL_ID):
+        self.model_id = model_id
+        self.model = None
+        self.tokenizer = None
+        self.lock = threading.Lock()
+
+    def load(self):
+        with self.lock:
+            if self.model is not None:
+                return
+            import torch
+            from transformers import AutoTokenizer, AutoModel
+            self.tokenizer = AutoTokenizer.from_pretrained(self.model_id)
+            self.model = AutoModel.from_pretrained(self.model_id, torch_dtype=torch.float32).eval()
+            logger.info(f"Loaded embedding model {self.model_id}")
+
+    def embed(self, texts, prefix: str, batch_size: int = 32):
+        import torch
+        self.load()
+        vectors = []
+        for start in range(0, len(texts), batch_size):
+            # e5 models expect "query: " / "passage: " prefixes
+            batch = [f"{prefix}{text}" for text in texts[start:start + batch_size]]
+            inputs = self.tokenizer(batch, padding=True, truncation=True, max_length=512, return_tensors="pt")
+            with torch.inference_mode():
+                hidden = self.model(**inputs).last_hidden_state
+            mask = inputs["attention_mask"].unsqueeze(-1).to(hidden.dtype)
+            pooled = (hidden * mask).sum(dim=1) / mask.sum(dim=1).clamp(min=1)
+            vectors.append(torch.nn.functional.normalize(pooled, dim=-1).numpy())
+        return np.concatenate(vectors).astype(np.float32)
+
+embedder = DocumentEmbedder()
+
+def index_paths(document_id: str):
+    return os.path.join(INDEX_DIR, f"{document_id}.npy"), os.path.join(INDEX_DIR, f"{document_id}.json")
+
+def document_id_for(processed_path: str):
+    return os.path.splitext(os.path.basename(processed_path))[0]
+
+def is_indexed(processed_path: str):
+    vectors_path, chunks_path = index_paths(document_id_for(processed_path))
+    return os.path.exists(vectors_path) and os.path.exists(chunks_path)
+
+def build_index(processed_path: str):
+    """Chunk and embed a processed upload; returns False when the document is short enough to inline"""
+    with open(processed_path, "r", encoding="utf-8") as f:
+        text = f.read()
+    if len(text) < MIN_INDEXED_CHARS:
+        return False
+
+    # The first line is the "[[filename]]" header written by /upload/file
+    title, _, body = text.partition("\n")
+    chunks = chunk_text(body)
+    vectors = embedder.embed(chunks, "passage: ")
+
+    vectors_path, chunks_path = index_paths(document_id_for(processed_path))
+    np.save(vectors_path, vectors)
+    with open(chunks_path, "w", encoding="utf-8") as f:
+        json.dump({"title": title, "embedding_model": embedder.model_id, "chunks": chunks}, f, ensure_ascii=False)
+    return True
+
+def search(processed_path: str, query: str, top_k: int = TOP_K):
+    """Top-k chunks of an indexed document for query, in document order, or None if not indexed"""
+    vectors_path, chunks_path = index_paths(document_id_for(processed_path))
+    if not query or not os.path.exists(vectors_path) or not os.path.exists(chunks_path):
+        return None
+
+    with open(chunks_path, "r", encoding="utf-8") as f:
+        index = json.load(f)
+    vectors = np.load(vectors_path, mmap_mode="r")
+    scores = vectors @ embedder.embed([query], "query: ")[0]
+    best = np.argsort(-scores)[:top_k]
+    excerpts = "\n...\n".join(index["chunks"][i] for i in sorted(best.tolist()))
+    return f"{index['title']}\n{excerpts}"
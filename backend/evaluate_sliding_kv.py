@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+"""
+Compare full and attention-sink sliding-window KV caches on a long conversation
+Feeds the text token by token and reports perplexity, per-token latency and KV cache size.
+The window is capped like the engine caps MEDGEMMA_KV_WINDOW (see max_kv_window).
+"""
+
+import sys
+import json
+import time
+import argparse
+import statistics
+import torch
+from dotenv import load_dotenv
+from transformers import HybridCache
+from medgemma_engine import MedGemmaEngine, SinkKVCache, max_kv_window
+
+load_dotenv()
+
+def cache_bytes(cache):
+    return sum(tensor.numel() * tensor.element_size() for tensor in cache.key_cache + cache.value_cache)
+
+def evaluate(model, input_ids, cache, prefix_tokens):
+    latencies = []
+    nll = []
+    peak_cache_bytes = 0
+    attention_mask = torch.ones((1, 0), dtype=torch.long, device=model.device)
+
+    with torch.inference_mode():
+        for position in range(input_ids.shape[-1] - 1):
+            token = input_ids[:, position:position + 1]
+            attention_mask = torch.cat([attention_mask, attention_mask.new_ones((1, 1))], dim=-1)
+
+            start = time.perf_counter()
+            outputs = model(
+                input_ids=token,
+                attention_mask=attention_mask,
+                position_ids=torch.tensor([[position]], device=model.device),
+                past_key_values=cache,
+                # A HybridCache cannot tell how much of it is filled; the sliding cache is compacted,
+                # so the model counts its own positions there
+                cache_position=torch.tensor([position], device=model.device) if isinstance(cache, HybridCache) else None,
+                use_cache=True
+            )
+            if isinstance(cache, SinkKVCache):
+                attention_mask = cache.compact(attention_mask)
+            elapsed = time.perf_counter() - start
+
+            peak_cache_bytes = max(peak_cache_bytes, cache_bytes(cache))
+            if position + 1 >= prefix_tokens:
+                log_probs = torch.log_softmax(outputs.logits[0, -1].float(), dim=-1)
+                nll.append(-log_probs[input_ids[0, position + 1]].item())
+                latencies.append(elapsed * 1000)
+
+    tail = latencies[-max(1, len(latencies) // 10):]
+    return {
+        "perplexity": round(float(torch.exp(torch.tensor(statistics.mean(nll)))), 3),
+        "ms_per_token_p50": round(statistics.median(latencies), 2),
+        "ms_per_token_last_10pct": round(statistics.mean(tail), 2),
+        "peak_kv_cache_mb": round(peak_cache_bytes / 1024**2, 1)
+    }
+
+def compare(model, input_ids, sink_tokens: int, window: int, prefix_tokens: int):
+    """Full (HybridCache, as the engine decodes without a window) and sliding-window results"""
+    window = min(window, max_kv_window(model, sink_tokens) or window)
+    full_cache = HybridCache(
+        model.config.get_text_config(),
+        max_batch_size=1,
+        max_cache_len=input_ids.shape[-1],
+        device=model.device,
+        dtype=model.dtype
+    )
+    return {
+        "tokens": input_ids.shape[-1],
+        "sink_tokens": sink_tokens,
+        "window": window,
+        "full": evaluate(model, input_ids, full_cache, prefix_tokens),
+        "sliding": evaluate(model, input_ids, SinkKVCache(sink_tokens, window), prefix_tokens)
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare full and sliding-window KV caches")
+    parser.add_argument("text", help="UTF-8 text file with a long consultation transcript")
+    parser.add_argument("--tokens", type=int, default=4096, help="Number of tokens of the text to evaluate")
+    parser.add_argument("--prefix", type=int, default=256, help="Tokens fed before perplexity is measured")
+    parser.add_argument("--sink", type=int, default=4)
+    parser.add_argument("--window", type=int, default=510, help="Capped at (sliding_window - sink) / 2, 510 for MedGemma 4B")
+    args = parser.parse_args()
+
+    engine = MedGemmaEngine()
+    engine.load()
+
+    with open(args.text, "r", encoding="utf-8") as f:
+        text = f.read()
+    input_ids = engine.processor.tokenizer(text, return_tensors="pt")["input_ids"][:, :args.tokens].to(engine.model.device)
+    if input_ids.shape[-1] <= args.prefix + 1:
+        print(f"❌ The text only has {input_ids.shape[-1]} tokens; need more than --prefix {args.prefix}")
+        sys.exit(1)
+
+    report = compare(engine.model, input_ids, args.sink, args.window, args.prefix)
+    print(json.dumps(report, ensure_ascii=False, indent=2))
+
+if __name__ == "__main__":
+    main()
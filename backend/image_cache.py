@@ -0,0 +1,90 @@
+import os
+import hashlib
+import logging
+import threading
+import warnings
+from collections import OrderedDict
+import numpy as np
+import torch
+
+# Same logger as logging_util, without importing the web app (used by the inference server too)
+logger = logging.getLogger("devochat")
+
+def content_hash(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+class TensorCache:
+    """LRU of tensors keyed by image content hash, bounded in bytes. Entries evicted from memory
+    are spilled to spill_dir as .npy files and memory-mapped back on the next hit."""
+
+    def __init__(self, max_bytes: int, spill_dir: str = None):
+        self.max_bytes = max_bytes
+        self.spill_dir = spill_dir
+        self.entries = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        if spill_dir:
+            os.makedirs(spill_dir, exist_ok=True)
+
+    def spill_path(self, key: str):
+        return os.path.join(self.spill_dir, f"{key}.npy")
+
+    def get(self, key: str):
+        with self.lock:
+            tensor = self.entries.get(key)
+            if tensor is not None:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return tensor
+
+        if self.spill_dir and os.path.exists(self.spill_path(key)):
+            array = np.load(self.spill_path(key), mmap_mode="r")
+            with warnings.catch_warnings():
+                # Read-only memmap: the tensor is only ever copied to the model device, never written
+                warnings.simplefilter("ignore")
+                tensor = torch.from_numpy(array)
+            self.put(key, tensor, spill=False)
+            with self.lock:
+                self.hits += 1
+            return tensor
+
+        with self.lock:
+            self.misses += 1
+        return None
+
+    def put(self, key: str, tensor, spill: bool = True):
+        nbytes = tensor.numel() * tensor.element_size()
+        if nbytes > self.max_bytes:
+            return
+
+        evicted = []
+        with self.lock:
+            if key in self.entries:
+                return
+            self.entries[key] = tensor
+            self.size += nbytes
+            while self.size > self.max_bytes:
+                old_key, old_tensor = self.entries.popitem(last=False)
+                self.size -= old_tensor.numel() * old_tensor.element_size()
+                evicted.append((old_key, old_tensor))
+
+        if self.spill_dir and spill:
+            for old_key, old_tensor in evicted:
+                self.spill(old_key, old_tensor)
+
+    def spill(self, key: str, tensor):
+        path = self.spill_path(key)
+        if os.path.exists(path):
+            return
+        try:
+            tmp_path = f"{path}.{os.getpid()}.tmp.npy"
+            np.save(tmp_path, tensor.detach().float().cpu().numpy())
+            os.replace(tmp_path, path)
+        except Exception as ex:
+            logger.error(f"IMAGE_CACHE_SPILL_ERROR: {str(ex)}")
+
+    def stats(self):
+        with self.lock:
+            return {"entries": len(self.entries), "bytes": self.size, "hits": self.hits, "misses": self.misses}
@@ -0,0 +1,54 @@
+import logging
+from pymongo import IndexModel, ASCENDING, DESCENDING
+from database import db
+
+# Same logger as logging_util, without importing the web app
+logger = logging.getLogger("devochat")
+
+# Every query in repositories.py must be served by one of these (verify_query_plans.py checks it)
+INDEXES = {
+    "users": [
+        IndexModel([("email", ASCENDING)], unique=True, name="email_unique")
+    ],
+    "conversations": [
+        IndexModel([("user_id", ASCENDING), ("conversation_id", ASCENDING)], unique=True, name="user_conversation"),
+        IndexModel([("conversation_id", ASCENDING)], name="conversation_id"),
+        IndexModel(
+            [("user_id", ASCENDING), ("starred", DESCENDING), ("starred_at", DESCENDING), ("created_at", DESCENDING), ("_id", DESCENDING)],
+            name="user_starred_created_id"
+        ),
+        IndexModel([("user_id", ASCENDING), ("created_at", DESCENDING), ("_id", DESCENDING)], name="user_created_id"),
+        IndexModel([("alias", ASCENDING), ("created_at", DESCENDING)], name="alias_created")
+    ],
+    "messages": [
+        IndexModel([("user_id", ASCENDING), ("conversation_id", ASCENDING), ("seq", ASCENDING)], unique=True, name="user_conversation_seq")
+    ],
+    "usage_events": [
+        IndexModel([("created_at", ASCENDING)], name="created_at")
+    ],
+    "usage_daily": [
+        # Also the key the rollup $merge matches on, which requires it to be unique
+        IndexModel([("day", ASCENDING), ("user_id", ASCENDING), ("model", ASCENDING)], unique=True, name="day_user_model")
+    ]
+}
+
+# Superseded definitions, dropped so they stop costing writes
+OBSOLETE_INDEXES = {
+    "conversations": ["user_starred_created", "user_created"]
+}
+
+async def ensure_indexes(database=db):
+    """Create the declared indexes; existing ones with the same definition are left alone"""
+    for collection_name, models in INDEXES.items():
+        try:
+            created = await database[collection_name].create_indexes(models)
+            logger.info(f"INDEXES: {collection_name}: {', '.join(created)}")
+
+            # Only after their replacements exist, so queries never lose their index
+            existing = await database[collection_name].index_information()
+            for name in OBSOLETE_INDEXES.get(collection_name, []):
+                if name in existing:
+                    await database[collection_name].drop_index(name)
+        except Exception as ex:
+            # E.g. duplicate emails preventing the unique index; the app still works, just slower
+            logger.error(f"INDEX_ERROR: {collection_name}: {str(ex)}")
@@ -0,0 +1,169 @@
+import os
+import json
+import asyncio
+import logging
+import itertools
+import inference_protocol as protocol
+
+# Same logger as logging_util, without importing the web app (the Flask server uses this client too)
+logger = logging.getLogger("devochat")
+
+DEFAULT_SOCKET_PATH = "/tmp/medgemma.sock"
+
+class InferenceError(Exception):
+    pass
+
+def pack_images(messages, images):
+    """Move image parts ({"path": ...} or {"image": bytes}) into the blob list as {"index": n}"""
+    images = list(images)
+    packed = []
+    for message in messages:
+        content = message.get("content")
+        if isinstance(content, list):
+            parts = []
+            for part in content:
+                if part.get("type") == "image" and ("path" in part or isinstance(part.get("image"), (bytes, bytearray))):
+                    if "path" in part:
+                        with open(part["path"], "rb") as f:
+                            images.append(f.read())
+                    else:
+                        images.append(bytes(part["image"]))
+                    part = {"type": "image", "index": len(images) - 1}
+                parts.append(part)
+            content = parts
+        packed.append({"role": message["role"], "content": content})
+    return packed, images
+
+class Connection:
+    """One socket carrying any number of concurrent requests; a reader task routes the server's
+    frames to each request's queue by request id"""
+
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self.streams = {}
+        self.closed = False
+        self.write_lock = asyncio.Lock()
+        self.reading = asyncio.create_task(self.read_frames())
+
+    async def read_frames(self):
+        error = "Inference server closed the connection"
+        try:
+            while True:
+                frame_type, request_id, payload = await protocol.read_frame(self.reader)
+                stream = self.streams.get(request_id)
+                if stream is not None:
+                    stream.put_nowait((frame_type, payload))
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        except Exception as ex:
+            logger.error(f"INFERENCE_CLIENT_ERROR: {str(ex)}")
+            error = str(ex)
+        finally:
+            self.closed = True
+            for stream in self.streams.values():
+                stream.put_nowait((None, error))
+            self.writer.close()
+
+    def open_stream(self, request_id: int):
+        stream = asyncio.Queue()
+        self.streams[request_id] = stream
+        return stream
+
+    def close_stream(self, request_id: int):
+        self.streams.pop(request_id, None)
+
+    async def send(self, frame: bytes):
+        if self.closed:
+            raise InferenceError("Inference server closed the connection")
+        # Frames of concurrent requests must not interleave, and drain() is awaited by one writer at a time
+        async with self.write_lock:
+            self.writer.write(frame)
+            await self.writer.drain()
+
+    def cancel(self, request_id: int):
+        """Ask the server to stop a request; safe from a finally block, never waits"""
+        if not self.closed:
+            try:
+                self.writer.write(protocol.encode_frame(protocol.CANCEL, request_id))
+            except Exception:
+                pass
+
+async def next_frame(stream):
+    frame_type, payload = await stream.get()
+    if frame_type is None:
+        raise InferenceError(payload)
+    if frame_type == protocol.ERROR:
+        raise InferenceError(payload.decode("utf-8"))
+    return frame_type, payload
+
+class InferenceClient:
+    """Pooled async client for inference_server.py. Requests are multiplexed by request id, so
+    each of the pool_size connections carries any number of them at once and the server's
+    batcher sees every concurrent request."""
+
+    def __init__(self, socket_path: str = DEFAULT_SOCKET_PATH, pool_size: int = int(os.getenv('MEDGEMMA_POOL_SIZE', '8'))):
+        self.socket_path = socket_path
+        self.pool_size = pool_size
+        self.connections = []
+        self.request_ids = itertools.count(1)
+        self.lock = None
+
+    async def connection(self):
+        """The least busy open connection, opening another while the pool has room"""
+        if self.lock is None:
+            self.lock = asyncio.Lock()
+        async with self.lock:
+            self.connections = [connection for connection in self.connections if not connection.closed]
+            connection = min(self.connections, key=lambda connection: len(connection.streams), default=None)
+            if connection is None or (connection.streams and len(self.connections) < self.pool_size):
+                reader, writer = await asyncio.open_unix_connection(self.socket_path)
+                connection = Connection(reader, writer)
+                self.connections.append(connection)
+            return connection
+
+    async def info(self):
+        connection = await self.connection()
+        request_id = next(self.request_ids)
+        stream = connection.open_stream(request_id)
+        try:
+            await connection.send(protocol.encode_frame(protocol.INFO, request_id))
+            _, payload = await next_frame(stream)
+            return json.loads(payload.decode("utf-8"))
+        finally:
+            connection.close_stream(request_id)
+
+    async def generate(self, messages, system_message=None, images=(), temperature: float = 0.0, max_new_tokens: int = 512, model: str = None, background: bool = False):
+        """Yield text deltas and a final token_usage dict, like MedGemmaEngine.agenerate"""
+        messages, images = await asyncio.to_thread(pack_images, messages, images)
+        meta = {
+            "messages": messages,
+            "system_message": system_message,
+            "temperature": temperature,
+            "max_new_tokens": max_new_tokens,
+            "model": model,
+            "background": background
+        }
+        connection = await self.connection()
+        request_id = next(self.request_ids)
+        stream = connection.open_stream(request_id)
+        finished = False
+        try:
+            await connection.send(protocol.encode_frame(protocol.REQUEST, request_id, protocol.encode_request(meta, images)))
+            while True:
+                try:
+                    frame_type, payload = await next_frame(stream)
+                except InferenceError:
+                    finished = True
+                    raise
+                if frame_type == protocol.TOKEN:
+                    yield payload.decode("utf-8")
+                elif frame_type == protocol.USAGE:
+                    finished = True
+                    yield protocol.decode_usage(payload)
+                    return
+        finally:
+            connection.close_stream(request_id)
+            if not finished:
+                # Abandoned mid-stream: tell the server to stop; the connection stays up for the others
+                connection.cancel(request_id)
@@ -0,0 +1,66 @@
+"""
+Binary framing used between the inference server and its clients over a Unix socket
+
+Every frame is a 9 byte header (type, request id, payload length) followed by the payload.
+A REQUEST payload is a length-prefixed JSON header followed by length-prefixed image blobs;
+the server answers with TOKEN frames and ends the stream with USAGE or ERROR.
+"""
+
+import json
+import struct
+
+REQUEST = 1
+TOKEN = 2
+USAGE = 3
+ERROR = 4
+CANCEL = 5
+INFO = 6
+
+HEADER = struct.Struct("!BII")
+LENGTH = struct.Struct("!I")
+USAGE_PAYLOAD = struct.Struct("!II")
+
+MAX_PAYLOAD = 256 * 1024 * 1024
+
+class ProtocolError(Exception):
+    pass
+
+def encode_frame(frame_type: int, request_id: int, payload: bytes = b"") -> bytes:
+    return HEADER.pack(frame_type, request_id, len(payload)) + payload
+
+async def read_frame(reader):
+    """Read one frame; raises asyncio.IncompleteReadError when the peer closes the socket"""
+    frame_type, request_id, length = HEADER.unpack(await reader.readexactly(HEADER.size))
+    if length > MAX_PAYLOAD:
+        raise ProtocolError(f"Frame payload too large: {length} bytes")
+    payload = await reader.readexactly(length) if length else b""
+    return frame_type, request_id, payload
+
+def encode_request(meta: dict, images=()) -> bytes:
+    header = json.dumps(meta, ensure_ascii=False).encode("utf-8")
+    parts = [LENGTH.pack(len(header)), header]
+    for image in images:
+        parts.append(LENGTH.pack(len(image)))
+        parts.append(image)
+    return b"".join(parts)
+
+def decode_request(payload: bytes):
+    (header_length,) = LENGTH.unpack_from(payload, 0)
+    offset = LENGTH.size
+    meta = json.loads(payload[offset:offset + header_length].decode("utf-8"))
+    offset += header_length
+
+    images = []
+    while offset < len(payload):
+        (image_length,) = LENGTH.unpack_from(payload, offset)
+        offset += LENGTH.size
+        images.append(payload[offset:offset + image_length])
+        offset += image_length
+    return meta, images
+
+def encode_usage(input_tokens: int, output_tokens: int) -> bytes:
+    return USAGE_PAYLOAD.pack(input_tokens, output_tokens)
+
+def decode_usage(payload: bytes):
+    input_tokens, output_tokens = USAGE_PAYLOAD.unpack(payload)
+    return {"type": "token_usage", "input_tokens": input_tokens, "output_tokens": output_tokens}
@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+"""
+Standalone MedGemma inference server
+Owns the only copy of each model and streams generations over a Unix domain socket
+to the FastAPI backend and the Flask test server (see inference_protocol.py)
+"""
+
+import os
+import json
+import asyncio
+import logging
+import argparse
+import threading
+from dotenv import load_dotenv
+import inference_protocol as protocol
+from inference_client import DEFAULT_SOCKET_PATH
+from model_registry import ModelRegistry
+
+# Same logger as logging_util, without importing the web app (and with it the database client)
+logger = logging.getLogger("devochat")
+
+load_dotenv()
+
+def attach_images(messages, images):
+    """Replace {"type": "image", "index": n} parts with the image blobs; the engine decodes them"""
+    for message in messages:
+        content = message.get("content")
+        if not isinstance(content, list):
+            continue
+        for part in content:
+            if part.get("type") == "image" and "index" in part:
+                part["image"] = images[part.pop("index")]
+    return messages
+
+async def serve_request(registry, writer, request_id, payload, cancel_event):
+    try:
+        meta, images = protocol.decode_request(payload)
+        messages = attach_images(meta["messages"], images)
+
+        async for chunk in registry.agenerate(
+            meta.get("model"),
+            messages,
+            meta.get("system_message"),
+            meta.get("temperature", 0.0),
+            meta.get("max_new_tokens", 512),
+            cancel_event=cancel_event,
+            background=meta.get("background", False)
+        ):
+            if isinstance(chunk, dict):
+                writer.write(protocol.encode_frame(protocol.USAGE, request_id, protocol.encode_usage(chunk["input_tokens"], chunk["output_tokens"])))
+            else:
+                writer.write(protocol.encode_frame(protocol.TOKEN, request_id, chunk.encode("utf-8")))
+            await writer.drain()
+    except (ConnectionError, asyncio.CancelledError):
+        cancel_event.set()
+    except Exception as ex:
+        logger.error(f"INFERENCE_ERROR: {json.dumps({'request_id': request_id, 'error': str(ex)}, ensure_ascii=False)}")
+        try:
+            writer.write(protocol.encode_frame(protocol.ERROR, request_id, str(ex).encode("utf-8")))
+            await writer.drain()
+        except ConnectionError:
+            pass
+
+async def handle_connection(registry, reader, writer):
+    in_flight = {}
+    try:
+        while True:
+            frame_type, request_id, payload = await protocol.read_frame(reader)
+            if frame_type == protocol.REQUEST:
+                cancel_event = threading.Event()
+                task = asyncio.create_task(serve_request(registry, writer, request_id, payload, cancel_event))
+                in_flight[request_id] = cancel_event
+                task.add_done_callback(lambda _, request_id=request_id: in_flight.pop(request_id, None))
+            elif frame_type == protocol.CANCEL:
+                if request_id in in_flight:
+                    in_flight[request_id].set()
+            elif frame_type == protocol.INFO:
+                writer.write(protocol.encode_frame(protocol.INFO, request_id, json.dumps(registry.info()).encode("utf-8")))
+                await writer.drain()
+    except (asyncio.IncompleteReadError, ConnectionError):
+        pass
+    except protocol.ProtocolError as ex:
+        logger.error(f"INFERENCE_PROTOCOL_ERROR: {str(ex)}")
+    finally:
+        # Client went away: stop whatever it was still generating
+        for cancel_event in in_flight.values():
+            cancel_event.set()
+        writer.close()
+
+async def serve(registry, socket_path):
+    if os.path.exists(socket_path):
+        os.remove(socket_path)
+
+    server = await asyncio.start_unix_server(
+        lambda reader, writer: handle_connection(registry, reader, writer),
+        path=socket_path
+    )
+    os.chmod(socket_path, 0o660)
+    logger.info(f"MedGemma inference server listening on {socket_path}")
+
+    async with server:
+        await server.serve_forever()
+
+def main():
+    parser = argparse.ArgumentParser(description="MedGemma inference server")
+    parser.add_argument("--socket", default=os.getenv('MEDGEMMA_SOCKET', DEFAULT_SOCKET_PATH))
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+    registry = ModelRegistry(shared_weights_dir=os.getenv('MEDGEMMA_SHARED_WEIGHTS'))
+    # Keep the default model resident from the start; others load on first request
+    registry.acquire()
+    registry.release()
+    asyncio.run(serve(registry, args.socket))
+
+if __name__ == "__main__":
+    main()
@@ -1,18 +1,23 @@
 import os
 import re
-import json
 import requests
+from contextlib import asynccontextmanager
 from pydantic import BaseModel
 from fastapi import FastAPI, HTTPException, Response, Depends
 from fastapi.responses import HTMLResponse
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
-from routes import auth, realtime, conversations, uploads
+from routes import auth, realtime, conversations, uploads, usage
 from routes.clients import medgemma_client
 from routes.auth import User, get_current_user
 from bs4 import BeautifulSoup
 import base64
 from logging_util import LoggingMiddleware
+from database import close_database
+from indexes import ensure_indexes
+from write_behind import write_behind
+from usage_ledger import start_rollups
+from config_registry import models_config, mcp_servers_config
 from dotenv import load_dotenv
 
 class URLRequest(BaseModel):
@@ -29,12 +34,24 @@ class MCPServer(BaseModel):
     admin: bool
 
 load_dotenv()
-app = FastAPI()
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    await ensure_indexes()
+    write_behind.start()
+    start_rollups()
+    medgemma_client.start_background_jobs()
+    yield
+    await write_behind.close()
+    close_database()
+
+app = FastAPI(lifespan=lifespan)
 
 app.include_router(auth.router)
 app.include_router(conversations.router)
 app.include_router(uploads.router)
 app.include_router(realtime.router)
+app.include_router(usage.router)
 app.include_router(medgemma_client.router)
 
 app.add_middleware(
@@ -64,14 +81,7 @@ async def get_notice():
 @app.get("/models", response_model=dict)
 async def get_models():
     try:
-        with open("models.json", "r", encoding="utf-8") as f:
-            models_data = json.load(f)
-            
-        models = []
-        for model in models_data["models"]:
-            models.append(model)
-        
-        return {"models": models}
+        return {"models": list(models_config.get()["models"])}
     except Exception as ex:
         raise HTTPException(status_code=500, detail=f"Error occurred while fetching models: {str(ex)}")
 
@@ -79,8 +89,7 @@ async def get_models():
 @app.get("/mcp-servers", response_model=list[MCPServer])
 async def get_mcp_servers(user: User = Depends(get_current_user)):
     try:
-        with open("mcp_servers.json", "r", encoding="utf-8") as f:
-            mcp_servers = json.load(f)
+        mcp_servers = mcp_servers_config.get()
         
         servers = []
         for server_id, config in mcp_servers.items():
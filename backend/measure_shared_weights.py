@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+"""
+Measure per-worker memory when MedGemma weights are shared between processes
+Spawns N workers the same way uvicorn --workers does and reports RSS / PSS / private memory
+"""
+
+import os
+import sys
+import json
+import argparse
+import multiprocessing
+from dotenv import load_dotenv
+
+load_dotenv()
+
+def run_worker(model_name, weights_path, shared, results):
+    import torch
+    from transformers import AutoProcessor, AutoModelForImageTextToText
+    from shared_weights import load_shared_model, read_memory_usage
+
+    hf_token = os.getenv('HUGGINGFACE_TOKEN')
+    baseline = read_memory_usage()
+
+    if shared:
+        model = load_shared_model(AutoModelForImageTextToText, model_name, weights_path, token=hf_token)
+    else:
+        model = AutoModelForImageTextToText.from_pretrained(
+            model_name,
+            torch_dtype=torch.bfloat16,
+            low_cpu_mem_usage=True,
+            trust_remote_code=True,
+            token=hf_token
+        )
+    loaded = read_memory_usage()
+
+    # Run one forward pass so activations and lazily touched pages are counted
+    processor = AutoProcessor.from_pretrained(model_name, token=hf_token)
+    inputs = processor(text="What are the symptoms of diabetes?", return_tensors="pt")
+    with torch.no_grad():
+        model(**inputs)
+    after_forward = read_memory_usage()
+
+    results.put({
+        "pid": os.getpid(),
+        "baseline": baseline,
+        "loaded": loaded,
+        "after_forward": after_forward,
+        "weights_private_mb": round(after_forward["private_mb"] - baseline["private_mb"], 1)
+    })
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure per-worker memory with shared MedGemma weights")
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--model", default="google/medgemma-4b-it")
+    parser.add_argument("--weights", default=os.path.join(os.getenv('MEDGEMMA_SHARED_WEIGHTS', "weights"), "medgemma-4b-it.pt"))
+    parser.add_argument("--private", action="store_true", help="Load an independent copy per worker for comparison")
+    args = parser.parse_args()
+
+    # uvicorn starts its workers with the spawn context, so measure under the same conditions
+    context = multiprocessing.get_context("spawn")
+    results = context.Queue()
+
+    if not args.private:
+        # Export once up front so every measured worker only attaches
+        first = context.Process(target=run_worker, args=(args.model, args.weights, True, results))
+        first.start()
+        first.join()
+        results.get()
+
+    workers = [
+        context.Process(target=run_worker, args=(args.model, args.weights, not args.private, results))
+        for _ in range(args.workers)
+    ]
+    for worker in workers:
+        worker.start()
+    reports = [results.get() for _ in workers]
+    for worker in workers:
+        worker.join()
+
+    total_pss = sum(report["after_forward"]["pss_mb"] for report in reports)
+    summary = {
+        "mode": "private" if args.private else "shared",
+        "workers": args.workers,
+        "model": args.model,
+        "per_worker": reports,
+        "total_pss_mb": round(total_pss, 1),
+        "max_worker_private_mb": max(report["weights_private_mb"] for report in reports)
+    }
+    print(json.dumps(summary, ensure_ascii=False, indent=2))
+
+if __name__ == "__main__":
+    if not sys.platform.startswith("linux"):
+        print("❌ This measurement reads /proc/<pid>/smaps_rollup and only runs on Linux")
+        sys.exit(1)
+    main()
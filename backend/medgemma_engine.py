@@ -0,0 +1,705 @@
+import os
+import gc
+import time
+import queue
+import asyncio
+import logging
+import threading
+from io import BytesIO
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+import torch
+from PIL import Image
+from transformers import AutoProcessor, AutoModelForImageTextToText, DynamicCache, HybridCache
+from shared_weights import load_shared_model
+from image_cache import TensorCache, content_hash
+
+# Same logger as logging_util, without importing the web app (used by the inference server too)
+logger = logging.getLogger("devochat")
+
+MEDGEMMA_MODEL_ID = "google/medgemma-4b-it"
+BASE_ADAPTER = "__base__"
+
+def require_peft():
+    try:
+        import peft  # type: ignore
+        return peft
+    except Exception:
+        raise RuntimeError("peft is not installed. Install it with `pip install peft` to serve LoRA model variants.")
+
+class GenerationPreempted(RuntimeError):
+    """A background generation was stopped to make room for interactive requests"""
+
+def sample_next_tokens(logits, temperatures):
+    """Greedy for rows with temperature <= 0, multinomial sampling for the rest"""
+    next_tokens = logits.argmax(dim=-1, keepdim=True)
+    sampled_rows = [row for row, temperature in enumerate(temperatures) if temperature and temperature > 0]
+    if sampled_rows:
+        rows = torch.tensor(sampled_rows, device=logits.device)
+        scale = torch.tensor([temperatures[row] for row in sampled_rows], device=logits.device).unsqueeze(-1)
+        probs = torch.softmax(logits[rows].float() / scale, dim=-1)
+        next_tokens[rows] = torch.multinomial(probs, num_samples=1)
+    return next_tokens
+
+def to_chat_content(content):
+    """Convert stored message content to the processor's list-of-parts format"""
+    if isinstance(content, str):
+        return [{"type": "text", "text": content}]
+    return [part for part in content if part.get("type") in ("text", "image")]
+
+def read_image_part(part):
+    """Image parts arrive as {"path": ...} (backend uploads), {"image": bytes} (socket clients)
+    or {"image": PIL.Image}; returns (raw bytes or None, PIL image or None)"""
+    if "path" in part:
+        with open(part["path"], "rb") as f:
+            return f.read(), None
+    if isinstance(part.get("image"), (bytes, bytearray)):
+        return bytes(part["image"]), None
+    if isinstance(part.get("image"), Image.Image):
+        return None, part["image"]
+    raise ValueError("Image part has neither a path nor image data")
+
+def feature_key(image_key: str, adapter: str = None):
+    """Feature cache key: a LoRA adapter may touch the vision tower or projector, so its features
+    are cached apart from the base model's"""
+    if not image_key or not adapter:
+        return image_key
+    return content_hash(f"{image_key}:{adapter}".encode())
+
+def max_kv_window(model, sink_tokens: int):
+    """Largest sliding KV window the model supports, None if it has no sliding-window layers.
+    Gemma 3's sliding layers only ever mask sliding_window keys, so the sinks, the window and a
+    window-sized prefill chunk on top of them must all fit in it."""
+    sliding_window = getattr(model.config.get_text_config(), "sliding_window", None)
+    if not sliding_window:
+        return None
+    return max(1, (sliding_window - sink_tokens) // 2)
+
+def left_pad(tensor, length: int, dim: int):
+    """Zero-pad tensor on the left along dim up to length"""
+    shape = list(tensor.shape)
+    shape[dim] = length - tensor.shape[dim]
+    return torch.cat([tensor.new_zeros(shape), tensor], dim=dim)
+
+class SinkKVCache(DynamicCache):
+    """DynamicCache that only keeps the first sink_tokens positions plus the most recent window
+    (attention sinks, StreamingLLM). Kept keys retain their original rotary positions, so memory
+    and per-token cost stay constant while the model still sees absolute positions.
+
+    Sinks are chosen per row from the attention mask, so in a left-padded batch they are each
+    row's first real tokens rather than padding columns."""
+
+    def __init__(self, sink_tokens: int, window: int):
+        super().__init__()
+        self.sink_tokens = sink_tokens
+        self.window = window
+
+    def keep_indices(self, attention_mask):
+        """Columns each row keeps: its first sink_tokens unpadded positions and the last window.
+        A row with fewer real tokens than that keeps its whole tail, so every row keeps the same count."""
+        length = attention_mask.shape[-1]
+        first_real = attention_mask.long().argmax(dim=-1)
+        sink_start = first_real.clamp(max=length - self.window - self.sink_tokens)
+        sinks = sink_start.unsqueeze(-1) + torch.arange(self.sink_tokens, device=attention_mask.device)
+        recent = torch.arange(length - self.window, length, device=attention_mask.device)
+        return torch.cat([sinks, recent.expand(attention_mask.shape[0], -1)], dim=-1)
+
+    def compact(self, attention_mask):
+        """Trim every layer and the matching attention mask; returns the trimmed mask"""
+        if attention_mask.shape[-1] <= self.sink_tokens + self.window:
+            return attention_mask
+        index = self.keep_indices(attention_mask)
+        for layer in range(len(self.key_cache)):
+            self.key_cache[layer] = self.gather(self.key_cache[layer], index)
+            self.value_cache[layer] = self.gather(self.value_cache[layer], index)
+        return attention_mask.gather(-1, index)
+
+    @staticmethod
+    def gather(tensor, index):
+        batch, heads, _, head_dim = tensor.shape
+        index = index.to(tensor.device)[:, None, :, None].expand(batch, heads, -1, head_dim)
+        return tensor.gather(2, index)
+
+    def merge(self, caches):
+        """Stack single-row caches into this (empty) cache, left-padded to a common length"""
+        length = max(cache.key_cache[0].shape[-2] for cache in caches)
+        for layer in range(len(caches[0].key_cache)):
+            self.key_cache.append(torch.cat([left_pad(cache.key_cache[layer], length, -2) for cache in caches], dim=0))
+            self.value_cache.append(torch.cat([left_pad(cache.value_cache[layer], length, -2) for cache in caches], dim=0))
+
+class GenerationRequest:
+    """One queued generation; emit() receives text deltas, then a token_usage dict or an exception"""
+
+    def __init__(self, messages, system_message=None, temperature: float = 0.0, max_new_tokens: int = 512, adapter: str = None, should_stop=None, emit=None, background: bool = False, on_token=None):
+        self.messages = messages
+        self.system_message = system_message
+        self.temperature = temperature
+        self.max_new_tokens = max_new_tokens
+        self.adapter = adapter
+        self.should_stop = should_stop
+        self.emit = emit
+        self.background = background
+        # Called once per generated token (emit() only fires once text is decodable); used by benchmarks
+        self.on_token = on_token
+        self.inputs = None
+        self.image_keys = []
+        self.finished = False
+
+    def finish(self, item):
+        if not self.finished:
+            self.finished = True
+            self.emit(item)
+
+class MedGemmaEngine:
+    """Owns one MedGemma model/processor pair and serves generations in dynamic batches
+    from a single scheduler thread, optionally multiplexing LoRA adapters over the base model"""
+
+    def __init__(self, model_id: str = MEDGEMMA_MODEL_ID, shared_weights_path: str = None):
+        self.model_id = model_id
+        self.shared_weights_path = shared_weights_path
+        self.model = None
+        self.processor = None
+        self.device = None
+        self.eos_token_ids = set()
+        self.load_lock = threading.Lock()
+
+        self.max_batch_size = int(os.getenv('MEDGEMMA_MAX_BATCH_SIZE', '8'))
+        self.batch_window = float(os.getenv('MEDGEMMA_BATCH_WINDOW_MS', '10')) / 1000
+        # Share of currently free device memory a batch's padded KV cache may take
+        self.batch_memory_fraction = float(os.getenv('MEDGEMMA_BATCH_MEMORY_FRACTION', '0.5'))
+        self.pending = deque()
+        # Low-priority work (titles, summaries): only scheduled when no interactive request is waiting
+        self.background_pending = deque()
+        self.pending_ready = threading.Condition()
+        self.scheduler = None
+        self.running = False
+
+        # Image decoding, pixel preprocessing and tokenization run here, off the scheduler thread
+        self.preprocess_workers = int(os.getenv('MEDGEMMA_PREPROCESS_WORKERS', '4'))
+        self.preprocess_pool = None
+
+        # Optional attention-sink sliding window over the KV cache (disabled when window is 0)
+        self.kv_sink_tokens = int(os.getenv('MEDGEMMA_KV_SINK_TOKENS', '4'))
+        self.kv_window = int(os.getenv('MEDGEMMA_KV_WINDOW', '0'))
+
+        # name -> adapter path; loaded adapters are kept in LRU order up to max_adapters
+        self.max_adapters = int(os.getenv('MEDGEMMA_MAX_ADAPTERS', '4'))
+        self.adapter_paths = {}
+        self.loaded_adapters = OrderedDict()
+
+        # Preprocessed pixels and vision-tower features keyed by image content hash, so a
+        # re-sent image (every turn of a conversation about one scan) skips both steps
+        cache_dir = os.getenv('MEDGEMMA_IMAGE_CACHE_DIR')
+        cache_dir = os.path.join(cache_dir, model_id.replace("/", "--")) if cache_dir else None
+        self.pixel_cache = TensorCache(
+            int(os.getenv('MEDGEMMA_IMAGE_CACHE_MB', '512')) * 1024**2,
+            os.path.join(cache_dir, "pixels") if cache_dir else None
+        )
+        self.feature_cache = TensorCache(
+            int(os.getenv('MEDGEMMA_FEATURE_CACHE_MB', '256')) * 1024**2,
+            os.path.join(cache_dir, "features") if cache_dir else None
+        )
+        self.batch_image_keys = None
+
+    @property
+    def loaded(self):
+        return self.model is not None
+
+    def load(self):
+        with self.load_lock:
+            if self.loaded:
+                return
+
+            logger.info(f"Loading {self.model_id}...")
+            # Without HUGGINGFACE_TOKEN, huggingface_hub falls back to the `huggingface-cli login` credentials
+            hf_token = os.getenv('HUGGINGFACE_TOKEN') or None
+            if not hf_token:
+                logger.warning("HUGGINGFACE_TOKEN is not set; using the cached Hugging Face login, if any")
+
+            self.device = "cuda" if torch.cuda.is_available() else "cpu"
+            processor = AutoProcessor.from_pretrained(self.model_id, token=hf_token)
+
+            if self.shared_weights_path:
+                # Memory-mapped weights are CPU-resident and shared with every other process
+                self.device = "cpu"
+                model = load_shared_model(AutoModelForImageTextToText, self.model_id, self.shared_weights_path, token=hf_token)
+            else:
+                model = AutoModelForImageTextToText.from_pretrained(
+                    self.model_id,
+                    torch_dtype=torch.bfloat16 if self.device == "cuda" else torch.float32,
+                    device_map="auto" if self.device == "cuda" else None,
+                    trust_remote_code=True,
+                    token=hf_token
+                )
+                if self.device == "cpu":
+                    model = model.to(self.device)
+            self.attach(model, processor)
+            logger.info(f"{self.model_id} loaded on {self.device}")
+
+    def attach(self, model, processor, device: str = None):
+        """Serve an already constructed model/processor pair (load() and the benchmarks)"""
+        model.eval()
+        self.install_feature_cache(model)
+
+        eos_token_id = model.generation_config.eos_token_id
+        if isinstance(eos_token_id, int):
+            eos_token_id = [eos_token_id]
+        self.eos_token_ids = set(eos_token_id or []) | {processor.tokenizer.eos_token_id}
+
+        limit = max_kv_window(model, self.kv_sink_tokens)
+        if self.kv_window and limit and self.kv_window > limit:
+            logger.warning(f"MEDGEMMA_KV_WINDOW {self.kv_window} exceeds what {self.model_id} supports; using {limit}")
+            self.kv_window = limit
+
+        self.device = device or self.device
+        self.processor = processor
+        self.model = model
+        self.loaded_adapters.clear()
+        self.preprocess_pool = ThreadPoolExecutor(max_workers=self.preprocess_workers, thread_name_prefix="medgemma-preprocess")
+
+    def unload(self):
+        with self.pending_ready:
+            self.running = False
+            self.pending_ready.notify_all()
+        if self.scheduler is not None:
+            self.scheduler.join()
+            self.scheduler = None
+
+        with self.load_lock:
+            if self.preprocess_pool is not None:
+                self.preprocess_pool.shutdown(wait=False)
+                self.preprocess_pool = None
+            self.model = None
+            self.processor = None
+            self.loaded_adapters.clear()
+            gc.collect()
+            if torch.cuda.is_available():
+                torch.cuda.empty_cache()
+
+    def memory_bytes(self):
+        return self.model.get_memory_footprint() if self.loaded else 0
+
+    def info(self):
+        return {
+            "model_name": self.model_id,
+            "device": self.device,
+            "model_loaded": self.loaded,
+            "parameters": sum(p.numel() for p in self.model.parameters()) if self.loaded else 0,
+            "trainable_parameters": sum(p.numel() for p in self.model.parameters() if p.requires_grad) if self.loaded else 0,
+            "adapters": list(self.loaded_adapters.keys()),
+            "pending": len(self.pending),
+            "background_pending": len(self.background_pending),
+            "image_cache": self.pixel_cache.stats(),
+            "feature_cache": self.feature_cache.stats()
+        }
+
+    def install_feature_cache(self, model):
+        """Wrap the model's vision tower so images already seen (batch_image_keys, in pixel_values
+        row order, see feature_key) reuse their cached features and only new ones are encoded"""
+        compute = model.get_image_features
+
+        def get_image_features(pixel_values):
+            keys = self.batch_image_keys
+            if not keys or len(keys) != pixel_values.shape[0]:
+                return compute(pixel_values)
+
+            features = [self.feature_cache.get(key) if key else None for key in keys]
+            missing = [i for i, cached in enumerate(features) if cached is None]
+            if missing:
+                computed = compute(pixel_values[missing])
+                for row, i in enumerate(missing):
+                    features[i] = computed[row]
+                    if keys[i]:
+                        self.feature_cache.put(keys[i], computed[row].to("cpu"))
+            return torch.stack([feature.to(pixel_values.device, dtype=model.dtype) for feature in features])
+
+        model.get_image_features = get_image_features
+
+    def register_adapter(self, name: str, path: str):
+        self.adapter_paths[name] = path
+
+    def ensure_adapters(self, names):
+        """Load the adapters a batch needs, evicting least recently used ones not in the batch"""
+        for name in names:
+            if name in self.loaded_adapters:
+                self.loaded_adapters.move_to_end(name)
+                continue
+
+            while len(self.loaded_adapters) >= self.max_adapters:
+                evicted = next((loaded for loaded in self.loaded_adapters if loaded not in names), None)
+                if evicted is None:
+                    break
+                self.loaded_adapters.pop(evicted)
+                self.model.delete_adapter(evicted)
+                logger.info(f"Evicted LoRA adapter {evicted} from {self.model_id}")
+
+            path = self.adapter_paths[name]
+            hf_token = os.getenv('HUGGINGFACE_TOKEN')
+            if not hasattr(self.model, "peft_config"):
+                peft = require_peft()
+                self.model = peft.PeftModel.from_pretrained(self.model, path, adapter_name=name, token=hf_token)
+            else:
+                self.model.load_adapter(path, adapter_name=name, token=hf_token)
+            self.model.eval()
+            self.loaded_adapters[name] = path
+            logger.info(f"Loaded LoRA adapter {name} on {self.model_id}")
+
+    def load_pixels(self, part):
+        """Content hash and preprocessed pixel tensor of one image part"""
+        data, image = read_image_part(part)
+        key = content_hash(data) if data is not None else None
+        pixel_values = self.pixel_cache.get(key) if key else None
+        if pixel_values is None:
+            if image is None:
+                image = Image.open(BytesIO(data))
+            pixel_values = self.processor.image_processor(images=image.convert("RGB"), return_tensors="pt")["pixel_values"]
+            if key:
+                self.pixel_cache.put(key, pixel_values)
+        return key, pixel_values
+
+    def tokenize(self, prompt: str, pixel_values):
+        """Tokenize a rendered chat prompt the way Gemma3Processor does, expanding every image
+        marker into the full image token run, but with pixels supplied by the caller"""
+        if pixel_values:
+            prompt = prompt.replace(self.processor.boi_token, self.processor.full_image_sequence)
+        inputs = dict(self.processor.tokenizer(prompt, add_special_tokens=False, return_tensors="pt"))
+        inputs["token_type_ids"] = (inputs["input_ids"] == self.processor.image_token_id).long()
+        if pixel_values:
+            inputs["pixel_values"] = torch.cat(pixel_values, dim=0)
+        return inputs
+
+    def prepare(self, request: GenerationRequest):
+        chat = []
+        if request.system_message:
+            chat.append({"role": "system", "content": to_chat_content(request.system_message)})
+
+        pixel_values = []
+        for message in request.messages:
+            parts = []
+            for part in to_chat_content(message["content"]):
+                if part["type"] == "image":
+                    key, pixels = self.load_pixels(part)
+                    request.image_keys.append(key)
+                    pixel_values.append(pixels)
+                    part = {"type": "image"}
+                parts.append(part)
+            chat.append({"role": message["role"], "content": parts})
+
+        prompt = self.processor.apply_chat_template(chat, add_generation_prompt=True, tokenize=False)
+        request.inputs = self.tokenize(prompt, pixel_values)
+
+    def collate(self, rows):
+        """Left-pad per-request inputs into one batch; image tensors are concatenated in row order"""
+        max_length = max(row["input_ids"].shape[-1] for row in rows)
+        pad_token_id = self.processor.tokenizer.pad_token_id or 0
+        batch = {}
+
+        for key in ("input_ids", "attention_mask", "token_type_ids"):
+            if key not in rows[0]:
+                continue
+            fill = pad_token_id if key == "input_ids" else 0
+            padded = []
+            for row in rows:
+                tensor = row[key]
+                padding = tensor.new_full((1, max_length - tensor.shape[-1]), fill)
+                padded.append(torch.cat([padding, tensor], dim=-1))
+            batch[key] = torch.cat(padded, dim=0).to(self.model.device)
+
+        pixel_values = [row["pixel_values"] for row in rows if "pixel_values" in row]
+        if pixel_values:
+            batch["pixel_values"] = torch.cat(pixel_values, dim=0).to(self.model.device, dtype=self.model.dtype)
+        return batch
+
+    def kv_bytes_per_token(self):
+        config = getattr(self.model.config, "text_config", self.model.config)
+        head_dim = getattr(config, "head_dim", None) or config.hidden_size // config.num_attention_heads
+        kv_heads = getattr(config, "num_key_value_heads", None) or config.num_attention_heads
+        return 2 * config.num_hidden_layers * kv_heads * head_dim * (torch.finfo(self.model.dtype).bits // 8)
+
+    def free_memory_bytes(self):
+        if self.device == "cuda":
+            return torch.cuda.mem_get_info()[0]
+        return os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+
+    def take_batch(self, pending, memory_budget: int):
+        """Pop queued requests while the batch's padded KV cache (prompt + max_new_tokens per row)
+        fits in memory_budget; the first request is always taken. Caller holds pending_ready."""
+        per_token = self.kv_bytes_per_token()
+        batch = []
+        max_tokens = 0
+        while pending and len(batch) < self.max_batch_size:
+            request = pending[0]
+            tokens = request.inputs["input_ids"].shape[-1] + request.max_new_tokens
+            if self.kv_window:
+                tokens = min(tokens, self.kv_sink_tokens + self.kv_window + 1)
+            if batch and (len(batch) + 1) * max(max_tokens, tokens) * per_token > memory_budget:
+                break
+            max_tokens = max(max_tokens, tokens)
+            batch.append(pending.popleft())
+        return batch
+
+    def new_cache(self, batch_size: int = 1, max_cache_len: int = None):
+        """Sliding-window cache when enabled, otherwise a HybridCache with room for max_cache_len
+        positions: Gemma 3's sliding-window layers cut their attention mask to sliding_window
+        keys, which a DynamicCache stops matching once the sequence grows past the window"""
+        if self.kv_window:
+            return SinkKVCache(self.kv_sink_tokens, self.kv_window)
+        config = self.model.config.get_text_config()
+        if getattr(config, "sliding_window", None) is None:
+            return DynamicCache()
+        return HybridCache(config, max_batch_size=batch_size, max_cache_len=max_cache_len, device=self.model.device, dtype=self.model.dtype)
+
+    @staticmethod
+    def cache_position(cache, attention_mask, length: int):
+        """Positions of the next length tokens in a HybridCache, which cannot tell how much of
+        it is filled; None lets the model count them for the other caches"""
+        if not isinstance(cache, HybridCache):
+            return None
+        end = attention_mask.shape[-1]
+        return torch.arange(end - length, end, device=attention_mask.device)
+
+    @staticmethod
+    def select_rows(cache, index):
+        """Keep only the index rows of a batch's cache"""
+        if not isinstance(cache, HybridCache):
+            cache.batch_select_indices(index)
+            return
+        for layer in range(len(cache.key_cache)):
+            cache.key_cache[layer] = cache.key_cache[layer][index.to(cache.key_cache[layer].device)]
+            cache.value_cache[layer] = cache.value_cache[layer][index.to(cache.value_cache[layer].device)]
+        cache.max_batch_size = len(index)
+
+    def compact(self, cache, attention_mask):
+        """Trim the sliding-window cache and its attention mask together"""
+        if not isinstance(cache, SinkKVCache):
+            return attention_mask
+        return cache.compact(attention_mask)
+
+    def prefill(self, batch, position_ids, cache, model_kwargs):
+        """Run the prompt through the model and return the last position's logits and the attention
+        mask. In sliding-window mode text-only prompts are fed in window-sized chunks so even prefill
+        memory does not grow with the conversation; each row is prefilled on its own, without left
+        padding, so no chunk is all padding, and the trimmed rows are then stacked for decoding."""
+        input_length = batch["input_ids"].shape[-1]
+        if not isinstance(cache, SinkKVCache) or "pixel_values" in batch or input_length <= self.kv_window:
+            outputs = self.model(
+                **batch,
+                position_ids=position_ids,
+                past_key_values=cache,
+                cache_position=self.cache_position(cache, batch["attention_mask"], input_length),
+                use_cache=True,
+                logits_to_keep=1,
+                **model_kwargs
+            )
+            return outputs.logits[:, -1, :], self.compact(cache, batch["attention_mask"])
+
+        row_caches, row_masks, logits = [], [], []
+        for row in range(batch["input_ids"].shape[0]):
+            real = batch["attention_mask"][row].bool()
+            inputs = {key: batch[key][row:row + 1, real] for key in ("input_ids", "token_type_ids") if key in batch}
+            row_kwargs = {"adapter_names": model_kwargs["adapter_names"][row:row + 1]} if "adapter_names" in model_kwargs else {}
+            row_cache = self.new_cache()
+            attention_mask = batch["attention_mask"][row:row + 1, :0]
+            length = inputs["input_ids"].shape[-1]
+            for start in range(0, length, self.kv_window):
+                end = min(start + self.kv_window, length)
+                attention_mask = torch.cat([attention_mask, attention_mask.new_ones((1, end - start))], dim=-1)
+                outputs = self.model(
+                    **{key: value[:, start:end] for key, value in inputs.items()},
+                    attention_mask=attention_mask,
+                    position_ids=torch.arange(start, end, device=attention_mask.device).unsqueeze(0),
+                    past_key_values=row_cache,
+                    use_cache=True,
+                    logits_to_keep=1,
+                    **row_kwargs
+                )
+                attention_mask = row_cache.compact(attention_mask)
+            row_caches.append(row_cache)
+            row_masks.append(attention_mask)
+            logits.append(outputs.logits[:, -1, :])
+
+        cache.merge(row_caches)
+        mask_length = max(mask.shape[-1] for mask in row_masks)
+        attention_mask = torch.cat([left_pad(mask, mask_length, -1) for mask in row_masks], dim=0)
+        return torch.cat(logits, dim=0), attention_mask
+
+    def run_batch(self, requests, background: bool = False):
+        """Prefill every request together, then decode one token per step for all unfinished rows.
+        A background batch gives way as soon as an interactive request is queued."""
+        adapters = {request.adapter for request in requests if request.adapter}
+        if adapters:
+            self.ensure_adapters(adapters)
+
+        rows = [request.inputs for request in requests]
+        batch = self.collate(rows)
+        input_tokens = [row["input_ids"].shape[-1] for row in rows]
+
+        # Mixed-adapter batches: PEFT routes each row through its own LoRA weights
+        adapter_names = None
+        if hasattr(self.model, "peft_config"):
+            adapter_names = [request.adapter or BASE_ADAPTER for request in requests]
+
+        active = list(range(len(requests)))
+        generated = [[] for _ in requests]
+        emitted = ["" for _ in requests]
+        position_ids = (batch["attention_mask"].cumsum(-1) - 1).clamp(min=0)
+        cache = self.new_cache(len(requests), batch["input_ids"].shape[-1] + max(request.max_new_tokens for request in requests))
+
+        with torch.inference_mode():
+            self.batch_image_keys = [feature_key(key, request.adapter) for request in requests for key in request.image_keys]
+            try:
+                logits, attention_mask = self.prefill(
+                    batch, position_ids, cache,
+                    {"adapter_names": adapter_names} if adapter_names else {}
+                )
+            finally:
+                self.batch_image_keys = None
+            position_ids = position_ids[:, -1:]
+
+            while active:
+                next_tokens = sample_next_tokens(logits, [requests[i].temperature for i in active])
+                keep = []
+                for row, (i, token_id) in enumerate(zip(active, next_tokens.squeeze(-1).tolist())):
+                    request = requests[i]
+                    finished = token_id in self.eos_token_ids or (request.should_stop is not None and request.should_stop())
+                    if not finished:
+                        generated[i].append(token_id)
+                        if request.on_token is not None:
+                            request.on_token()
+                        # Decode the whole suffix so multi-token characters are emitted once complete
+                        text = self.processor.decode(generated[i], skip_special_tokens=True)
+                        if len(text) > len(emitted[i]) and not text.endswith("\ufffd"):
+                            request.emit(text[len(emitted[i]):])
+                            emitted[i] = text
+                        finished = len(generated[i]) >= request.max_new_tokens
+
+                    if finished:
+                        request.finish({
+                            "type": "token_usage",
+                            "input_tokens": input_tokens[i],
+                            "output_tokens": len(generated[i])
+                        })
+                    else:
+                        keep.append(row)
+
+                if not keep:
+                    break
+                if background and self.pending:
+                    for row in keep:
+                        requests[active[row]].finish(GenerationPreempted("Preempted by interactive requests"))
+                    break
+                if len(keep) < len(active):
+                    # Drop finished rows from the KV cache so they stop costing compute
+                    index = torch.tensor(keep, device=attention_mask.device)
+                    self.select_rows(cache, index)
+                    attention_mask = attention_mask[index]
+                    position_ids = position_ids[index]
+                    next_tokens = next_tokens[index]
+                    active = [active[row] for row in keep]
+                    if adapter_names:
+                        adapter_names = [adapter_names[row] for row in keep]
+
+                attention_mask = torch.cat([attention_mask, attention_mask.new_ones((len(active), 1))], dim=-1)
+                position_ids = position_ids[:, -1:] + 1
+                logits = self.model(
+                    input_ids=next_tokens,
+                    attention_mask=attention_mask,
+                    position_ids=position_ids,
+                    past_key_values=cache,
+                    cache_position=self.cache_position(cache, attention_mask, 1),
+                    use_cache=True,
+                    **({"adapter_names": adapter_names} if adapter_names else {})
+                ).logits[:, -1, :]
+                attention_mask = self.compact(cache, attention_mask)
+
+    def scheduler_loop(self):
+        while True:
+            with self.pending_ready:
+                while self.running and not self.pending and not self.background_pending:
+                    self.pending_ready.wait()
+                if not self.running:
+                    return
+
+            # Give concurrent requests a moment to arrive so they share one batch
+            time.sleep(self.batch_window)
+            memory_budget = self.free_memory_bytes() * self.batch_memory_fraction
+            with self.pending_ready:
+                background = not self.pending
+                batch = self.take_batch(self.background_pending if background else self.pending, memory_budget)
+
+            for request in batch:
+                if request.should_stop and request.should_stop():
+                    request.finish({"type": "token_usage", "input_tokens": 0, "output_tokens": 0})
+            batch = [request for request in batch if not request.finished]
+            if not batch:
+                continue
+            try:
+                self.run_batch(batch, background)
+            except Exception as ex:
+                logger.error(f"Batch generation failed on {self.model_id}: {str(ex)}")
+                for request in batch:
+                    request.finish(ex)
+
+    def submit(self, request: GenerationRequest):
+        """Preprocess on the pool, then queue for the next batch; images of all requests in a
+        batch go through the vision tower together"""
+        def preprocessed(future):
+            if future.exception() is not None:
+                request.finish(future.exception())
+            else:
+                self.enqueue(request)
+
+        self.preprocess_pool.submit(self.prepare, request).add_done_callback(preprocessed)
+
+    def enqueue(self, request: GenerationRequest):
+        with self.pending_ready:
+            (self.background_pending if request.background else self.pending).append(request)
+            if self.scheduler is None or not self.scheduler.is_alive():
+                self.running = True
+                self.scheduler = threading.Thread(target=self.scheduler_loop, name=f"medgemma-scheduler-{self.model_id}", daemon=True)
+                self.scheduler.start()
+            self.pending_ready.notify()
+
+    def generate(self, messages, system_message=None, temperature: float = 0.0, max_new_tokens: int = 512, adapter: str = None, should_stop=None, background: bool = False):
+        """Yield decoded text deltas, then a token_usage dict"""
+        results = queue.Queue()
+        abandoned = threading.Event()
+        self.submit(GenerationRequest(
+            messages, system_message, temperature, max_new_tokens, adapter,
+            should_stop=lambda: abandoned.is_set() or (should_stop is not None and should_stop()),
+            emit=results.put,
+            background=background
+        ))
+        try:
+            while True:
+                item = results.get()
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+                if isinstance(item, dict):
+                    return
+        finally:
+            abandoned.set()
+
+    async def agenerate(self, messages, system_message=None, temperature: float = 0.0, max_new_tokens: int = 512, adapter: str = None, cancel_event: threading.Event = None, background: bool = False):
+        """Queue a generation on the scheduler thread without blocking the event loop"""
+        loop = asyncio.get_running_loop()
+        results = asyncio.Queue()
+        cancel_event = cancel_event or threading.Event()
+
+        self.submit(GenerationRequest(
+            messages, system_message, temperature, max_new_tokens, adapter,
+            should_stop=cancel_event.is_set,
+            emit=lambda item: loop.call_soon_threadsafe(results.put_nowait, item),
+            background=background
+        ))
+        try:
+            while True:
+                item = await results.get()
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+                if isinstance(item, dict):
+                    return
+        finally:
+            cancel_event.set()
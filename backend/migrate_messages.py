@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+"""
+Move messages out of the conversation documents' "conversation" arrays into the messages collection
+Each conversation is migrated on its own: its messages are (re)written with seq = position, then
+the array is replaced by message_count. Safe to interrupt and re-run; finished conversations no
+longer have the array and are skipped. Stop the API while it runs.
+"""
+
+import asyncio
+import argparse
+from pymongo import InsertOne
+from database import db, close_database
+from indexes import ensure_indexes
+
+async def migrate_conversation(conversation, dry_run: bool):
+    user_id, conversation_id = conversation["user_id"], conversation["conversation_id"]
+    messages = conversation.get("conversation") or []
+    if dry_run:
+        return len(messages)
+
+    # Leftovers of an interrupted run for this conversation are replaced, not duplicated
+    await db.messages.delete_many({"user_id": user_id, "conversation_id": conversation_id})
+    if messages:
+        await db.messages.bulk_write([
+            InsertOne({"user_id": user_id, "conversation_id": conversation_id, "seq": seq, "message": message})
+            for seq, message in enumerate(messages)
+        ], ordered=False)
+    await db.conversations.update_one(
+        {"_id": conversation["_id"]},
+        {"$set": {"message_count": len(messages)}, "$unset": {"conversation": ""}}
+    )
+    return len(messages)
+
+async def migrate(batch_size: int, dry_run: bool):
+    if not dry_run:
+        await ensure_indexes()
+    conversations = migrated_messages = 0
+    cursor = db.conversations.find(
+        {"conversation": {"$exists": True}},
+        {"user_id": 1, "conversation_id": 1, "conversation": 1}
+    ).batch_size(batch_size)
+    async for conversation in cursor:
+        migrated_messages += await migrate_conversation(conversation, dry_run)
+        conversations += 1
+        if conversations % 100 == 0:
+            print(f"{conversations} conversations, {migrated_messages} messages")
+
+    action = "would be migrated" if dry_run else "migrated"
+    print(f"✅ {conversations} conversations, {migrated_messages} messages {action}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Migrate conversation message arrays to the messages collection")
+    parser.add_argument("--batch-size", type=int, default=50, help="Conversations fetched per round trip")
+    parser.add_argument("--dry-run", action="store_true", help="Only count what would be migrated")
+    args = parser.parse_args()
+    try:
+        asyncio.run(migrate(args.batch_size, args.dry_run))
+    finally:
+        close_database()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,162 @@
+import os
+import gc
+import asyncio
+import logging
+import threading
+from collections import OrderedDict
+from medgemma_engine import MedGemmaEngine, MEDGEMMA_MODEL_ID
+from config_registry import JsonConfig
+
+# Same logger as logging_util, without importing the web app (used by the inference server too)
+logger = logging.getLogger("devochat")
+
+MODELS_PATH = os.path.join(os.path.dirname(__file__), "models.json")
+LOCAL_ENDPOINT = "/medgemma"
+DEFAULT_MODEL = os.getenv('MEDGEMMA_DEFAULT_MODEL', "medgemma-4b-it")
+
+def local_models(models_data: dict):
+    return {
+        model["model_name"]: model
+        for model in models_data["models"]
+        if model.get("endpoint") == LOCAL_ENDPOINT
+    }
+
+class ModelRegistry:
+    """Loads the local models listed in models.json on demand and keeps them within a memory budget,
+    evicting the least recently used idle model first"""
+
+    def __init__(self, models_path: str = MODELS_PATH, memory_budget_bytes: int = None, shared_weights_dir: str = None):
+        self.models_path = models_path
+        # Re-read whenever models.json changes, so edited entries (not just new ones) take effect
+        self.configs = JsonConfig(models_path, local_models)
+        self.memory_budget_bytes = memory_budget_bytes or int(float(os.getenv('MODEL_MEMORY_BUDGET_GB', '16')) * 1024**3)
+        self.shared_weights_dir = shared_weights_dir
+        self.engines = OrderedDict()
+        self.in_use = {}
+        self.sizes = {}
+        self.lock = threading.Lock()
+
+    def model_config(self, model_name: str):
+        configs = self.configs.get()
+        if model_name not in configs:
+            # A model added moments ago may not have been picked up by the watcher yet
+            self.configs.reload()
+            configs = self.configs.get()
+        if model_name not in configs:
+            raise KeyError(f"Model {model_name} is not a local model in models.json")
+        return configs[model_name]
+
+    def resolve(self, model_name: str = None):
+        """Map a models.json name to (base model name, LoRA adapter name or None)"""
+        model_name = model_name or DEFAULT_MODEL
+        config = self.model_config(model_name)
+        if config.get("base_model"):
+            return config["base_model"], model_name
+        return model_name, None
+
+    def create_engine(self, model_name: str, config: dict):
+        shared_weights_path = None
+        if self.shared_weights_dir:
+            shared_weights_path = os.path.join(self.shared_weights_dir, f"{model_name}.pt")
+        return MedGemmaEngine(config.get("hf_model", MEDGEMMA_MODEL_ID), shared_weights_path=shared_weights_path)
+
+    def expected_size(self, model_name: str, config: dict):
+        if model_name in self.sizes:
+            return self.sizes[model_name]
+        return int(float(config.get("memory_gb", 0)) * 1024**3)
+
+    def used_bytes(self):
+        return sum(self.sizes.get(name, 0) for name, engine in self.engines.items() if engine.loaded)
+
+    def evict_for(self, needed_bytes: int, keep: str):
+        """Drop idle models, least recently used first, until needed_bytes fits the budget.
+        Called under the lock; returns the dropped engines for unload() to free outside it."""
+        evicted = []
+        for name in list(self.engines.keys()):
+            if self.used_bytes() + needed_bytes <= self.memory_budget_bytes:
+                break
+            if name == keep or self.in_use.get(name, 0) > 0:
+                continue
+            evicted.append((name, self.engines.pop(name)))
+        return evicted
+
+    def unload(self, evicted):
+        """Free evicted engines; slow (GPU memory release, gc), so never done while holding the lock"""
+        for name, engine in evicted:
+            engine.unload()
+            logger.info(f"Evicted {name} from memory ({self.sizes.get(name, 0) / 1024**3:.1f} GB)")
+        if evicted:
+            gc.collect()
+
+    def acquire(self, model_name: str = None):
+        """Return a loaded engine for model_name; callers must release() it when done"""
+        with self.lock:
+            # LoRA variants share their base model's engine, so only the base counts against the budget
+            model_name, adapter = self.resolve(model_name)
+            engine = self.engines.get(model_name)
+            if engine is None:
+                config = self.model_config(model_name)
+                evicted = self.evict_for(self.expected_size(model_name, config), keep=model_name)
+                engine = self.create_engine(model_name, config)
+                self.engines[model_name] = engine
+            else:
+                evicted = []
+            if adapter:
+                engine.register_adapter(adapter, self.model_config(adapter)["adapter"])
+            self.engines.move_to_end(model_name)
+            self.in_use[model_name] = self.in_use.get(model_name, 0) + 1
+
+        try:
+            # Unloading and loading happen outside the registry lock so requests for resident models are not blocked
+            self.unload(evicted)
+            if not engine.loaded:
+                engine.load()
+                with self.lock:
+                    self.sizes[model_name] = engine.memory_bytes()
+                    evicted = self.evict_for(0, keep=model_name)
+                self.unload(evicted)
+        except Exception:
+            with self.lock:
+                self.in_use[model_name] = max(0, self.in_use[model_name] - 1)
+                if self.engines.get(model_name) is engine and not engine.loaded:
+                    self.engines.pop(model_name)
+            raise
+        return engine
+
+    def release(self, model_name: str = None):
+        with self.lock:
+            model_name, _ = self.resolve(model_name)
+            if model_name in self.in_use:
+                self.in_use[model_name] = max(0, self.in_use[model_name] - 1)
+
+    async def agenerate(self, model_name: str, *args, **kwargs):
+        engine = await asyncio.to_thread(self.acquire, model_name)
+        try:
+            async for chunk in engine.agenerate(*args, adapter=self.adapter_name(model_name), **kwargs):
+                yield chunk
+        finally:
+            self.release(model_name)
+
+    def resident(self, model_name: str = None):
+        """Whether model_name's engine is already loaded (background jobs never trigger a load)"""
+        with self.lock:
+            engine = self.engines.get(self.resolve(model_name)[0])
+            return engine is not None and engine.loaded
+
+    def adapter_name(self, model_name: str = None):
+        with self.lock:
+            return self.resolve(model_name)[1]
+
+    def info(self):
+        with self.lock:
+            resident = [
+                dict(engine.info(), name=name, memory_bytes=self.sizes.get(name, 0), in_use=self.in_use.get(name, 0))
+                for name, engine in self.engines.items() if engine.loaded
+            ]
+        return {
+            "model_loaded": bool(resident),
+            "device": resident[-1]["device"] if resident else None,
+            "resident": resident,
+            "memory_budget_bytes": self.memory_budget_bytes,
+            "memory_used_bytes": sum(model["memory_bytes"] for model in resident)
+        }
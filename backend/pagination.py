@@ -0,0 +1,49 @@
+import base64
+from bson import json_util
+
+class InvalidCursor(ValueError):
+    pass
+
+def encode_cursor(document: dict, sort) -> str:
+    """Opaque cursor holding the sort key values of the last document on a page"""
+    values = {field: document.get(field) for field, _ in sort}
+    return base64.urlsafe_b64encode(json_util.dumps(values).encode()).decode()
+
+def decode_cursor(cursor: str) -> dict:
+    try:
+        values = json_util.loads(base64.urlsafe_b64decode(cursor.encode()).decode())
+    except Exception:
+        raise InvalidCursor("Invalid cursor")
+    if not isinstance(values, dict):
+        raise InvalidCursor("Invalid cursor")
+    return values
+
+def keyset_filter(sort, after: dict) -> dict:
+    """Documents strictly after the given sort key values, for a sort whose last key is unique:
+    (k1 past v1) or (k1 = v1 and k2 past v2) or ..."""
+    clauses = []
+    for i, (field, direction) in enumerate(sort):
+        if field not in after:
+            raise InvalidCursor("Invalid cursor")
+        value = after[field]
+        if value is None:
+            # Nulls sort first: nothing comes after them descending, every non-null value ascending
+            if direction < 0:
+                continue
+            condition = {"$ne": None}
+        else:
+            condition = {"$gt" if direction > 0 else "$lt": value}
+        clauses.append({**{key: after[key] for key, _ in sort[:i]}, field: condition})
+    return {"$or": clauses}
+
+async def fetch_page(collection, query: dict, projection: dict, sort, limit: int, cursor: str = None):
+    """One page of query in sort order, starting after cursor; returns (documents, next cursor or None).
+    The sort must end in a unique key and be backed by an index for the page to cost O(limit)."""
+    if cursor:
+        query = {"$and": [query, keyset_filter(sort, decode_cursor(cursor))]}
+    if projection and any(value for value in projection.values()):
+        # Inclusion projections still need the sort keys to build the next cursor
+        projection = {**projection, **{field: 1 for field, _ in sort}}
+    documents = await collection.find(query, projection).sort(sort).limit(limit + 1).to_list(length=limit + 1)
+    next_cursor = encode_cursor(documents[limit - 1], sort) if len(documents) > limit else None
+    return documents[:limit], next_cursor
@@ -0,0 +1,86 @@
+import os
+import time
+import asyncio
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import bcrypt
+
+# Same logger as logging_util, without importing the web app
+logger = logging.getLogger("devochat")
+
+# bcrypt releases the GIL, so a couple of threads hash in parallel without touching the event loop
+HASH_WORKERS = int(os.getenv('PASSWORD_HASH_WORKERS', '2'))
+# Hashes running or waiting beyond this are refused instead of queueing for seconds
+HASH_MAX_PENDING = int(os.getenv('PASSWORD_HASH_MAX_PENDING', '64'))
+
+class HasherBusy(Exception):
+    pass
+
+class PasswordHasher:
+    """Runs bcrypt in a small dedicated thread pool with a cap on queued work"""
+
+    def __init__(self, workers: int = HASH_WORKERS, max_pending: int = HASH_MAX_PENDING):
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="bcrypt")
+        self.workers = workers
+        self.max_pending = max_pending
+        self.lock = threading.Lock()
+        self.pending = 0
+        self.running = 0
+        self.peak_pending = 0
+        self.completed = 0
+        self.rejected = 0
+        self.wait_seconds = 0.0
+        self.run_seconds = 0.0
+
+    def work(self, function, args, queued_at: float):
+        started = time.perf_counter()
+        with self.lock:
+            self.running += 1
+            self.wait_seconds += started - queued_at
+        try:
+            return function(*args)
+        finally:
+            with self.lock:
+                self.running -= 1
+                self.run_seconds += time.perf_counter() - started
+
+    async def run(self, function, *args):
+        with self.lock:
+            if self.pending >= self.max_pending:
+                self.rejected += 1
+                logger.warning(f"PASSWORD_HASH_BUSY: {self.pending} pending, {self.rejected} rejected so far")
+                raise HasherBusy(f"{self.pending} password hashes already pending")
+            self.pending += 1
+            self.peak_pending = max(self.peak_pending, self.pending)
+        try:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self.executor, self.work, function, args, time.perf_counter())
+        finally:
+            with self.lock:
+                self.pending -= 1
+                self.completed += 1
+
+    async def hash(self, password: str) -> str:
+        hashed = await self.run(bcrypt.hashpw, password.encode(), bcrypt.gensalt())
+        return hashed.decode()
+
+    async def verify(self, password: str, hashed_password: str) -> bool:
+        return await self.run(bcrypt.checkpw, password.encode(), hashed_password.encode())
+
+    def stats(self):
+        with self.lock:
+            return {
+                "workers": self.workers,
+                "max_pending": self.max_pending,
+                "pending": self.pending,
+                "running": self.running,
+                "queued": self.pending - self.running,
+                "peak_pending": self.peak_pending,
+                "completed": self.completed,
+                "rejected": self.rejected,
+                "avg_wait_ms": round(self.wait_seconds / self.completed * 1000, 2) if self.completed else 0.0,
+                "avg_run_ms": round(self.run_seconds / self.completed * 1000, 2) if self.completed else 0.0
+            }
+
+hasher = PasswordHasher()
@@ -0,0 +1,419 @@
+import os
+import time
+from datetime import datetime, timezone, timedelta
+from bson import ObjectId
+from pymongo import ReturnDocument, InsertOne, UpdateOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+from database import db
+from pagination import fetch_page
+
+# Authenticated users' profiles are served from a per-process cache for this long; updates made
+# through this process invalidate it right away, other workers see them after at most the TTL
+USER_CACHE_TTL = float(os.getenv('USER_CACHE_TTL_SECONDS', '30'))
+USER_CACHE_MAX_ENTRIES = 10000
+# Permission and billing fields are never cached: every worker reads them fresh, so an admin change,
+# a new charge or the last trial use applies on the next request whichever worker made it
+USER_FRESH_FIELDS = {"admin": 1, "trial": 1, "trial_remaining": 1, "billing": 1}
+# Ids of the latest turns charged to each user (billed_turns), so a retried charge is not applied
+# twice; far more than one write-behind batch can hold
+BILLED_TURNS_KEPT = 500
+
+async def insert_new(collection, documents: list, session=None):
+    """Bulk insert that skips documents whose unique key is already stored, so a retried batch
+    that partly went through the first time is safe"""
+    if not documents:
+        return
+    try:
+        await collection.bulk_write([InsertOne(document) for document in documents], ordered=False, session=session)
+    except BulkWriteError as ex:
+        if any(error.get("code") != 11000 for error in ex.details.get("writeErrors", [])) or ex.details.get("writeConcernErrors"):
+            raise
+
+def message_document(user_id: str, conversation_id: str, seq: int, message: dict, prepared: dict = None):
+    document = {"user_id": user_id, "conversation_id": conversation_id, "seq": seq, "message": message}
+    if prepared is not None:
+        document["prepared"] = prepared
+    return document
+
+class UserRepository:
+    """All queries against the users collection"""
+
+    def __init__(self, collection, cache_ttl: float = USER_CACHE_TTL):
+        self.collection = collection
+        self.cache_ttl = cache_ttl
+        self.cache = {}
+        # Bumped on every invalidation so a read that raced with an update is not cached
+        self.version = 0
+
+    async def find_by_id(self, user_id: str, projection: dict = None):
+        if not ObjectId.is_valid(user_id):
+            return None
+        return await self.collection.find_one({"_id": ObjectId(user_id)}, projection)
+
+    async def find_cached(self, user_id: str):
+        """find_by_id without the password; the profile comes from the cache while it is fresh,
+        USER_FRESH_FIELDS always from the database"""
+        entry = self.cache.get(user_id)
+        if entry and entry[0] > time.monotonic():
+            fresh = await self.find_by_id(user_id, USER_FRESH_FIELDS)
+            # Deleted by another worker
+            if not fresh:
+                self.cache.pop(user_id, None)
+                return None
+            return {**entry[1], **fresh}
+
+        version = self.version
+        user = await self.find_by_id(user_id, {"password": 0, "billed_turns": 0})
+        if user and self.cache_ttl > 0 and version == self.version:
+            self.cache.pop(user_id, None)
+            if len(self.cache) >= USER_CACHE_MAX_ENTRIES:
+                self.cache.pop(next(iter(self.cache)))
+            profile = {field: value for field, value in user.items() if field not in USER_FRESH_FIELDS}
+            self.cache[user_id] = (time.monotonic() + self.cache_ttl, profile)
+        return user
+
+    def invalidate(self, user_id: str):
+        self.version += 1
+        self.cache.pop(user_id, None)
+
+    async def find_by_email(self, email: str, projection: dict = None):
+        return await self.collection.find_one({"email": email}, projection)
+
+    async def insert(self, user: dict):
+        result = await self.collection.insert_one(user)
+        return str(result.inserted_id)
+
+    async def list(self, limit: int, projection: dict, cursor: str = None):
+        """A page of users in _id order; returns (users, next cursor or None)"""
+        return await fetch_page(self.collection, {}, projection, [("_id", 1)], limit, cursor)
+
+    async def increment(self, user_id: str, fields: dict):
+        await self.collection.update_one({"_id": ObjectId(user_id)}, {"$inc": fields})
+        self.invalidate(user_id)
+
+    async def charge_turns(self, charges: list, session=None):
+        """[(user_id, turn_id, {field: amount})] in one bulk write. A turn whose id is already in
+        the user's billed_turns is skipped, so retrying a write that partly went through does not
+        charge it twice."""
+        if not charges:
+            return
+        await self.collection.bulk_write(
+            [
+                UpdateOne(
+                    {"_id": ObjectId(user_id), "billed_turns": {"$ne": turn_id}},
+                    {"$inc": fields, "$push": {"billed_turns": {"$each": [turn_id], "$slice": -BILLED_TURNS_KEPT}}}
+                )
+                for user_id, turn_id, fields in charges
+            ],
+            ordered=False,
+            session=session
+        )
+        for user_id in {user_id for user_id, _, _ in charges}:
+            self.invalidate(user_id)
+
+    async def update(self, user_id: str, fields: dict):
+        """Set fields and return the updated document (None if the user does not exist)"""
+        user = await self.collection.find_one_and_update(
+            {"_id": ObjectId(user_id)},
+            {"$set": fields},
+            return_document=ReturnDocument.AFTER
+        )
+        self.invalidate(user_id)
+        return user
+
+class MessageRepository:
+    """Messages live one per document, keyed by (user_id, conversation_id, seq) where seq is the
+    message's position in the conversation; appends, tail reads and truncation only touch the
+    messages involved instead of rewriting one ever-growing array"""
+
+    def __init__(self, collection):
+        self.collection = collection
+
+    async def insert(self, user_id: str, conversation_id: str, first_seq: int, messages: list):
+        if messages:
+            await self.collection.insert_many([
+                message_document(user_id, conversation_id, first_seq + i, message)
+                for i, message in enumerate(messages)
+            ], ordered=True)
+
+    async def insert_many(self, appends, session=None):
+        """[(user_id, conversation_id, first_seq, messages, prepared or None)] in one bulk write, where
+        prepared holds each message's model-ready form. Positions that are already stored (a retried
+        write that went through the first time) are skipped."""
+        await insert_new(self.collection, [
+            message_document(user_id, conversation_id, first_seq + i, message, prepared[i] if prepared else None)
+            for user_id, conversation_id, first_seq, messages, prepared in appends
+            for i, message in enumerate(messages)
+        ], session)
+
+    async def range(self, user_id: str, conversation_id: str, start: int = 0, count: int = None):
+        """Messages from position start on (count of them, or all), in order"""
+        query = {"user_id": user_id, "conversation_id": conversation_id, "seq": {"$gte": start}}
+        cursor = self.collection.find(query, {"_id": 0, "message": 1}).sort("seq", 1)
+        if count is not None:
+            cursor = cursor.limit(count)
+        return [doc["message"] for doc in await cursor.to_list(length=count)]
+
+    async def seq_at(self, user_id: str, conversation_id: str, index: int):
+        """seq of the message at index in the conversation as clients see it (None past the end);
+        positions released by a dropped turn leave gaps in seq, so the two can differ"""
+        documents = await self.collection.find(
+            {"user_id": user_id, "conversation_id": conversation_id},
+            {"_id": 0, "seq": 1}
+        ).sort("seq", 1).skip(index).limit(1).to_list(length=1)
+        return documents[0]["seq"] if documents else None
+
+    async def index_of(self, user_id: str, conversation_id: str, seq: int):
+        """Index of the message at seq in the conversation as clients see it (see seq_at)"""
+        return await self.collection.count_documents({"user_id": user_id, "conversation_id": conversation_id, "seq": {"$lt": seq}})
+
+    async def page(self, user_id: str, conversation_id: str, limit: int, cursor: str = None):
+        """Messages before the cursor, newest page first, each page in order; returns
+        ([{"seq", "message"}], cursor of the previous page or None)"""
+        documents, next_cursor = await fetch_page(
+            self.collection,
+            {"user_id": user_id, "conversation_id": conversation_id},
+            {"_id": 0, "seq": 1, "message": 1},
+            [("seq", -1)],
+            limit,
+            cursor
+        )
+        return documents[::-1], next_cursor
+
+    async def since(self, user_id: str, conversation_id: str, start: int):
+        """Message documents (message and prepared) from position start on, in order"""
+        return await self.collection.find(
+            {"user_id": user_id, "conversation_id": conversation_id, "seq": {"$gte": start}},
+            {"_id": 0, "message": 1, "prepared": 1}
+        ).sort("seq", 1).to_list(length=None)
+
+    async def outdated_prepared(self, version: int, limit: int, after=None):
+        """Message documents whose prepared form is missing or older than version, in _id order"""
+        query = {"prepared.version": {"$ne": version}}
+        if after is not None:
+            query["_id"] = {"$gt": after}
+        return await self.collection.find(query, {"message": 1}).sort("_id", 1).limit(limit).to_list(length=limit)
+
+    async def set_prepared(self, prepared: dict):
+        """{message document _id: prepared} in one bulk write"""
+        if prepared:
+            await self.collection.bulk_write(
+                [UpdateOne({"_id": _id}, {"$set": {"prepared": value}}) for _id, value in prepared.items()],
+                ordered=False
+            )
+
+    async def first(self, conversations):
+        """First message of each (user_id, conversation_id), keyed by conversation_id"""
+        if not conversations:
+            return {}
+        docs = await self.collection.find(
+            {"$or": [{"user_id": user_id, "conversation_id": conversation_id, "seq": 0} for user_id, conversation_id in conversations]},
+            {"_id": 0, "conversation_id": 1, "message": 1}
+        ).to_list(length=len(conversations))
+        return {doc["conversation_id"]: doc["message"] for doc in docs}
+
+    async def truncate(self, user_id: str, conversation_id: str, start: int, end: int = None):
+        """Delete the messages from position start on (up to end, exclusive)"""
+        seq = {"$gte": start} if end is None else {"$gte": start, "$lt": end}
+        await self.collection.delete_many({"user_id": user_id, "conversation_id": conversation_id, "seq": seq})
+
+    async def delete(self, user_id: str, conversation_id: str):
+        await self.collection.delete_many({"user_id": user_id, "conversation_id": conversation_id})
+
+    async def delete_all(self, user_id: str):
+        await self.collection.delete_many({"user_id": user_id})
+
+class ConversationRepository:
+    """All queries against the conversations collection; the conversation document keeps the
+    settings, summary and message_count, the messages themselves are in MessageRepository"""
+
+    def __init__(self, collection, messages: MessageRepository):
+        self.collection = collection
+        self.messages = messages
+
+    async def find(self, user_id: str, conversation_id: str, projection: dict = None):
+        return await self.collection.find_one({"user_id": user_id, "conversation_id": conversation_id}, projection)
+
+    async def find_by_conversation_id(self, conversation_id: str, projection: dict = None):
+        return await self.collection.find_one({"conversation_id": conversation_id}, projection)
+
+    async def list_for_user(self, user_id: str, projection: dict, sort, limit: int, cursor: str = None):
+        """A page of the user's conversations; sort must end in _id. Returns (conversations, next cursor or None)"""
+        return await fetch_page(self.collection, {"user_id": user_id}, projection, sort, limit, cursor)
+
+    async def insert(self, conversation: dict):
+        await self.collection.insert_one(conversation)
+
+    async def update(self, user_id: str, conversation_id: str, update: dict, conditions: dict = None):
+        """Apply an update document; returns the number of matched conversations"""
+        query = {"user_id": user_id, "conversation_id": conversation_id, **(conditions or {})}
+        result = await self.collection.update_one(query, update)
+        return result.matched_count
+
+    async def reserve_messages(self, user_id: str, conversation_id: str, count: int, fields: dict, session=None):
+        """Claim the next count positions and set fields; returns the first position, or None if
+        the conversation does not exist. Reserving first keeps seq ordered under concurrent appends;
+        it is dense unless a turn's positions are released after a later turn reserved its own."""
+        conversation = await self.collection.find_one_and_update(
+            {"user_id": user_id, "conversation_id": conversation_id},
+            {"$inc": {"message_count": count}, "$set": fields},
+            {"message_count": 1},
+            return_document=ReturnDocument.AFTER,
+            session=session
+        )
+        return conversation["message_count"] - count if conversation else None
+
+    async def append_messages(self, user_id: str, conversation_id: str, messages: list, fields: dict):
+        start = await self.reserve_messages(user_id, conversation_id, len(messages), fields)
+        if start is None:
+            return
+        try:
+            await self.messages.insert(user_id, conversation_id, start, messages)
+        except Exception:
+            await self.release_messages(user_id, conversation_id, start, len(messages))
+            raise
+
+    async def release_messages(self, user_id: str, conversation_id: str, start: int, count: int):
+        """Give back reserved positions whose messages could not be stored, unless another append
+        has taken the ones after them; then they stay a gap in seq (see MessageRepository.seq_at)"""
+        end = start + count
+        await self.messages.truncate(user_id, conversation_id, start, end)
+        await self.update(user_id, conversation_id, {"$inc": {"message_count": -count}}, {"message_count": end})
+
+    async def message_count(self, user_id: str, conversation_id: str, fields: dict = None):
+        """Number of messages (as "count") plus the requested top-level fields"""
+        conversation = await self.find(user_id, conversation_id, {**(fields or {}), "message_count": 1})
+        if conversation:
+            conversation["count"] = conversation.get("message_count", 0)
+        return conversation
+
+    async def truncate(self, user_id: str, conversation_id: str, start: int, update: dict = None):
+        """Drop the messages from position start on. Bumps summary_generation so a summary computed
+        from messages read before the truncation is not saved afterwards."""
+        await self.messages.truncate(user_id, conversation_id, start)
+        update = dict(update or {})
+        update["$set"] = {**update.get("$set", {}), "message_count": start}
+        update["$inc"] = {**update.get("$inc", {}), "summary_generation": 1}
+        await self.update(user_id, conversation_id, update)
+
+    async def without_alias(self, limit: int, exclude=()):
+        """Most recent conversations that have messages but no alias, with their first message"""
+        conversations = await self.collection.find(
+            {
+                "alias": {"$in": [None, ""]},
+                "message_count": {"$gt": 0},
+                "conversation_id": {"$nin": list(exclude)}
+            },
+            {"user_id": 1, "conversation_id": 1}
+        ).sort("created_at", -1).limit(limit).to_list(length=limit)
+        first = await self.messages.first([(doc["user_id"], doc["conversation_id"]) for doc in conversations])
+        for conversation in conversations:
+            conversation["first_message"] = first.get(conversation["conversation_id"])
+        return [conversation for conversation in conversations if conversation["first_message"]]
+
+    async def delete(self, user_id: str, conversation_id: str):
+        result = await self.collection.delete_one({"user_id": user_id, "conversation_id": conversation_id})
+        await self.messages.delete(user_id, conversation_id)
+        return result.deleted_count
+
+    async def delete_all(self, user_id: str):
+        result = await self.collection.delete_many({"user_id": user_id})
+        await self.messages.delete_all(user_id)
+        return result.deleted_count
+
+class UsageRepository:
+    """Append-only usage events (one per billed turn) and their per-user/model/day rollups"""
+
+    def __init__(self, events, daily, state):
+        self.events = events
+        self.daily = daily
+        self.state = state
+
+    async def insert_many(self, events: list, session=None):
+        # Events carry their own _id, so a retried write cannot record a turn twice
+        await insert_new(self.events, events, session)
+
+    async def first_event_time(self):
+        event = await self.events.find_one({}, {"created_at": 1}, sort=[("created_at", 1)])
+        return event["created_at"] if event else None
+
+    async def rolled_up_until(self):
+        state = await self.state.find_one({"_id": "daily"})
+        return state["until"] if state else None
+
+    async def rollup(self, since: datetime, until: datetime):
+        """Recompute the rollups of every UTC day from since's up to until; replacing whole days
+        keeps this idempotent, so overlapping or repeated runs never double count"""
+        day_start = since.replace(hour=0, minute=0, second=0, microsecond=0)
+        await self.events.aggregate([
+            {"$match": {"created_at": {"$gte": day_start, "$lt": until}}},
+            {"$group": {
+                "_id": {
+                    "day": {"$dateToString": {"format": "%Y-%m-%d", "date": "$created_at"}},
+                    "user_id": "$user_id",
+                    "model": "$model"
+                },
+                "requests": {"$sum": 1},
+                "input_tokens": {"$sum": "$input_tokens"},
+                "output_tokens": {"$sum": "$output_tokens"},
+                "reasoning_tokens": {"$sum": "$reasoning_tokens"},
+                "cost": {"$sum": "$cost"}
+            }},
+            {"$project": {
+                "_id": 0, "day": "$_id.day", "user_id": "$_id.user_id", "model": "$_id.model",
+                "requests": 1, "input_tokens": 1, "output_tokens": 1, "reasoning_tokens": 1, "cost": 1
+            }},
+            {"$merge": {"into": self.daily.name, "on": ["day", "user_id", "model"], "whenMatched": "replace", "whenNotMatched": "insert"}}
+        ]).to_list(length=None)
+        await self.state.update_one({"_id": "daily"}, {"$set": {"until": until}}, upsert=True)
+
+    async def report(self, start: str, end: str, group_by: list, user_id: str = None, model: str = None):
+        """Totals per group_by key (any of day, user_id, model) over the days start..end, from the rollups"""
+        query = {"day": {"$gte": start, "$lte": end}}
+        if user_id:
+            query["user_id"] = user_id
+        if model:
+            query["model"] = model
+        return await self.daily.aggregate([
+            {"$match": query},
+            {"$group": {
+                "_id": {key: f"${key}" for key in group_by},
+                "requests": {"$sum": "$requests"},
+                "input_tokens": {"$sum": "$input_tokens"},
+                "output_tokens": {"$sum": "$output_tokens"},
+                "reasoning_tokens": {"$sum": "$reasoning_tokens"},
+                "cost": {"$sum": "$cost"}
+            }},
+            {"$replaceWith": {"$mergeObjects": ["$_id", {
+                "requests": "$requests", "input_tokens": "$input_tokens", "output_tokens": "$output_tokens",
+                "reasoning_tokens": "$reasoning_tokens", "cost": "$cost"
+            }]}},
+            {"$sort": {key: 1 for key in group_by}}
+        ]).to_list(length=None)
+
+class LeaseRepository:
+    """Named, expiring leases so a periodic job runs in one process at a time across uvicorn
+    workers and hosts; the holder renews its lease on every run and loses it once it stops"""
+
+    def __init__(self, collection):
+        self.collection = collection
+
+    async def acquire(self, name: str, owner: str, seconds: float):
+        """Take or renew the lease; False while another owner holds an unexpired one"""
+        now = datetime.now(timezone.utc)
+        try:
+            await self.collection.update_one(
+                {"_id": name, "$or": [{"owner": owner}, {"expires_at": {"$lt": now}}]},
+                {"$set": {"owner": owner, "expires_at": now + timedelta(seconds=seconds)}},
+                upsert=True
+            )
+        except DuplicateKeyError:
+            # Held by someone else: the filter missed and the upsert collided with their document
+            return False
+        return True
+
+users = UserRepository(db.users)
+messages = MessageRepository(db.messages)
+conversations = ConversationRepository(db.conversations, messages)
+usage = UsageRepository(db.usage_events, db.usage_daily, db.usage_rollup_state)
+leases = LeaseRepository(db.leases)
@@ -1,23 +1,20 @@
 import os
 import jwt
-import bcrypt
 # from dotenv import load_dotenv
-from pymongo import MongoClient
-from fastapi import APIRouter, HTTPException, Cookie, Depends, Query, status
+from fastapi import APIRouter, HTTPException, Depends, Query, Request, status
 from fastapi.responses import JSONResponse
 from pydantic import BaseModel, EmailStr, constr
-from typing import List, Annotated
+from typing import Annotated
 from bson import ObjectId
 from datetime import datetime, timezone, timedelta
 from jwt.exceptions import ExpiredSignatureError, InvalidTokenError
+import repositories
+from password_hasher import hasher, HasherBusy
+from pagination import InvalidCursor
 
 # load_dotenv()
 router = APIRouter()
 
-mongo_client = MongoClient(os.getenv('MONGODB_URI'))
-db = mongo_client.chat_db
-collection = db.users
-
 AUTH_KEY = os.getenv('AUTH_KEY')
 ALGORITHM = 'HS256'
 
@@ -39,34 +36,54 @@ class User(BaseModel):
     trial: bool
     trial_remaining: int = 0
 
-def hash_password(password: str) -> str:
-    return bcrypt.hashpw(password.encode(), bcrypt.gensalt()).decode()
+# Everything user_from_document reads, and nothing else
+USER_FIELDS = {"name": 1, "email": 1, "billing": 1, "admin": 1, "trial": 1, "trial_remaining": 1}
 
-def verify_password(plain_password: str, hashed_password: str) -> bool:
-    return bcrypt.checkpw(plain_password.encode(), hashed_password.encode())
+def user_from_document(db_user: dict) -> User:
+    return User(
+        user_id=str(db_user["_id"]),
+        name=db_user["name"],
+        email=db_user["email"],
+        billing=db_user["billing"],
+        admin=db_user["admin"],
+        trial=db_user["trial"],
+        trial_remaining=db_user["trial_remaining"]
+    )
+
+async def hash_password(password: str) -> str:
+    try:
+        return await hasher.hash(password)
+    except HasherBusy:
+        raise HTTPException(status_code=503, detail="요청이 많습니다. 잠시 후 다시 시도해 주세요.", headers={"Retry-After": "1"})
+
+async def verify_password(plain_password: str, hashed_password: str) -> bool:
+    try:
+        return await hasher.verify(plain_password, hashed_password)
+    except HasherBusy:
+        raise HTTPException(status_code=503, detail="요청이 많습니다. 잠시 후 다시 시도해 주세요.", headers={"Retry-After": "1"})
 
 @router.post("/register")
 async def register(user: RegisterUser):
-    if collection.find_one({"email": user.email}):
+    if await repositories.users.find_by_email(user.email, {"_id": 1}):
         raise HTTPException(status_code=400, detail="이미 존재하는 사용자입니다.")
     
     new_user = {
         "name": user.name,
         "email": user.email,
-        "password": hash_password(user.password),
+        "password": await hash_password(user.password),
         "billing": 0.0,
         "admin": False,
         "trial": True,
         "trial_remaining": 10,
         "created_at": datetime.now(timezone.utc)
     }
-    result = collection.insert_one(new_user)
-    return {"message": "Registration Success!", "user_id": str(result.inserted_id)}
+    user_id = await repositories.users.insert(new_user)
+    return {"message": "Registration Success!", "user_id": user_id}
 
 @router.post("/login")
 async def login(user: LoginUser):
-    db_user = collection.find_one({"email": user.email})
-    if not db_user or not verify_password(user.password, db_user["password"]):
+    db_user = await repositories.users.find_by_email(user.email)
+    if not db_user or not await verify_password(user.password, db_user["password"]):
         raise HTTPException(status_code=401, detail="이메일 또는 비밀번호 오류입니다.")
     
     token = jwt.encode(
@@ -100,99 +117,60 @@ async def logout():
     response.delete_cookie("access_token")
     return response
 
+def decode_token(access_token: str):
+    try:
+        return jwt.decode(access_token, AUTH_KEY, algorithms=[ALGORITHM])
+    except (ExpiredSignatureError, InvalidTokenError):
+        return None
+
+def token_payload(request: Request):
+    """Payload of the access_token cookie (None if missing or invalid), decoded once per request
+    and shared by LoggingMiddleware and the auth dependencies through request.state"""
+    if not hasattr(request.state, "auth_payload"):
+        access_token = request.cookies.get("access_token")
+        request.state.auth_payload = decode_token(access_token) if access_token else None
+    return request.state.auth_payload
+
 @router.get("/auth/status")
-async def get_auth_status(access_token: str = Cookie(None)):
-    if not access_token:
+async def get_auth_status(request: Request):
+    if not request.cookies.get("access_token"):
         return {"logged_in": False}
     
-    try:
-        payload = jwt.decode(access_token, AUTH_KEY, algorithms=[ALGORITHM])
-        return {
-            "logged_in": True,
-            "user_id": payload["user_id"],
-            "name": payload["name"],
-            "email": payload["email"]
-        }
-    except (ExpiredSignatureError, InvalidTokenError):
+    payload = token_payload(request)
+    if not payload:
         response = JSONResponse(
             content={"logged_in": False, "error": "Invalid or expired token"},
             headers={"set-cookie": "access_token=; expires=Thu, 01 Jan 1970 00:00:00 GMT; HttpOnly; SameSite=Lax; Path=/"}
         )
         return response
+    return {
+        "logged_in": True,
+        "user_id": payload["user_id"],
+        "name": payload["name"],
+        "email": payload["email"]
+    }
 
-@router.get("/auth/user")
-async def get_current_user(access_token: str = Cookie(None)) -> User:
-    if not access_token:
-        raise HTTPException(
-            status_code=status.HTTP_401_UNAUTHORIZED,
-            detail="Not authenticated",
-            headers={"set-cookie": "access_token=; expires=Thu, 01 Jan 1970 00:00:00 GMT; HttpOnly; SameSite=Lax; Path=/"}
-        )
+async def authenticated_user(request: Request, clear_cookie: bool):
+    """Cached user document for the request's token, or the matching 401"""
+    headers = {"set-cookie": "access_token=; expires=Thu, 01 Jan 1970 00:00:00 GMT; HttpOnly; SameSite=Lax; Path=/"} if clear_cookie else None
+    if not request.cookies.get("access_token"):
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Not authenticated", headers=headers)
     
-    try:
-        payload = jwt.decode(access_token, AUTH_KEY, algorithms=[ALGORITHM])
-        user_id = payload.get("user_id")
-    except (ExpiredSignatureError, InvalidTokenError):
-        raise HTTPException(
-            status_code=status.HTTP_401_UNAUTHORIZED,
-            detail="Invalid token",
-            headers={"set-cookie": "access_token=; expires=Thu, 01 Jan 1970 00:00:00 GMT; HttpOnly; SameSite=Lax; Path=/"}
-        )
+    payload = token_payload(request)
+    if not payload:
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid token", headers=headers)
     
-    db_user = collection.find_one({"_id": ObjectId(user_id)})
+    db_user = await repositories.users.find_cached(payload.get("user_id"))
     if not db_user:
-        raise HTTPException(
-            status_code=status.HTTP_401_UNAUTHORIZED,
-            detail="User not found",
-            headers={"set-cookie": "access_token=; expires=Thu, 01 Jan 1970 00:00:00 GMT; HttpOnly; SameSite=Lax; Path=/"}
-        )
-    
-    return User(
-        user_id=str(db_user["_id"]),
-        name=db_user["name"],
-        email=db_user["email"],
-        billing=db_user["billing"],
-        admin=db_user["admin"],
-        trial=db_user["trial"],
-        trial_remaining=db_user["trial_remaining"]
-    )
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="User not found", headers=headers)
+    return db_user
 
-def decode_user_token(access_token: str):
-    if not access_token:
-        return None
-    
-    try:
-        payload = jwt.decode(access_token, AUTH_KEY, algorithms=[ALGORITHM])
-        return {
-            "name": payload.get("name"),
-            "user_id": payload.get("user_id")
-        }
-    except (ExpiredSignatureError, InvalidTokenError, Exception):
-        return None
+@router.get("/auth/user")
+async def get_current_user(request: Request) -> User:
+    return user_from_document(await authenticated_user(request, clear_cookie=True))
 
-async def check_admin(access_token: str = Cookie(None)):
-    if not access_token:
-        raise HTTPException(
-            status_code=status.HTTP_401_UNAUTHORIZED,
-            detail="Not authenticated"
-        )
-    
-    try:
-        payload = jwt.decode(access_token, AUTH_KEY, algorithms=[ALGORITHM])
-        user_id = payload.get("user_id")
-    except (ExpiredSignatureError, InvalidTokenError):
-        raise HTTPException(
-            status_code=status.HTTP_401_UNAUTHORIZED,
-            detail="Invalid token"
-        )
-    
-    db_user = collection.find_one({"_id": ObjectId(user_id)})
-    if not db_user:
-        raise HTTPException(
-            status_code=status.HTTP_401_UNAUTHORIZED,
-            detail="User not found"
-        )
-    
+async def check_admin(request: Request):
+    db_user = await authenticated_user(request, clear_cookie=False)
     if not db_user.get("admin", False):
         raise HTTPException(
             status_code=status.HTTP_403_FORBIDDEN,
@@ -201,27 +179,17 @@ async def check_admin(access_token: str = Cookie(None)):
     
     return db_user
 
-@router.get("/users", response_model=List[User])
+@router.get("/users", response_model=dict)
 async def get_all_users(
-    skip: int = Query(0, ge=0),
     limit: int = Query(100, ge=1, le=1000),
+    cursor: str = None,
     _ = Depends(check_admin)
 ):
-    users = []
-    cursor = collection.find({}).skip(skip).limit(limit)
-    
-    for user in cursor:
-        users.append(User(
-            user_id=str(user["_id"]),
-            name=user["name"],
-            email=user["email"],
-            billing=user["billing"],
-            admin=user["admin"],
-            trial=user["trial"],
-            trial_remaining=user["trial_remaining"]
-        ))
-    
-    return users
+    try:
+        db_users, next_cursor = await repositories.users.list(limit, USER_FIELDS, cursor)
+    except InvalidCursor:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    return {"users": [user_from_document(user) for user in db_users], "next_cursor": next_cursor}
 
 @router.patch("/users/{user_id}")
 async def update_user_status(
@@ -233,31 +201,22 @@ async def update_user_status(
         if not ObjectId.is_valid(user_id):
             raise HTTPException(status_code=400, detail="Invalid User ID")
             
-        user = collection.find_one({"_id": ObjectId(user_id)})
-        if not user:
-            raise HTTPException(status_code=404, detail="User not found")
-            
         update_data = {
             "trial": user_data["trial"],
             "trial_remaining": 10 if user_data["trial"] else 0
         }
         
-        collection.update_one(
-            {"_id": ObjectId(user_id)},
-            {"$set": update_data}
-        )
-        
-        updated_user = collection.find_one({"_id": ObjectId(user_id)})
+        updated_user = await repositories.users.update(user_id, update_data)
+        if not updated_user:
+            raise HTTPException(status_code=404, detail="User not found")
         
-        return User(
-            user_id=str(updated_user["_id"]),
-            name=updated_user["name"],
-            email=updated_user["email"],
-            billing=updated_user["billing"],
-            admin=updated_user["admin"],
-            trial=updated_user["trial"],
-            trial_remaining=updated_user["trial_remaining"]
-        )
+        return user_from_document(updated_user)
         
+    except HTTPException:
+        raise
     except Exception as ex:
-        raise HTTPException(status_code=500, detail=f"Error occured: {str(ex)}")
\ No newline at end of file
+        raise HTTPException(status_code=500, detail=f"Error occured: {str(ex)}")
+
+@router.get("/auth/hashing")
+async def get_password_hashing_stats(_ = Depends(check_admin)):
+    return hasher.stats()
@@ -3,76 +3,56 @@ import json
 import asyncio
 import base64
 import copy
+import threading
 from typing import Optional, Dict, Any, List
 from fastapi import Depends, Request, HTTPException
 from fastapi.responses import StreamingResponse
-from transformers import AutoTokenizer, AutoModelForCausalLM
-import torch
 from ..auth import User, get_current_user
 from ..common import (
     ChatRequest, router,
-    DEFAULT_PROMPT, DAN_PROMPT,
+    DEFAULT_PROMPT, DAN_PROMPT, SUMMARY_PROMPT, ALIAS_PROMPT,
     check_user_permissions,
-    get_conversation, save_conversation,
-    normalize_assistant_content,
+    get_conversation_context, save_conversation,
+    get_messages_to_summarize, save_summary,
+    get_conversations_without_alias, save_alias, hold_lease,
+    normalize_assistant_content, prepare_message, upload_path,
     ApiSettings
 )
 from logging_util import logger
+from document_index import search as search_document
+from model_registry import ModelRegistry, DEFAULT_MODEL
+from medgemma_engine import GenerationPreempted
+from inference_client import InferenceClient, InferenceError
 from dotenv import load_dotenv
 load_dotenv()
 
-# Global variables for model and tokenizer
-model = None
-tokenizer = None
-model_loaded = False
+# Directory of memory-mapped weights files shared by all uvicorn workers (disabled when unset)
+SHARED_WEIGHTS_DIR = os.getenv('MEDGEMMA_SHARED_WEIGHTS')
 
-def load_medgemma_model():
-    """Load MedGemma 4B model and tokenizer"""
-    global model, tokenizer, model_loaded
-    
-    if model_loaded:
-        return
-    
+# Socket of inference_server.py; when set, the models live in that process instead of this one
+INFERENCE_SOCKET = os.getenv('MEDGEMMA_SOCKET')
+
+# Background title generation for conversations without an alias
+ALIAS_GENERATION = os.getenv('ALIAS_GENERATION', '1') != '0'
+ALIAS_INTERVAL_SECONDS = float(os.getenv('ALIAS_INTERVAL_SECONDS', '30'))
+ALIAS_BATCH_SIZE = int(os.getenv('ALIAS_BATCH_SIZE', '8'))
+# Only one process titles conversations at a time; a holder that stops running loses it after this
+ALIAS_LEASE_SECONDS = ALIAS_INTERVAL_SECONDS * 3
+
+registry = ModelRegistry(shared_weights_dir=SHARED_WEIGHTS_DIR)
+inference_client = InferenceClient(INFERENCE_SOCKET) if INFERENCE_SOCKET else None
+
+async def load_medgemma_model(model_name: str):
+    """Load the requested local model into this process (or reuse it if resident)"""
     try:
-        logger.info("Loading MedGemma 4B model...")
-        
-        # MedGemma 4B model from Hugging Face
-        model_name = "google/medgemma-4b-it"
-        
-        # Get Hugging Face access token from environment
-        hf_token = os.getenv('HUGGINGFACE_TOKEN')
-        if not hf_token:
-            logger.error("HUGGINGFACE_TOKEN environment variable not set")
-            raise HTTPException(
-                status_code=500, 
-                detail="Hugging Face access token not configured. Please set HUGGINGFACE_TOKEN environment variable."
-            )
-        
-        # Load tokenizer with access token
-        tokenizer = AutoTokenizer.from_pretrained(
-            model_name, 
-            trust_remote_code=True,
-            token=hf_token
-        )
-        if tokenizer.pad_token is None:
-            tokenizer.pad_token = tokenizer.eos_token
-        
-        # Load model with quantization for memory efficiency
-        model = AutoModelForCausalLM.from_pretrained(
-            model_name,
-            torch_dtype=torch.float16,
-            device_map="auto",
-            trust_remote_code=True,
-            load_in_8bit=True,  # Use 8-bit quantization to reduce memory usage
-            token=hf_token
-        )
-        
-        model_loaded = True
-        logger.info("MedGemma 4B model loaded successfully")
-        
+        return await asyncio.to_thread(registry.acquire, model_name)
+    except KeyError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
         logger.error(f"Error loading MedGemma model: {str(e)}")
-        if "401" in str(e) or "unauthorized" in str(e).lower():
+        if "HUGGINGFACE_TOKEN" in str(e):
+            raise HTTPException(status_code=500, detail=str(e))
+        elif "401" in str(e) or "unauthorized" in str(e).lower():
             raise HTTPException(
                 status_code=401, 
                 detail="Invalid Hugging Face access token. Please check your HUGGINGFACE_TOKEN environment variable."
@@ -85,8 +65,8 @@ def load_medgemma_model():
         else:
             raise HTTPException(status_code=500, detail=f"Failed to load MedGemma model: {str(e)}")
 
-def normalize_user_content(part):
-    """Normalize user content for MedGemma input"""
+def normalize_user_content(part, query: str = None):
+    """Resolve a prepared user part for MedGemma input; indexed documents contribute only the chunks relevant to query"""
     if part.get("type") == "url":
         return {
             "type": "text",
@@ -95,9 +75,15 @@ def normalize_user_content(part):
     elif part.get("type") == "file":
         file_path = part.get("content")
         try:
-            abs_path = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "..", file_path.lstrip("/")))
-            with open(abs_path, "r", encoding="utf-8") as f:
-                file_content = f.read()
+            abs_path = upload_path(file_path)
+            try:
+                file_content = search_document(abs_path, query)
+            except Exception as ex:
+                logger.error(f"DOCUMENT_SEARCH_ERROR: {str(ex)}")
+                file_content = None
+            if file_content is None:
+                with open(abs_path, "r", encoding="utf-8") as f:
+                    file_content = f.read()
             return {
                 "type": "text",
                 "text": file_content
@@ -106,123 +92,195 @@ def normalize_user_content(part):
             logger.error(f"FILE_PROCESS_ERROR: {str(ex)}")
             return None
     elif part.get("type") == "image":
-        # MedGemma supports images, but for now we'll convert to text description
+        # Decoding and pixel preprocessing happen in the engine's preprocessing pool
         file_path = part.get("content")
         try:
-            abs_path = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "..", file_path.lstrip("/")))
+            abs_path = upload_path(file_path)
+            if not os.path.isfile(abs_path):
+                raise FileNotFoundError(abs_path)
             return {
-                "type": "text",
-                "text": f"[Image file: {os.path.basename(file_path)}]"
+                "type": "image",
+                "path": abs_path
             }
         except Exception as ex:
             logger.error(f"IMAGE_PROCESS_ERROR: {str(ex)}")
             return None
     return part
 
-def format_message(message):
-    """Format message for MedGemma input"""
+def format_message(message, query: str = None):
+    """Format a prepared message (see common.prepare_message) for MedGemma input; only the
+    per-turn work is left: documents (searched for query if indexed, inlined otherwise) and
+    image path checks"""
     role = message.get("role")
     content = message.get("content")
     
     if role == "user":
-        return {"role": "user", "content": [item for item in [normalize_user_content(part) for part in content] if item is not None]}
-    elif role == "assistant":
-        return {"role": "assistant", "content": normalize_assistant_content(content)}
+        return {"role": "user", "content": [item for item in [normalize_user_content(part, query) for part in content] if item is not None]}
     return message
 
-def create_prompt(messages, system_message=None):
-    """Create prompt for MedGemma model"""
-    prompt = ""
-    
-    # Add system message if provided
-    if system_message:
-        prompt += f"<|im_start|>system\n{system_message}<|im_end|>\n"
-    
-    # Add conversation messages
-    for message in messages:
-        role = message.get("role")
-        content = message.get("content")
-        
-        if role == "user":
-            # Extract text content from user message
-            if isinstance(content, list):
-                text_parts = []
-                for part in content:
-                    if part.get("type") == "text":
-                        text_parts.append(part.get("text", ""))
-                user_text = " ".join(text_parts)
-            else:
-                user_text = str(content)
-            prompt += f"<|im_start|>user\n{user_text}<|im_end|>\n"
-        elif role == "assistant":
-            prompt += f"<|im_start|>assistant\n{content}<|im_end|>\n"
-    
-    # Add assistant start token
-    prompt += "<|im_start|>assistant\n"
+async def generate_medgemma(parameters, cancel_event: threading.Event):
+    """Stream text chunks and a final token_usage dict from the sidecar or the in-process engine"""
+    if inference_client:
+        async for chunk in inference_client.generate(
+            parameters["messages"],
+            parameters["system_message"],
+            temperature=parameters["temperature"],
+            max_new_tokens=parameters["max_new_tokens"],
+            model=parameters["model"],
+            background=parameters.get("background", False)
+        ):
+            yield chunk
+        return
     
-    return prompt
+    engine = await load_medgemma_model(parameters["model"])
+    try:
+        async for chunk in engine.agenerate(
+            parameters["messages"],
+            parameters["system_message"],
+            temperature=parameters["temperature"],
+            max_new_tokens=parameters["max_new_tokens"],
+            adapter=registry.adapter_name(parameters["model"]),
+            cancel_event=cancel_event,
+            background=parameters.get("background", False)
+        ):
+            yield chunk
+    finally:
+        registry.release(parameters["model"])
 
 async def process_stream(chunk_queue: asyncio.Queue, request, parameters, fastapi_request: Request):
     """Process streaming response from MedGemma"""
+    cancel_event = threading.Event()
+    stream = None
     try:
-        # Load model if not already loaded
-        if not model_loaded:
-            load_medgemma_model()
-        
-        # Create prompt
-        messages = parameters.get("messages", [])
-        system_message = parameters.get("system_message", DEFAULT_PROMPT)
-        prompt = create_prompt(messages, system_message)
-        
-        # Tokenize input
-        inputs = tokenizer(prompt, return_tensors="pt", truncation=True, max_length=2048)
-        
-        # Generate response with streaming
-        generated_tokens = 0
-        max_new_tokens = parameters.get("max_new_tokens", 512)
-        
-        with torch.no_grad():
-            for i in range(max_new_tokens):
-                if await fastapi_request.is_disconnected():
-                    return
-                
-                # Generate next token
-                outputs = model.generate(
-                    **inputs,
-                    max_new_tokens=1,
-                    do_sample=True,
-                    temperature=parameters.get("temperature", 0.7),
-                    pad_token_id=tokenizer.eos_token_id,
-                    use_cache=True
-                )
-                
-                # Get the new token
-                new_token = outputs[0][-1].unsqueeze(0)
-                
-                # Decode the token
-                new_text = tokenizer.decode(new_token, skip_special_tokens=True)
-                
-                # Check for end of response
-                if new_text.strip() == "" or "<|im_end|>" in new_text:
-                    break
-                
-                # Send the token
-                await chunk_queue.put(new_text)
-                generated_tokens += 1
-                
-                # Update inputs for next iteration
-                inputs = {"input_ids": torch.cat([inputs["input_ids"], new_token], dim=1)}
-        
-        # Send token usage
-        await chunk_queue.put({
-            "type": "token_usage",
-            "input_tokens": len(tokenizer.encode(prompt)),
-            "output_tokens": generated_tokens
-        })
+        stream = generate_medgemma(parameters, cancel_event)
+        async for chunk in stream:
+            if await fastapi_request.is_disconnected():
+                cancel_event.set()
+                return
+            await chunk_queue.put(chunk)
         
     except Exception as e:
         logger.error(f"Error in MedGemma streaming: {str(e)}")
         await chunk_queue.put(f"Error: {str(e)}")
+    finally:
+        if stream is not None:
+            await stream.aclose()
+
+# Conversations with a summary update in flight, and references keeping background tasks alive
+summarizing = set()
+background_tasks = set()
+
+def is_preempted(ex: Exception):
+    """Background generations give way to interactive ones; they are simply retried later"""
+    return isinstance(ex, GenerationPreempted) or (isinstance(ex, InferenceError) and str(ex).startswith("Preempted"))
+
+def run_in_background(coro):
+    task = asyncio.create_task(coro)
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+
+def summary_transcript(messages):
+    lines = []
+    for message in messages:
+        content = message.get("content")
+        if message.get("role") == "user" and isinstance(content, list):
+            text = " ".join(
+                part.get("text", "") if part.get("type") == "text" else f"[{part.get('type')}]"
+                for part in content
+            )
+        else:
+            text = normalize_assistant_content(content or "")
+        lines.append(f"{message.get('role')}: {text}")
+    return "\n\n".join(lines)
+
+async def update_summary(user: User, model_name: str, conversation_id: str):
+    """Fold the turns that left the recent window into the conversation's running summary"""
+    key = (user.user_id, conversation_id)
+    if key in summarizing:
+        return
+    summarizing.add(key)
+    try:
+        summary, summary_upto, generation, messages = await get_messages_to_summarize(user, conversation_id)
+        if not messages:
+            return
+
+        prompt = (f"Current summary:\n{summary}\n\n" if summary else "") + f"New messages:\n{summary_transcript(messages)}"
+        parameters = {
+            "model": model_name,
+            "messages": [{"role": "user", "content": prompt}],
+            "system_message": SUMMARY_PROMPT,
+            "temperature": 0.0,
+            "max_new_tokens": 320,
+            "background": True
+        }
+        text = ""
+        async for chunk in generate_medgemma(parameters, threading.Event()):
+            if isinstance(chunk, str):
+                text += chunk
+        if text.strip():
+            await save_summary(user, conversation_id, text.strip(), summary_upto, summary_upto + len(messages), generation)
+    except Exception as ex:
+        if not is_preempted(ex):
+            logger.error(f"SUMMARY_ERROR: {str(ex)}")
+    finally:
+        summarizing.discard(key)
+
+# Conversations whose title could not be generated; not retried until restart
+alias_failures = set()
+
+def clean_alias(text: str):
+    alias = text.strip().split("\n")[0].strip().strip("\"'`*#.,!?。")
+    return alias[:50]
+
+async def generate_alias(conversation):
+    first_message = conversation["first_message"]
+    parameters = {
+        "model": DEFAULT_MODEL,
+        "messages": [{"role": "user", "content": summary_transcript([first_message]).split(": ", 1)[-1][:2000]}],
+        "system_message": ALIAS_PROMPT,
+        "temperature": 0.0,
+        "max_new_tokens": 24,
+        "background": True
+    }
+    text = ""
+    async for chunk in generate_medgemma(parameters, threading.Event()):
+        if isinstance(chunk, str):
+            text += chunk
+    return clean_alias(text)
+
+async def alias_worker():
+    """Title conversations that lack an alias, a batch at a time, at background priority so
+    interactive generations are never delayed. Every worker runs it, but only the one holding
+    the alias lease does any work, so conversations are not titled once per process."""
+    while True:
+        await asyncio.sleep(ALIAS_INTERVAL_SECONDS)
+        try:
+            # Never load a model just to write titles; a worker without it leaves the lease to one that has it
+            if inference_client is None and not registry.resident(DEFAULT_MODEL):
+                continue
+            if not await hold_lease("alias_worker", ALIAS_LEASE_SECONDS):
+                continue
+            conversations = await get_conversations_without_alias(ALIAS_BATCH_SIZE, alias_failures)
+            if not conversations:
+                continue
+
+            aliases = await asyncio.gather(*(generate_alias(conversation) for conversation in conversations), return_exceptions=True)
+            for conversation, alias in zip(conversations, aliases):
+                if isinstance(alias, Exception) and is_preempted(alias):
+                    continue
+                if isinstance(alias, Exception) or not alias:
+                    logger.error(f"ALIAS_ERROR: {conversation['conversation_id']}: {str(alias)}")
+                    alias_failures.add(conversation["conversation_id"])
+                    continue
+                # save_alias only needs the owner's id
+                owner = User.model_construct(user_id=conversation["user_id"])
+                await save_alias(owner, conversation["conversation_id"], alias, True)
+        except Exception as ex:
+            logger.error(f"ALIAS_WORKER_ERROR: {str(ex)}")
+
+def start_background_jobs():
+    if ALIAS_GENERATION:
+        run_in_background(alias_worker())
 
 @router.post("/medgemma")
 async def chat_with_medgemma(
@@ -237,23 +295,25 @@ async def chat_with_medgemma(
     if error_message:
         raise HTTPException(status_code=400, detail=error_message)
     
-    # Get conversation history
-    conversation = get_conversation(user, request.conversation_id)
-    
-    # Prepare messages
-    messages = []
-    
-    # Add conversation history
-    for msg in conversation:
-        messages.append(format_message(msg))
+    # Get conversation history: running summary of older turns plus the most recent messages
+    summary, conversation = await get_conversation_context(user, request.conversation_id)
     
-    # Add current user message
-    messages.append(format_message({"role": "user", "content": request.user_message}))
+    # Prepare messages: history plus the current user message. Uploaded documents are searched
+    # with the current question (embedding runs off the event loop)
+    query = " ".join(part.get("text", "") for part in request.user_message if part.get("type") == "text").strip()
+    messages = await asyncio.to_thread(
+        lambda: [format_message(msg, query) for msg in conversation + [prepare_message({"role": "user", "content": request.user_message})]]
+    )
     
+    system_message = request.system_message or DEFAULT_PROMPT
+    if summary:
+        system_message += f"\n\nSummary of the earlier conversation:\n{summary}"
+
     # Prepare parameters
     parameters = {
+        "model": request.model,
         "messages": messages,
-        "system_message": request.system_message or DEFAULT_PROMPT,
+        "system_message": system_message,
         "temperature": request.temperature,
         "max_new_tokens": 512,
         "stream": request.stream
@@ -274,11 +334,12 @@ async def chat_with_medgemma(
                     chunk = await asyncio.wait_for(chunk_queue.get(), timeout=30.0)
                     
                     if isinstance(chunk, dict) and chunk.get("type") == "token_usage":
-                        # Save conversation with token usage
-                        save_conversation(
+                        # Reserve and queue the turn; [DONE] does not wait for the messages to be written
+                        await save_conversation(
                             user, request.user_message, response_text,
                             chunk, request, in_billing, out_billing
                         )
+                        run_in_background(update_summary(user, request.model, request.conversation_id))
                         break
                     else:
                         response_text += str(chunk)
@@ -300,45 +361,28 @@ async def chat_with_medgemma(
     else:
         # Non-streaming response
         try:
-            # Load model if not already loaded
-            if not model_loaded:
-                load_medgemma_model()
-            
-            # Create prompt
-            prompt = create_prompt(messages, parameters["system_message"])
-            
-            # Tokenize input
-            inputs = tokenizer(prompt, return_tensors="pt", truncation=True, max_length=2048)
-            
-            # Generate response
-            with torch.no_grad():
-                outputs = model.generate(
-                    **inputs,
-                    max_new_tokens=parameters["max_new_tokens"],
-                    do_sample=True,
-                    temperature=parameters["temperature"],
-                    pad_token_id=tokenizer.eos_token_id
-                )
-            
-            # Decode response
-            response_text = tokenizer.decode(outputs[0][inputs["input_ids"].shape[1]:], skip_special_tokens=True)
-            
-            # Calculate token usage
-            input_tokens = len(tokenizer.encode(prompt))
-            output_tokens = len(tokenizer.encode(response_text))
-            token_usage = {
-                "input_tokens": input_tokens,
-                "output_tokens": output_tokens
-            }
+            response_text = ""
+            token_usage = None
+            async for chunk in generate_medgemma(parameters, threading.Event()):
+                if isinstance(chunk, dict):
+                    token_usage = {
+                        "input_tokens": chunk["input_tokens"],
+                        "output_tokens": chunk["output_tokens"]
+                    }
+                else:
+                    response_text += chunk
             
             # Save conversation
-            save_conversation(user, request.user_message, response_text, token_usage, request, in_billing, out_billing)
+            await save_conversation(user, request.user_message, response_text, token_usage, request, in_billing, out_billing)
+            run_in_background(update_summary(user, request.model, request.conversation_id))
             
             return {
                 "content": response_text,
                 "token_usage": token_usage
             }
             
+        except HTTPException:
+            raise
         except Exception as e:
             logger.error(f"Error in MedGemma chat: {str(e)}")
             raise HTTPException(status_code=500, detail=f"Error generating response: {str(e)}") 
\ No newline at end of file
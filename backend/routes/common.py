@@ -1,14 +1,18 @@
 import os
 import re
 import json
+import socket
+import asyncio
 from dotenv import load_dotenv
-from pymongo import MongoClient
 from fastapi import APIRouter
 from pydantic import BaseModel
-from bson import ObjectId
 from typing import Any, List, Dict, Optional
 from .auth import User
 from logging_util import logger
+import repositories
+from write_behind import write_behind, PendingTurn
+from usage_ledger import usage_event
+from config_registry import models_config
 
 class ChatRequest(BaseModel):
     conversation_id: str
@@ -39,11 +43,6 @@ class ApiSettings(BaseModel):
 load_dotenv()
 router = APIRouter()
 
-mongo_client = MongoClient(os.getenv('MONGODB_URI'))
-db = mongo_client.chat_db
-user_collection = db.users
-conversation_collection = db.conversations
-
 default_prompt_path = os.path.join(os.path.dirname(__file__), '..', 'prompts', 'default_prompt.txt')
 try:
     with open(default_prompt_path, 'r', encoding='utf-8') as f:
@@ -65,6 +64,23 @@ try:
 except FileNotFoundError:
     ALIAS_PROMPT = ""
 
+summary_prompt_path = os.path.join(os.path.dirname(__file__), '..', 'prompts', 'summary_prompt.txt')
+try:
+    with open(summary_prompt_path, 'r', encoding='utf-8') as f:
+        SUMMARY_PROMPT = f.read()
+except FileNotFoundError:
+    SUMMARY_PROMPT = ""
+
+# Version of prepare_message's output stored with each message; bump it whenever prepare_message
+# changes and run backfill_prepared_messages.py to bring stored messages up to date
+PREPARED_VERSION = 2
+BACKEND_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+
+# Messages always sent verbatim with each prompt; older ones are folded into the conversation's running summary
+RECENT_MESSAGES = int(os.getenv('CONVERSATION_RECENT_MESSAGES', '6'))
+# Most messages folded into the summary per update, so a long backlog is caught up in steps
+SUMMARY_BATCH_MESSAGES = 20
+
 def check_user_permissions(user: User, request: ChatRequest):
     billing_result = get_model_billing(request.model)
     if not billing_result:
@@ -82,14 +98,59 @@ def check_user_permissions(user: User, request: ChatRequest):
         return "메시지 내용이 비어 있습니다. 내용을 입력해 주세요.", None, None
     return None, in_billing, out_billing
 
-def get_conversation(user: User, conversation_id: str):
-    conversation = conversation_collection.find_one(
-        {"user_id": user.user_id, "conversation_id": conversation_id},
-        {"conversation": {"$slice": -6}}
+async def get_conversation_context(user: User, conversation_id: str):
+    """Running summary of older turns (None until there is one) and the messages it does not cover
+    yet, at least the last RECENT_MESSAGES and at most RECENT_MESSAGES + SUMMARY_BATCH_MESSAGES, in
+    their model-ready form (see prepare_message)"""
+    await write_behind.settled(user.user_id, conversation_id)
+    state = await repositories.conversations.message_count(user.user_id, conversation_id, {"summary": 1, "summary_upto": 1})
+    if not state:
+        return None, []
+    summary = state.get("summary")
+    # The summary lags behind the recent window while it catches up (one batch per turn); anything
+    # older than one batch past the window is dropped until then, so the prompt stays bounded
+    start = max(
+        min(state.get("summary_upto", 0) if summary else 0, max(0, state["count"] - RECENT_MESSAGES)),
+        state["count"] - RECENT_MESSAGES - SUMMARY_BATCH_MESSAGES,
+        0
+    )
+    documents = await repositories.messages.since(user.user_id, conversation_id, start)
+    return summary, [model_message(document) for document in documents]
+
+async def get_messages_to_summarize(user: User, conversation_id: str):
+    """(summary, summary_upto, summary_generation, messages that left the recent window but are
+    not in the summary yet); summary_upto and summary_generation are passed back to save_summary"""
+    await write_behind.settled(user.user_id, conversation_id)
+    state = await repositories.conversations.message_count(
+        user.user_id, conversation_id, {"summary": 1, "summary_upto": 1, "summary_generation": 1}
+    )
+    if not state:
+        return None, 0, 0, []
+
+    summary = state.get("summary")
+    summary_upto = state.get("summary_upto", 0)
+    generation = state.get("summary_generation", 0)
+    end = min(state["count"] - RECENT_MESSAGES, summary_upto + SUMMARY_BATCH_MESSAGES)
+    if end <= summary_upto:
+        return summary, summary_upto, generation, []
+    messages = await repositories.messages.range(user.user_id, conversation_id, summary_upto, end - summary_upto)
+    return summary, summary_upto, generation, messages
+
+async def save_summary(user: User, conversation_id: str, summary: str, previous_upto: int, summary_upto: int, generation: int):
+    # Only applies if the summary was not updated in the meantime and no messages were deleted
+    # since they were read (truncation bumps summary_generation)
+    await repositories.conversations.update(
+        user.user_id, conversation_id,
+        {"$set": {"summary": summary, "summary_upto": summary_upto}},
+        {
+            "summary_upto": previous_upto if previous_upto else {"$in": [None, 0]},
+            "summary_generation": generation if generation else {"$in": [None, 0]}
+        }
     )
-    return conversation.get("conversation", []) 
 
-def save_conversation(user: User, user_message, response_text, token_usage, request: ChatRequest, in_billing: float, out_billing: float):
+async def save_conversation(user: User, user_message, response_text, token_usage, request: ChatRequest, in_billing: float, out_billing: float):
+    """Reserve the turn's positions, then queue it for the write-behind writer; returns a future
+    that resolves once it is saved"""
     response_data = {
         "name": user.name,
         "user_id": user.user_id,
@@ -102,55 +163,55 @@ def save_conversation(user: User, user_message, response_text, token_usage, requ
     formatted_response = {"role": "assistant", "content": response_text or "\u200B"}
     billing = calculate_billing(user, request.model, token_usage, in_billing, out_billing)
     
-    if user.trial:
-        user_collection.update_one(
-            {"_id": ObjectId(user.user_id)},
-            {"$inc": {"trial_remaining": -1}}
-        )
-    else:
-        user_collection.update_one(
-            {"_id": ObjectId(user.user_id)},
-            {"$inc": {"billing": billing}}
-        )
-        
-    conversation_collection.update_one(
-        {"user_id": user.user_id, "conversation_id": request.conversation_id},
+    messages = [user_message, formatted_response]
+    prepared = await asyncio.to_thread(lambda: [prepared_document(message) for message in messages])
+    # Reserved here rather than by the writer so turns keep their order across workers;
+    # a conversation deleted meanwhile (None) still gets billed
+    start = await repositories.conversations.reserve_messages(
+        user.user_id, request.conversation_id, len(messages),
         {
-            "$push": {
-                "conversation": {
-                    "$each": [user_message, formatted_response]
-                }
-            },
-            "$set": {
-                "model": request.model,
-                "temperature": request.temperature,
-                "reason": request.reason,
-                "verbosity": request.verbosity,
-                "system_message": request.system_message,
-                "inference": request.inference,
-                "search": request.search,
-                "deep_research": request.deep_research,
-                "dan": request.dan,
-                "mcp": request.mcp
-            }
+            "model": request.model,
+            "temperature": request.temperature,
+            "reason": request.reason,
+            "verbosity": request.verbosity,
+            "system_message": request.system_message,
+            "inference": request.inference,
+            "search": request.search,
+            "deep_research": request.deep_research,
+            "dan": request.dan,
+            "mcp": request.mcp
         }
     )
+    return write_behind.enqueue(PendingTurn(
+        user.user_id, request.conversation_id,
+        messages,
+        -1 if start is None else start,
+        {"trial_remaining": -1} if user.trial else {"billing": billing},
+        usage_event(user.user_id, request.conversation_id, request.model, token_usage, billing, user.trial),
+        prepared
+    ))
 
-def save_alias(user: User, conversation_id: str, alias: str):
-    conversation_collection.update_one(
-        {"user_id": user.user_id, "conversation_id": conversation_id},
-        {"$set": {"alias": alias}}
-    )
+async def save_alias(user: User, conversation_id: str, alias: str, if_missing: bool = False):
+    # Generated titles never overwrite one the user set in the meantime
+    conditions = {"alias": {"$in": [None, ""]}} if if_missing else None
+    await repositories.conversations.update(user.user_id, conversation_id, {"$set": {"alias": alias}}, conditions)
+
+# Identifies this process as a lease holder (see hold_lease)
+LEASE_OWNER = f"{socket.gethostname()}:{os.getpid()}"
+
+async def hold_lease(name: str, seconds: float):
+    """Whether this process holds the named lease for the next seconds (taking or renewing it)"""
+    return await repositories.leases.acquire(name, LEASE_OWNER, seconds)
+
+async def get_conversations_without_alias(limit: int, exclude=()):
+    """Most recent conversations that have messages but no alias yet, with their first message"""
+    return await repositories.conversations.without_alias(limit, exclude)
 
 def get_model_billing(model_name):
     try:
-        models_path = os.path.join(os.path.dirname(__file__), '..', 'models.json')
-        with open(models_path, 'r', encoding='utf-8') as f:
-            models_data = json.load(f)
-        
-        for model in models_data['models']:
-            if model['model_name'] == model_name:
-                return float(model['in_billing']), float(model['out_billing'])
+        model = models_config.get()["by_name"].get(model_name)
+        if model:
+            return float(model['in_billing']), float(model['out_billing'])
         
         logger.warning(f"Model {model_name} not found in models.json")
         return None
@@ -184,6 +245,38 @@ def calculate_billing(user: User, model_name, token_usage, in_billing_rate: floa
         
     return total_cost
 
+def upload_path(content_path: str):
+    """Absolute path of an uploaded file from its /images/... or /files/... URL path"""
+    return os.path.join(BACKEND_DIR, content_path.lstrip("/"))
+
+def prepare_user_part(part):
+    if part.get("type") == "url":
+        return {"type": "text", "text": part.get("content")}
+    # Files stay references: whether a document is searched or inlined is decided per turn,
+    # since its index may be built (or rebuilt) after the message was saved
+    return part
+
+def prepare_message(message):
+    """Model-ready form of a stored message, computed once when it is saved instead of on every
+    later turn: assistant text without think/citation/tool markup and URLs as text"""
+    role = message.get("role")
+    content = message.get("content")
+    if role == "assistant":
+        return {"role": "assistant", "content": normalize_assistant_content(content or "")}
+    if role == "user" and isinstance(content, list):
+        return {"role": "user", "content": [prepare_user_part(part) for part in content]}
+    return message
+
+def prepared_document(message):
+    return {"version": PREPARED_VERSION, "message": prepare_message(message)}
+
+def model_message(document):
+    """Prepared message of a stored message document, prepared now if it predates PREPARED_VERSION"""
+    prepared = document.get("prepared")
+    if prepared and prepared.get("version") == PREPARED_VERSION:
+        return prepared["message"]
+    return prepare_message(document["message"])
+
 def normalize_assistant_content(content):
     content = re.sub(r'<think>.*?</think>', '', content, flags=re.DOTALL)
     content = re.sub(r'<citations>.*?</citations>', '', content, flags=re.DOTALL)
@@ -1,39 +1,53 @@
-import os
 import uuid
 from dotenv import load_dotenv
-from pymongo import MongoClient
-from fastapi import APIRouter, Depends, HTTPException, status
+from fastapi import APIRouter, Depends, HTTPException, Query, status
 from pydantic import BaseModel
 from bson import ObjectId
 from datetime import datetime, timezone
 from .auth import User, get_current_user, check_admin
+import repositories
+from write_behind import write_behind
+from pagination import InvalidCursor
 
 load_dotenv()
 router = APIRouter()
 
-mongo_client = MongoClient(os.getenv('MONGODB_URI'))
-db = mongo_client.chat_db
-conversations_collection = db.conversations
-
 class RenameRequest(BaseModel):
     alias: str
 
 class StarRequest(BaseModel):
     starred: bool
 
+CONVERSATION_SETTINGS = {
+    field: 1 for field in (
+        "conversation_id", "user_id", "alias", "model", "temperature", "reason", "verbosity",
+        "system_message", "inference", "search", "deep_research", "dan", "mcp"
+    )
+}
+
+async def read_page(fetch, *args):
+    try:
+        return await fetch(*args)
+    except InvalidCursor:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
 @router.get("/conversations", response_model=dict)
-async def get_conversations(current_user: User = Depends(get_current_user)):
+async def get_conversations(
+    limit: int = Query(100, ge=1, le=500),
+    cursor: str = None,
+    current_user: User = Depends(get_current_user)
+):
     user_id = current_user.user_id
-    cursor = conversations_collection.find(
-        {"user_id": user_id},
-        {"_id": 1, "user_id": 1, "conversation_id": 1, "alias": 1, "starred": 1, "starred_at": 1, "created_at": 1}
-    ).sort([
-        ("starred", -1),
-        ("starred_at", -1),
-        ("created_at", -1)
-    ])
+    docs, next_cursor = await read_page(
+        repositories.conversations.list_for_user,
+        user_id,
+        {"_id": 1, "user_id": 1, "conversation_id": 1, "alias": 1, "starred": 1, "starred_at": 1, "created_at": 1},
+        [("starred", -1), ("starred_at", -1), ("created_at", -1), ("_id", -1)],
+        limit,
+        cursor
+    )
     conversations = []
-    for doc in cursor:
+    for doc in docs:
         conversations.append({
             "_id": str(doc["_id"]),
             "user_id": doc["user_id"],
@@ -43,27 +57,33 @@ async def get_conversations(current_user: User = Depends(get_current_user)):
             "starred_at": doc.get("starred_at").isoformat() if doc.get("starred_at") else None,
             "created_at": doc.get("created_at").isoformat() if doc.get("created_at") else None
         })
-    return {"conversations": conversations}
+    return {"conversations": conversations, "next_cursor": next_cursor}
 
 @router.get("/conversations/{user_id}", response_model=dict)
 async def get_user_conversations(
     user_id: str, 
+    limit: int = Query(100, ge=1, le=500),
+    cursor: str = None,
     _ = Depends(check_admin)
 ):
     if not ObjectId.is_valid(user_id):
         raise HTTPException(status_code=400, detail="Invalid User ID")
     
-    user = db.users.find_one({"_id": ObjectId(user_id)})
+    user = await repositories.users.find_by_id(user_id, {"_id": 1})
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
     
-    cursor = conversations_collection.find(
-        {"user_id": user_id},
-        {"_id": 1, "user_id": 1, "conversation_id": 1, "alias": 1, "model": 1, "created_at": 1}
-    ).sort("created_at", -1)
+    docs, next_cursor = await read_page(
+        repositories.conversations.list_for_user,
+        user_id,
+        {"_id": 1, "user_id": 1, "conversation_id": 1, "alias": 1, "model": 1, "created_at": 1},
+        [("created_at", -1), ("_id", -1)],
+        limit,
+        cursor
+    )
     
     conversations = []
-    for doc in cursor:
+    for doc in docs:
         conversations.append({
             "_id": str(doc["_id"]),
             "user_id": doc["user_id"],
@@ -73,11 +93,18 @@ async def get_user_conversations(
             "created_at": doc.get("created_at").isoformat() if doc.get("created_at") else None
         })
     
-    return {"conversations": conversations}
+    return {"conversations": conversations, "next_cursor": next_cursor}
 
 @router.get("/conversation/{conversation_id}", response_model=dict)
-async def get_conversation(conversation_id: str, current_user: User = Depends(get_current_user)):
-    doc = conversations_collection.find_one({"conversation_id": conversation_id})
+async def get_conversation(
+    conversation_id: str,
+    limit: int = Query(100, ge=1, le=500),
+    cursor: str = None,
+    current_user: User = Depends(get_current_user)
+):
+    """Settings plus the newest page of messages; next_cursor fetches the page before it and
+    start is the index of the first returned message in the whole conversation"""
+    doc = await repositories.conversations.find_by_conversation_id(conversation_id, CONVERSATION_SETTINGS)
     if not doc:
         raise HTTPException(status_code=404, detail="Conversation not found")
     if doc["user_id"] != current_user.user_id and not current_user.admin:
@@ -85,6 +112,8 @@ async def get_conversation(conversation_id: str, current_user: User = Depends(ge
             status_code=status.HTTP_403_FORBIDDEN,
             detail="You don't have permission to access this conversation"
         )
+    await write_behind.settled(doc["user_id"], conversation_id)
+    messages, next_cursor = await read_page(repositories.messages.page, doc["user_id"], conversation_id, limit, cursor)
     return {
         "conversation_id": doc["conversation_id"],
         "alias": doc.get("alias", ""),
@@ -98,7 +127,9 @@ async def get_conversation(conversation_id: str, current_user: User = Depends(ge
         "deep_research": doc.get("deep_research", False),
         "dan": doc.get("dan", False),
         "mcp": doc.get("mcp", []),
-        "messages": doc.get("conversation", [])
+        "messages": [message["message"] for message in messages],
+        "start": await repositories.messages.index_of(doc["user_id"], conversation_id, messages[0]["seq"]) if messages else 0,
+        "next_cursor": next_cursor
     }
 
 @router.post("/new_conversation", response_model=dict)
@@ -120,14 +151,14 @@ async def create_new_conversation(current_user: User = Depends(get_current_user)
         "deep_research": None,
         "dan": None,
         "mcp": None,
-        "conversation": [],
+        "message_count": 0,
         "starred": False,
         "starred_at": None,
         "created_at": datetime.now(timezone.utc)
     }
     
     try:
-        conversations_collection.insert_one(new_conversation)
+        await repositories.conversations.insert(new_conversation)
     except Exception as ex:
         raise HTTPException(status_code=500, detail="Failed to create conversation")
         
@@ -144,11 +175,8 @@ async def rename_conversation(
     current_user: User = Depends(get_current_user)
 ):
     user_id = current_user.user_id
-    result = conversations_collection.update_one(
-        {"user_id": user_id, "conversation_id": conversation_id},
-        {"$set": {"alias": request.alias}}
-    )
-    if result.matched_count == 0:
+    matched = await repositories.conversations.update(user_id, conversation_id, {"$set": {"alias": request.alias}})
+    if matched == 0:
         raise HTTPException(status_code=404, detail="Conversation not found")
     return {
         "message": "Conversation renamed successfully",
@@ -159,21 +187,16 @@ async def rename_conversation(
 @router.delete("/conversation/all", response_model=dict)
 async def delete_all_conversation(current_user: User = Depends(get_current_user)):
     user_id = current_user.user_id
-    result = conversations_collection.delete_many({
-        "user_id": user_id,
-    })
-    if result.deleted_count == 0:
+    deleted = await repositories.conversations.delete_all(user_id)
+    if deleted == 0:
         raise HTTPException(status_code=404, detail="Conversation not found or already deleted")
     return {"message": "Conversations deleted successfully"}
 
 @router.delete("/conversation/{conversation_id}", response_model=dict)
 async def delete_conversation(conversation_id: str, current_user: User = Depends(get_current_user)):
     user_id = current_user.user_id
-    result = conversations_collection.delete_one({
-        "user_id": user_id,
-        "conversation_id": conversation_id
-    })
-    if result.deleted_count == 0:
+    deleted = await repositories.conversations.delete(user_id, conversation_id)
+    if deleted == 0:
         raise HTTPException(status_code=404, detail="Conversation not found or already deleted")
     return {"message": "Conversation deleted successfully", "conversation_id": conversation_id}
     
@@ -184,19 +207,21 @@ async def delete_messages_from_index(
     current_user: User = Depends(get_current_user)
 ):
     user_id = current_user.user_id
-    doc = conversations_collection.find_one({"user_id": user_id, "conversation_id": conversation_id})
+    await write_behind.settled(user_id, conversation_id)
+    doc = await repositories.conversations.find(user_id, conversation_id, {"summary_upto": 1})
     if doc is None:
         raise HTTPException(status_code=404, detail="Conversation not found")
     
-    messages = doc.get("conversation", [])
-    if startIndex < 0 or startIndex >= len(messages):
+    # startIndex counts the messages the client has; seq can skip positions of dropped turns
+    seq = await repositories.messages.seq_at(user_id, conversation_id, startIndex) if startIndex >= 0 else None
+    if seq is None:
         raise HTTPException(status_code=400, detail="startIndex is out of range")
     
-    new_messages = messages[:startIndex]
-    conversations_collection.update_one(
-        {"_id": doc["_id"]},
-        {"$set": {"conversation": new_messages}}
-    )
+    update = {}
+    if seq < doc.get("summary_upto", 0):
+        # The running summary covers deleted messages; it is rebuilt on the next turns
+        update["$unset"] = {"summary": "", "summary_upto": ""}
+    await repositories.conversations.truncate(user_id, conversation_id, seq, update)
     
     return {
         "message": "Conversation truncated successfully.",
@@ -210,8 +235,8 @@ async def toggle_star_conversation(
     current_user: User = Depends(get_current_user)
 ):
     user_id = current_user.user_id
-    result = conversations_collection.update_one(
-        {"user_id": user_id, "conversation_id": conversation_id},
+    matched = await repositories.conversations.update(
+        user_id, conversation_id,
         {
             "$set": {
                 "starred": request.starred,
@@ -219,7 +244,7 @@ async def toggle_star_conversation(
             }
         }
     )
-    if result.matched_count == 0:
+    if matched == 0:
         raise HTTPException(status_code=404, detail="Conversation not found")
     return {
         "message": "Conversation star status updated successfully"
@@ -5,6 +5,7 @@ import zipfile
 # import textract  # moved to lazy import
 import io
 import json
+import asyncio
 from fastapi import APIRouter, File, UploadFile, HTTPException, Depends
 from pydantic import BaseModel
 from PIL import Image, ImageOps
@@ -12,6 +13,7 @@ from typing import List
 # from google.cloud import speech  # moved to optional import
 from .auth import User, get_current_user
 from logging_util import logger
+from document_index import build_index
 
 router = APIRouter()
 
@@ -273,6 +275,12 @@ async def upload_file(file: UploadFile = File(...), current_user: User = Depends
 	with open(processed_file_path, "w", encoding="utf-8") as f:
 		f.write(processed_content)
 
+	# Long documents are chunked and embedded now so prompts can carry only the relevant parts
+	try:
+		await asyncio.to_thread(build_index, processed_file_path)
+	except Exception as ex:
+		logger.error(f"DOCUMENT_INDEX_FAILED: {json.dumps({'file': filename, 'error': str(ex), 'fallback': 'full_text'}, ensure_ascii=False, indent=2)}")
+
 	original_filename = f"{file_uuid}{ext}"
 	original_file_path = os.path.join(FILES_ORIGINAL_DIR, original_filename)
 	with open(original_file_path, "wb") as f:
@@ -0,0 +1,42 @@
+from datetime import datetime, timezone, timedelta
+from fastapi import APIRouter, Depends, HTTPException, Query
+from .auth import check_admin
+import repositories
+
+router = APIRouter()
+
+GROUP_KEYS = ("day", "user_id", "model")
+
+def parse_day(value: str):
+    try:
+        return datetime.strptime(value, "%Y-%m-%d").strftime("%Y-%m-%d")
+    except ValueError:
+        raise HTTPException(status_code=400, detail=f"Invalid date: {value} (expected YYYY-MM-DD)")
+
+@router.get("/usage/report", response_model=dict)
+async def get_usage_report(
+    start: str = Query(None, description="First day (UTC, YYYY-MM-DD), default 30 days ago"),
+    end: str = Query(None, description="Last day (UTC, YYYY-MM-DD), default today"),
+    group_by: str = Query("day,model", description="Comma separated: day, user_id, model"),
+    user_id: str = None,
+    model: str = None,
+    _ = Depends(check_admin)
+):
+    """Requests, tokens and cost per group over a day range, served from the daily rollups"""
+    today = datetime.now(timezone.utc)
+    start = parse_day(start) if start else (today - timedelta(days=30)).strftime("%Y-%m-%d")
+    end = parse_day(end) if end else today.strftime("%Y-%m-%d")
+
+    keys = [key.strip() for key in group_by.split(",") if key.strip()]
+    if not keys or any(key not in GROUP_KEYS for key in keys):
+        raise HTTPException(status_code=400, detail=f"group_by must be a combination of {', '.join(GROUP_KEYS)}")
+
+    rows = await repositories.usage.report(start, end, keys, user_id, model)
+    rolled_up_until = await repositories.usage.rolled_up_until()
+    return {
+        "start": start,
+        "end": end,
+        "group_by": keys,
+        "rows": rows,
+        "rolled_up_until": rolled_up_until.isoformat() if rolled_up_until else None
+    }
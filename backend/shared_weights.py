@@ -0,0 +1,113 @@
+import os
+import time
+import logging
+import contextlib
+import torch
+from transformers import AutoConfig
+
+# Same logger as logging_util, without importing the web app (used by the inference server too)
+logger = logging.getLogger("devochat")
+
+def export_shared_weights(model, path: str):
+    """Write every parameter and buffer of a loaded model to a single mmap-able file"""
+    tensors = {}
+    for name, param in model.named_parameters():
+        tensors[name] = param.detach().cpu().contiguous()
+    # Non-persistent buffers (rotary inv_freq etc.) are not part of state_dict,
+    # so buffers are exported explicitly to rebuild the model from the meta device
+    for name, buffer in model.named_buffers():
+        tensors[name] = buffer.detach().cpu().contiguous()
+
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    torch.save(tensors, tmp_path)
+    os.replace(tmp_path, path)
+
+def assign_tensor(model, name: str, tensor):
+    module_path, _, leaf = name.rpartition(".")
+    module = model.get_submodule(module_path) if module_path else model
+    if leaf in module._parameters:
+        module._parameters[leaf] = torch.nn.Parameter(tensor, requires_grad=False)
+    else:
+        module._buffers[leaf] = tensor
+
+@contextlib.contextmanager
+def exclusive_lock(lock_file):
+    """Cross-process exclusive lock on an open file: flock on POSIX, msvcrt on Windows"""
+    try:
+        import fcntl
+    except ImportError:
+        fcntl = None
+    if fcntl is not None:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+        return
+
+    import msvcrt
+    while True:
+        try:
+            # LK_LOCK itself only retries for about 10 seconds; an export takes longer
+            msvcrt.locking(lock_file.fileno(), msvcrt.LK_LOCK, 1)
+            break
+        except OSError:
+            time.sleep(1)
+    try:
+        yield
+    finally:
+        lock_file.seek(0)
+        msvcrt.locking(lock_file.fileno(), msvcrt.LK_UNLCK, 1)
+
+def load_shared_model(model_cls, model_name: str, path: str, token=None, dtype=torch.bfloat16):
+    """Load a model whose weights are memory-mapped from a file shared by every worker process"""
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+
+    # Only the first worker exports the weights; the others wait on the lock and attach
+    with open(f"{path}.lock", "w") as lock_file, exclusive_lock(lock_file):
+        if not os.path.exists(path):
+            logger.info(f"Exporting shared weights for {model_name} to {path}")
+            source_model = model_cls.from_pretrained(
+                model_name,
+                torch_dtype=dtype,
+                low_cpu_mem_usage=True,
+                trust_remote_code=True,
+                token=token
+            )
+            export_shared_weights(source_model, path)
+            del source_model
+
+    config = AutoConfig.from_pretrained(model_name, trust_remote_code=True, token=token)
+    with torch.device("meta"):
+        model = model_cls.from_config(config, torch_dtype=dtype, trust_remote_code=True)
+
+    # MAP_PRIVATE pages stay backed by the page cache until written, and inference never
+    # writes weights, so every worker maps the same physical memory
+    tensors = torch.load(path, mmap=True, weights_only=True, map_location="cpu")
+    for name, tensor in tensors.items():
+        assign_tensor(model, name, tensor)
+    model.tie_weights()
+
+    missing = [name for name, param in model.named_parameters() if param.is_meta]
+    if missing:
+        raise RuntimeError(f"Shared weights file {path} is missing tensors: {', '.join(missing[:5])}")
+
+    model.eval()
+    logger.info(f"Attached shared weights for {model_name} from {path} (pid {os.getpid()})")
+    return model
+
+def read_memory_usage(pid: str = "self"):
+    """Return RSS and its shared/private split in MB from /proc/<pid>/smaps_rollup"""
+    fields = {}
+    with open(f"/proc/{pid}/smaps_rollup", "r") as f:
+        for line in f:
+            parts = line.split()
+            if len(parts) >= 3 and parts[2] == "kB":
+                fields[parts[0].rstrip(":")] = int(parts[1]) / 1024
+
+    return {
+        "rss_mb": round(fields.get("Rss", 0), 1),
+        "pss_mb": round(fields.get("Pss", 0), 1),
+        "shared_mb": round(fields.get("Shared_Clean", 0) + fields.get("Shared_Dirty", 0), 1),
+        "private_mb": round(fields.get("Private_Clean", 0) + fields.get("Private_Dirty", 0), 1)
+    }
@@ -0,0 +1,59 @@
+import os
+import asyncio
+import logging
+from bson import ObjectId
+from datetime import datetime, timezone, timedelta
+import repositories
+
+# Same logger as logging_util, without importing the web app
+logger = logging.getLogger("devochat")
+
+ROLLUP_INTERVAL_SECONDS = float(os.getenv('USAGE_ROLLUP_INTERVAL_SECONDS', '300'))
+# Events can reach the database a little after their timestamp (write-behind batching, retries);
+# each rollup re-reads this far behind the previous one so they are still counted
+LATE_EVENTS = timedelta(minutes=10)
+
+def usage_event(user_id: str, conversation_id: str, model: str, token_usage: dict, cost: float, trial: bool):
+    """One ledger entry for a billed turn; the _id is fixed up front so retried writes are idempotent"""
+    token_usage = token_usage or {}
+    return {
+        "_id": ObjectId(),
+        "user_id": user_id,
+        "conversation_id": conversation_id,
+        "model": model,
+        "input_tokens": token_usage.get("input_tokens", 0),
+        "output_tokens": token_usage.get("output_tokens", 0),
+        "reasoning_tokens": token_usage.get("reasoning_tokens", 0),
+        "cost": cost,
+        "trial": trial,
+        "created_at": datetime.now(timezone.utc)
+    }
+
+async def rollup_once():
+    until = datetime.now(timezone.utc)
+    previous = await repositories.usage.rolled_up_until()
+    if previous is not None:
+        since = previous.replace(tzinfo=timezone.utc) - LATE_EVENTS
+    else:
+        # First run: backfill the whole ledger
+        since = await repositories.usage.first_event_time()
+        if since is None:
+            return
+        since = since.replace(tzinfo=timezone.utc)
+    await repositories.usage.rollup(since, until)
+
+async def rollup_worker():
+    """Keep the per-user/model/day rollups that the usage report reads up to date"""
+    while True:
+        try:
+            await rollup_once()
+        except Exception as ex:
+            logger.error(f"USAGE_ROLLUP_ERROR: {str(ex)}")
+        await asyncio.sleep(ROLLUP_INTERVAL_SECONDS)
+
+rollup_task = None
+
+def start_rollups():
+    global rollup_task
+    if rollup_task is None:
+        rollup_task = asyncio.create_task(rollup_worker())
@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+"""
+Regression checks for MedGemmaEngine on a tiny random Gemma 3 (see benchmark_engine.py)
+Generates past the model's sliding window, alone and in a left-padded batch whose rows finish
+at different steps, with the full and the sliding KV cache (MEDGEMMA_KV_WINDOW), and fails unless
+every request produces all of its tokens. Also runs evaluate_sliding_kv.py's comparison on it.
+"""
+
+import os
+import sys
+import argparse
+import threading
+import torch
+from dotenv import load_dotenv
+from transformers import AutoProcessor
+from medgemma_engine import MedGemmaEngine, GenerationRequest, MEDGEMMA_MODEL_ID
+from benchmark_engine import tiny_model
+from evaluate_sliding_kv import compare
+
+load_dotenv()
+
+def prompt_of(words: int):
+    return " ".join(["patient"] * words)
+
+def generate_all(engine, jobs):
+    """Submit every (prompt, max_new_tokens) job at once so they share batches; returns each
+    request's token_usage dict or exception"""
+    results = [None] * len(jobs)
+    done = threading.Semaphore(0)
+    for i, (prompt, max_new_tokens) in enumerate(jobs):
+        def emit(item, i=i):
+            if isinstance(item, (dict, Exception)):
+                results[i] = item
+                done.release()
+
+        engine.submit(GenerationRequest([{"role": "user", "content": prompt}], temperature=0.0, max_new_tokens=max_new_tokens, emit=emit))
+    for _ in jobs:
+        done.acquire()
+    return results
+
+def check(label: str, engine, jobs):
+    results = generate_all(engine, jobs)
+    failures = []
+    for (_, max_new_tokens), result in zip(jobs, results):
+        if isinstance(result, Exception):
+            failures.append(f"{type(result).__name__}: {result}")
+        elif result["output_tokens"] != max_new_tokens:
+            failures.append(f"{result['output_tokens']} of {max_new_tokens} tokens")
+    lengths = [result["input_tokens"] + result["output_tokens"] for result in results if isinstance(result, dict)]
+    status = "FAIL" if failures else "ok"
+    print(f"{status:4} {label}: sequence lengths {lengths}" + (f" ({'; '.join(failures)})" if failures else ""))
+    return not failures
+
+def check_comparison(model, sliding_window: int, sink_tokens: int):
+    """Full and sliding-window perplexity/latency over four windows of random tokens"""
+    input_ids = torch.randint(0, model.config.get_text_config().vocab_size, (1, sliding_window * 4))
+    try:
+        report = compare(model, input_ids, sink_tokens, sliding_window, prefix_tokens=sliding_window // 2)
+    except Exception as e:
+        print(f"FAIL full vs sliding KV comparison: {type(e).__name__}: {e}")
+        return False
+    print(f"ok   full vs sliding KV comparison: window {report['window']}, full {report['full']}, sliding {report['sliding']}")
+    return True
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate past the sliding window of a tiny Gemma 3 and fail on errors")
+    parser.add_argument("--processor", default=MEDGEMMA_MODEL_ID, help="Repository to take the processor/tokenizer from")
+    parser.add_argument("--sliding-window", type=int, default=32)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    torch.set_num_threads(2)
+    processor = AutoProcessor.from_pretrained(args.processor, token=os.getenv('HUGGINGFACE_TOKEN'))
+    engine = MedGemmaEngine(args.processor)
+    # Long enough for all jobs of one check to land in the same batch
+    engine.batch_window = 0.2
+    engine.attach(tiny_model(processor, args.seed, args.sliding_window), processor, device="cpu")
+    # Random weights emit EOS at random; disable it so every request must produce max_new_tokens
+    engine.eos_token_ids = set()
+
+    window = args.sliding_window
+    results = [
+        check("within the window", engine, [(prompt_of(2), 4)]),
+        check("decode past the window", engine, [(prompt_of(window // 2), window)]),
+        check("prompt longer than the window", engine, [(prompt_of(window * 2), 8)]),
+        check(
+            "padded batch past the window, rows finishing early",
+            engine,
+            [(prompt_of(2), window * 2), (prompt_of(window), 4), (prompt_of(window // 2), window)]
+        )
+    ]
+    engine.unload()
+
+    sliding_engine = MedGemmaEngine(args.processor)
+    sliding_engine.batch_window = 0.2
+    # More than the model allows, so attach() must cap it
+    sliding_engine.kv_window = window
+    model = tiny_model(processor, args.seed, args.sliding_window)
+    sliding_engine.attach(model, processor, device="cpu")
+    sliding_engine.eos_token_ids = set()
+    label = f"sliding KV window {sliding_engine.kv_window}"
+    results += [
+        check(f"{label}, prompt longer than the model's window", sliding_engine, [(prompt_of(window * 3), window)]),
+        check(
+            f"{label}, padded batch past the model's window",
+            sliding_engine,
+            [(prompt_of(2), window * 2), (prompt_of(window * 3), 4), (prompt_of(window), window)]
+        ),
+        check_comparison(model, window, sliding_engine.kv_sink_tokens)
+    ]
+    sliding_engine.unload()
+    if not all(results):
+        print(f"❌ {results.count(False)} checks failed")
+        sys.exit(1)
+    print("✅ The engine generates past the sliding window, with and without the sliding KV cache")
+
+if __name__ == "__main__":
+    main()
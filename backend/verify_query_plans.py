@@ -0,0 +1,161 @@
+#!/usr/bin/env python3
+"""
+Check that every repository query is served by an index
+Runs each repository method against a scratch database on a local
+mongod, records the commands it sends, explains them and fails on collection scans (COLLSCAN)
+or in-memory sorts (SORT)
+"""
+
+import os
+import sys
+import uuid
+import asyncio
+import argparse
+from datetime import datetime, timezone, timedelta
+from pymongo import monitoring
+from bson import ObjectId
+from motor.motor_asyncio import AsyncIOMotorClient
+from pagination import encode_cursor
+from repositories import UserRepository, MessageRepository, ConversationRepository, UsageRepository
+from usage_ledger import usage_event
+from indexes import ensure_indexes
+
+EXPLAINABLE = {"find", "aggregate", "update", "delete", "findAndModify"}
+DRIVER_FIELDS = {"$db", "lsid", "$clusterTime", "txnNumber", "$readPreference", "readConcern", "writeConcern"}
+BAD_STAGES = {"COLLSCAN", "SORT"}
+
+class CommandRecorder(monitoring.CommandListener):
+    def __init__(self):
+        self.label = None
+        self.commands = []
+
+    def started(self, event):
+        if event.command_name in EXPLAINABLE and self.label:
+            command = {key: value for key, value in event.command.items() if key not in DRIVER_FIELDS}
+            self.commands.append((self.label, command))
+
+    def succeeded(self, event):
+        pass
+
+    def failed(self, event):
+        pass
+
+def plan_stages(plan):
+    """Every stage name anywhere in an explain document (classic and SBE plans, aggregate wrappers)"""
+    if isinstance(plan, dict):
+        for key, value in plan.items():
+            if key == "stage" and isinstance(value, str):
+                yield value
+            elif key in ("rejectedPlans", "allPlansExecution"):
+                continue
+            else:
+                yield from plan_stages(value)
+    elif isinstance(plan, list):
+        for item in plan:
+            yield from plan_stages(item)
+
+async def exercise(users: UserRepository, messages: MessageRepository, conversations: ConversationRepository, usage: UsageRepository, recorder: CommandRecorder):
+    """Seed a little data, then call every read/update path once with recording on"""
+    now = datetime.now(timezone.utc)
+    user_ids = [await users.insert({
+        "name": f"user{i}", "email": f"user{i}@example.com", "password": "x",
+        "billing": 0.0, "admin": False, "trial": True, "trial_remaining": 10, "created_at": now
+    }) for i in range(20)]
+    conversation_ids = []
+    for i in range(200):
+        conversation_id = str(uuid.uuid4())
+        conversation_ids.append(conversation_id)
+        await conversations.insert({
+            "user_id": user_ids[i % len(user_ids)], "conversation_id": conversation_id, "alias": None if i % 3 else "t",
+            "message_count": 0, "starred": i % 7 == 0, "starred_at": now if i % 7 == 0 else None, "created_at": now
+        })
+        await conversations.append_messages(
+            user_ids[i % len(user_ids)], conversation_id,
+            [{"role": "user", "content": "hi"}, {"role": "assistant", "content": "hello"}], {"model": "m"}
+        )
+    await usage.insert_many([
+        usage_event(user_ids[i % len(user_ids)], conversation_ids[i], "m", {"input_tokens": 10, "output_tokens": 5}, 0.001, False)
+        for i in range(50)
+    ])
+    user_id, conversation_id = user_ids[0], conversation_ids[0]
+    starred_sort = [("starred", -1), ("starred_at", -1), ("created_at", -1), ("_id", -1)]
+    created_sort = [("created_at", -1), ("_id", -1)]
+    first_conversation = await conversations.find(user_id, conversation_id)
+
+    calls = {
+        "users.find_by_id": lambda: users.find_by_id(user_id, {"password": 0}),
+        "users.find_by_email": lambda: users.find_by_email("user1@example.com"),
+        "users.list": lambda: users.list(10, {"name": 1, "email": 1}),
+        "users.list (next page)": lambda: users.list(10, {"name": 1, "email": 1}, encode_cursor({"_id": ObjectId(user_ids[5])}, [("_id", 1)])),
+        "users.increment": lambda: users.increment(user_id, {"billing": 0.1}),
+        "users.charge_turns": lambda: users.charge_turns([(user_id, ObjectId(), {"billing": 0.1})]),
+        "users.update": lambda: users.update(user_id, {"trial": False}),
+        "conversations.find": lambda: conversations.find(user_id, conversation_id),
+        "conversations.find_by_conversation_id": lambda: conversations.find_by_conversation_id(conversation_id),
+        "conversations.list_for_user (starred)": lambda: conversations.list_for_user(user_id, {"conversation_id": 1}, starred_sort, 3),
+        "conversations.list_for_user (starred, next page)": lambda: conversations.list_for_user(
+            user_id, {"conversation_id": 1}, starred_sort, 3, encode_cursor(first_conversation, starred_sort)
+        ),
+        "conversations.list_for_user (created)": lambda: conversations.list_for_user(user_id, {"conversation_id": 1}, created_sort, 3),
+        "conversations.list_for_user (created, next page)": lambda: conversations.list_for_user(
+            user_id, {"conversation_id": 1}, created_sort, 3, encode_cursor(first_conversation, created_sort)
+        ),
+        "conversations.update": lambda: conversations.update(user_id, conversation_id, {"$set": {"alias": "x"}}, {"alias": {"$in": [None, ""]}}),
+        "conversations.append_messages": lambda: conversations.append_messages(user_id, conversation_id, [{"role": "user", "content": "q"}], {"model": "m"}),
+        "conversations.message_count": lambda: conversations.message_count(user_id, conversation_id, {"summary": 1}),
+        "conversations.without_alias": lambda: conversations.without_alias(8, conversation_ids[:3]),
+        "conversations.truncate": lambda: conversations.truncate(user_id, conversation_ids[2], 1),
+        "messages.range": lambda: messages.range(user_id, conversation_id, 0, 2),
+        "messages.page": lambda: messages.page(user_id, conversation_id, 1),
+        "messages.page (previous page)": lambda: messages.page(user_id, conversation_id, 1, encode_cursor({"seq": 1}, [("seq", -1)])),
+        "messages.since": lambda: messages.since(user_id, conversation_id, 1),
+        "messages.seq_at": lambda: messages.seq_at(user_id, conversation_id, 1),
+        "messages.index_of": lambda: messages.index_of(user_id, conversation_id, 1),
+        "messages.first": lambda: messages.first([(user_id, conversation_id), (user_ids[1], conversation_ids[1])]),
+        "usage.rollup": lambda: usage.rollup(now - timedelta(days=1), datetime.now(timezone.utc)),
+        "usage.report": lambda: usage.report(now.strftime("%Y-%m-%d"), now.strftime("%Y-%m-%d"), ["day", "model"], user_id),
+        "conversations.delete": lambda: conversations.delete(user_id, conversation_ids[1]),
+        "conversations.delete_all": lambda: conversations.delete_all(user_ids[-1])
+    }
+    for label, call in calls.items():
+        recorder.label = label
+        await call()
+    recorder.label = None
+
+async def verify(uri: str):
+    recorder = CommandRecorder()
+    client = AsyncIOMotorClient(uri, event_listeners=[recorder], serverSelectionTimeoutMS=5000)
+    database = client[f"plan_check_{uuid.uuid4().hex[:8]}"]
+    failures = []
+    try:
+        await ensure_indexes(database)
+        messages = MessageRepository(database.messages)
+        usage = UsageRepository(database.usage_events, database.usage_daily, database.usage_rollup_state)
+        await exercise(UserRepository(database.users), messages, ConversationRepository(database.conversations, messages), usage, recorder)
+
+        for label, command in recorder.commands:
+            explain = await database.command({"explain": command, "verbosity": "queryPlanner"})
+            stages = set(plan_stages(explain.get("queryPlanner", explain.get("stages", explain))))
+            bad = stages & BAD_STAGES
+            status = "FAIL" if bad else "ok"
+            print(f"{status:4} {label}: {', '.join(sorted(stages))}")
+            if bad:
+                failures.append(label)
+    finally:
+        await client.drop_database(database.name)
+        client.close()
+    return failures
+
+def main():
+    parser = argparse.ArgumentParser(description="Explain every repository query and fail on COLLSCAN or in-memory SORT")
+    parser.add_argument("--uri", default=os.getenv('MONGODB_TEST_URI', "mongodb://localhost:27017"))
+    args = parser.parse_args()
+
+    failures = asyncio.run(verify(args.uri))
+    if failures:
+        print(f"❌ {len(failures)} queries are not fully served by an index")
+        sys.exit(1)
+    print("✅ Every repository query uses an index")
+
+if __name__ == "__main__":
+    main()
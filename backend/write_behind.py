@@ -0,0 +1,173 @@
+import os
+import json
+import asyncio
+import logging
+from bson import ObjectId
+from database import mongo_client
+import repositories
+
+# Same logger as logging_util, without importing the web app
+logger = logging.getLogger("devochat")
+
+# Turns written per flush, and how long the writer waits for more before flushing a partial batch
+BATCH_SIZE = int(os.getenv('WRITE_BEHIND_BATCH_SIZE', '100'))
+FLUSH_INTERVAL = float(os.getenv('WRITE_BEHIND_FLUSH_MS', '50')) / 1000
+MAX_RETRIES = int(os.getenv('WRITE_BEHIND_MAX_RETRIES', '5'))
+# Needs a replica set; makes each batch's messages and billing all-or-nothing
+USE_TRANSACTIONS = os.getenv('MONGODB_TRANSACTIONS', '0') == '1'
+
+class PendingTurn:
+    """One finished chat turn waiting to be persisted: its messages, at the positions already
+    reserved for them (start, or -1 when the conversation no longer exists), the user counters
+    to increment and its usage ledger event"""
+
+    def __init__(self, user_id: str, conversation_id: str, messages: list, start: int, increments: dict, usage: dict = None, prepared: list = None):
+        self.user_id = user_id
+        self.conversation_id = conversation_id
+        self.messages = messages
+        # Model-ready form of each message, stored alongside it
+        self.prepared = prepared
+        self.start = start
+        self.increments = increments
+        self.usage = usage
+        # Marks the charge on the user so a retried write applies it once (see charge_turns)
+        self.id = usage["_id"] if usage else ObjectId()
+        self.saved = asyncio.get_running_loop().create_future()
+        # Progress kept across retries so a step that went through is not applied twice
+        self.stored = start < 0
+        self.billed = False
+        self.logged = usage is None
+
+    @property
+    def key(self):
+        return (self.user_id, self.conversation_id)
+
+class WriteBehindQueue:
+    """Persists chat turns off the response path. Positions are reserved by the caller before a
+    turn is queued, so message order holds across workers; the writer groups turns into bulk
+    writes (messages, usage events and user charges in one each), retries them, gives back the positions of turns it has to drop, and is drained on shutdown.
+    settled() only knows about turns queued in this process."""
+
+    def __init__(self, batch_size: int = BATCH_SIZE, flush_interval: float = FLUSH_INTERVAL, max_retries: int = MAX_RETRIES, transactions: bool = USE_TRANSACTIONS):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_retries = max_retries
+        self.transactions = transactions
+        self.queue = None
+        self.worker = None
+        # Latest unsaved turn per conversation, so readers can wait for their own writes
+        self.latest = {}
+
+    def start(self):
+        self.queue = asyncio.Queue()
+        self.worker = asyncio.create_task(self.run())
+
+    def enqueue(self, turn: PendingTurn):
+        """Queue a turn; its saved future resolves once it is in the database"""
+        if self.worker is None:
+            self.start()
+        self.latest[turn.key] = turn
+        turn.saved.add_done_callback(lambda _: self.forget(turn))
+        self.queue.put_nowait(turn)
+        return turn.saved
+
+    def forget(self, turn: PendingTurn):
+        if self.latest.get(turn.key) is turn:
+            del self.latest[turn.key]
+
+    async def settled(self, user_id: str, conversation_id: str):
+        """Wait until every queued turn of the conversation is saved (or given up on)"""
+        turn = self.latest.get((user_id, conversation_id))
+        if turn:
+            await asyncio.wait([turn.saved])
+
+    async def run(self):
+        while True:
+            batch = [await self.queue.get()]
+            deadline = asyncio.get_running_loop().time() + self.flush_interval
+            while len(batch) < self.batch_size:
+                timeout = deadline - asyncio.get_running_loop().time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            await self.flush(batch)
+            for _ in batch:
+                self.queue.task_done()
+
+    async def flush(self, batch):
+        for attempt in range(self.max_retries + 1):
+            try:
+                if self.transactions:
+                    async with await mongo_client.start_session() as session:
+                        await session.with_transaction(lambda session: self.write_transaction(batch, session))
+                else:
+                    await self.write(batch)
+                for turn in batch:
+                    if not turn.saved.done():
+                        turn.saved.set_result(True)
+                return
+            except Exception as ex:
+                logger.warning(f"WRITE_BEHIND_RETRY: attempt {attempt + 1}, {len(batch)} turns: {str(ex)}")
+                if attempt < self.max_retries:
+                    await asyncio.sleep(min(0.1 * 2 ** attempt, 5.0))
+                    continue
+                for turn in reversed(batch):
+                    # Everything needed to replay the turn by hand
+                    logger.error(f"WRITE_BEHIND_DROPPED: {json.dumps({'user_id': turn.user_id, 'conversation_id': turn.conversation_id, 'start': turn.start, 'messages': turn.messages, 'increments': turn.increments, 'usage': turn.usage}, ensure_ascii=False, default=str)}")
+                    await self.release(turn)
+                    if not turn.saved.done():
+                        turn.saved.set_exception(ex)
+                        # Nobody has to be waiting on it; don't report the exception as unretrieved
+                        turn.saved.exception()
+
+    async def release(self, turn: PendingTurn):
+        """Give back a dropped turn's positions, like a failed append_messages (newest turn first,
+        so turns of one conversation unwind in order)"""
+        if turn.stored:
+            return
+        try:
+            await repositories.conversations.release_messages(turn.user_id, turn.conversation_id, turn.start, len(turn.messages))
+        except Exception as ex:
+            logger.error(f"WRITE_BEHIND_RELEASE_FAILED: {turn.user_id}/{turn.conversation_id} {turn.start}: {str(ex)}")
+
+    async def write_transaction(self, batch, session):
+        # Runs again from scratch whenever the transaction is retried; nothing of an aborted
+        # attempt is in the database (positions were reserved before it and are kept)
+        for turn in batch:
+            turn.stored, turn.billed, turn.logged = turn.start < 0, False, turn.usage is None
+        await self.write(batch, session)
+
+    async def write(self, batch, session=None):
+        pending = [turn for turn in batch if not turn.stored]
+        await repositories.messages.insert_many(
+            [(turn.user_id, turn.conversation_id, turn.start, turn.messages, turn.prepared) for turn in pending], session
+        )
+        for turn in pending:
+            turn.stored = True
+
+        unbilled = [turn for turn in batch if not turn.billed]
+        await repositories.users.charge_turns([(turn.user_id, turn.id, turn.increments) for turn in unbilled], session)
+        for turn in unbilled:
+            turn.billed = True
+
+        unlogged = [turn for turn in batch if not turn.logged]
+        await repositories.usage.insert_many([turn.usage for turn in unlogged], session)
+        for turn in unlogged:
+            turn.logged = True
+
+    async def close(self):
+        """Write out everything queued, then stop the writer"""
+        if self.worker is None:
+            return
+        await self.queue.join()
+        self.worker.cancel()
+        try:
+            await self.worker
+        except asyncio.CancelledError:
+            pass
+        self.worker = None
+
+write_behind = WriteBehindQueue()
@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+"""
+Measure /generate throughput of medgemma_server.py under concurrent load
+Run it once against a server started with MEDGEMMA_MAX_BATCH_SIZE=1 (one request at a time)
+and once with batching enabled to compare
+"""
+
+import json
+import time
+import argparse
+import statistics
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+PROMPTS = [
+    "Các triệu chứng thường gặp của đái tháo đường type 2 là gì?",
+    "Tóm tắt phác đồ điều trị tăng huyết áp độ 1 ở người trưởng thành.",
+    "Khi nào cần chụp CT sọ não cho bệnh nhân chấn thương đầu nhẹ?",
+    "Liệt kê các chẩn đoán phân biệt của đau ngực cấp."
+]
+
+def post_generate(url, prompt, image_paths, timeout):
+    body = json.dumps({"prompt": prompt, "image_paths": image_paths}).encode("utf-8")
+    request = urllib.request.Request(f"{url}/generate", data=body, headers={"Content-Type": "application/json"})
+    start = time.perf_counter()
+    try:
+        with urllib.request.urlopen(request, timeout=timeout) as response:
+            result = json.loads(response.read().decode("utf-8"))
+    except urllib.error.HTTPError as ex:
+        result = {"error": f"HTTP {ex.code}: {ex.read().decode('utf-8', 'replace')}"}
+    except (urllib.error.URLError, TimeoutError) as ex:
+        # One refused or timed out request is counted as an error instead of aborting the run
+        result = {"error": str(getattr(ex, "reason", ex))}
+    return time.perf_counter() - start, result
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure /generate throughput")
+    parser.add_argument("--url", default="http://localhost:8001")
+    parser.add_argument("--requests", type=int, default=16, help="Total number of requests")
+    parser.add_argument("--concurrency", type=int, default=8, help="Requests in flight at once")
+    parser.add_argument("--image", action="append", default=[], help="Image path sent with every request")
+    parser.add_argument("--timeout", type=float, default=600)
+    args = parser.parse_args()
+
+    prompts = [PROMPTS[i % len(PROMPTS)] for i in range(args.requests)]
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        results = list(pool.map(lambda prompt: post_generate(args.url, prompt, args.image, args.timeout), prompts))
+    elapsed = time.perf_counter() - start
+
+    latencies = sorted(latency for latency, _ in results)
+    errors = [result["error"] for _, result in results if "error" in result]
+    print(json.dumps({
+        "requests": args.requests,
+        "concurrency": args.concurrency,
+        "errors": len(errors),
+        "elapsed_s": round(elapsed, 2),
+        "requests_per_s": round(args.requests / elapsed, 3),
+        "latency_p50_s": round(statistics.median(latencies), 2),
+        "latency_p95_s": round(latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))], 2)
+    }, indent=2))
+
+if __name__ == "__main__":
+    main()
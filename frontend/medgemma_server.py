@@ -1,13 +1,15 @@
 #!/usr/bin/env python3
 import os
+import sys
+import json
+import time
+import queue
+import asyncio
+import threading
 import logging
-from io import BytesIO
-from flask import Flask, request, jsonify
+from contextlib import closing
+from flask import Flask, request, jsonify, Response, stream_with_context
 from flask_cors import CORS
-import torch
-from PIL import Image
-from transformers import AutoProcessor, AutoModelForImageTextToText
-import io
 # ----------------------
 # Logging
 # ----------------------
@@ -23,34 +25,81 @@ CORS(app)
 # ----------------------
 # Global model variables
 # ----------------------
-model = None
-processor = None
-device = None
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "backend"))
+engine = None
+
+SYSTEM_PROMPT = "Bạn là một chuyên gia hỗ trợ y tế cho bác sĩ."
 
 # ----------------------
-# Load model
+# Inference server (optional)
 # ----------------------
-def load_model():
-    global model, processor, device
-    try:
-        logger.info("Loading MedGemma-4b-it model...")
-        device = "cuda" if torch.cuda.is_available() else "cpu"
-        logger.info(f"Using device: {device}")
+# Khi đặt MEDGEMMA_SOCKET, server này không tải model mà gửi request tới backend/inference_server.py
+INFERENCE_SOCKET = os.getenv("MEDGEMMA_SOCKET")
+inference_client = None
+inference_loop = None
+
+def start_inference_client():
+    global inference_client, inference_loop
+    from inference_client import InferenceClient
 
-        model_id = "google/medgemma-4b-it"
+    # Flask views are synchronous, so the pooled async client lives on its own event loop thread
+    inference_loop = asyncio.new_event_loop()
+    threading.Thread(target=inference_loop.run_forever, daemon=True).start()
+    inference_client = InferenceClient(INFERENCE_SOCKET)
+    logger.info(f"Using MedGemma inference server at {INFERENCE_SOCKET}")
 
-        processor = AutoProcessor.from_pretrained(model_id)
-        model = AutoModelForImageTextToText.from_pretrained(
-            model_id,
-            torch_dtype=torch.bfloat16 if device=="cuda" else torch.float32,
-            device_map="auto" if device=="cuda" else None,
-            trust_remote_code=True
-        )
+def run_on_inference_loop(coro):
+    return asyncio.run_coroutine_threadsafe(coro, inference_loop).result()
 
-        if device == "cpu":
-            model = model.to(device)
+def build_messages(prompt, image_blobs):
+    return [{
+        "role": "user",
+        "content": [{"type": "text", "text": prompt}] + [{"type": "image", "image": blob} for blob in image_blobs]
+    }]
 
-        logger.info("Model loaded successfully!")
+def stream_chunks(prompt, image_blobs):
+    """Yield text deltas, then a token_usage dict, from the local engine or the inference server.
+    Closing the generator (client disconnected) stops the generation."""
+    messages = build_messages(prompt, image_blobs)
+    if inference_client is None:
+        yield from engine.generate(messages, SYSTEM_PROMPT, temperature=0.0, max_new_tokens=1024)
+        return
+
+    chunks = queue.Queue()
+
+    async def produce():
+        try:
+            async for chunk in inference_client.generate(messages, SYSTEM_PROMPT, temperature=0.0, max_new_tokens=1024):
+                chunks.put(chunk)
+        except Exception as ex:
+            chunks.put(ex)
+
+    future = asyncio.run_coroutine_threadsafe(produce(), inference_loop)
+    try:
+        while True:
+            item = chunks.get()
+            if isinstance(item, Exception):
+                raise item
+            yield item
+            if isinstance(item, dict):
+                return
+    finally:
+        # Cancelling the task makes the client send CANCEL to the inference server
+        future.cancel()
+
+# ----------------------
+# Load model
+# ----------------------
+def load_model():
+    # Same engine as the backend: images are cached by content hash, so a re-sent image
+    # is neither re-decoded nor re-encoded by the vision tower
+    global engine
+    try:
+        from medgemma_engine import MedGemmaEngine
+        logger.info("Loading MedGemma-4b-it model...")
+        engine = MedGemmaEngine("google/medgemma-4b-it")
+        engine.load()
+        logger.info(f"Model loaded successfully on {engine.device}!")
         return True
     except Exception as e:
         logger.error(f"Error loading model: {e}")
@@ -61,87 +110,200 @@ def load_model():
 # ----------------------
 @app.route('/health', methods=['GET'])
 def health_check():
-    if model is not None and processor is not None:
-        return jsonify({"status": "healthy", "model_loaded": True, "device": device}), 200
+    if inference_client is not None:
+        try:
+            info = run_on_inference_loop(inference_client.info())
+            return jsonify({"status": "healthy", "model_loaded": info["model_loaded"], "device": info["device"]}), 200
+        except Exception as e:
+            return jsonify({"status": "unhealthy", "model_loaded": False, "error": str(e)}), 503
+    if engine is not None and engine.loaded:
+        return jsonify({"status": "healthy", "model_loaded": True, "device": engine.device}), 200
     else:
         return jsonify({"status": "unhealthy", "model_loaded": False}), 503
 
 # ----------------------
 # Generate endpoint (text + optional image)
 # ----------------------
+def read_generate_request():
+    """(prompt, image_blobs) from FormData or JSON { prompt, image_paths }"""
+    image_blobs = []
+
+    # --- Nếu gửi FormData ---
+    if request.content_type.startswith("multipart/form-data"):
+        prompt = request.form.get("prompt", "").strip()
+        files = request.files.getlist("image")
+        for f in files:
+            image_blobs.append(f.read())
+
+    # --- Nếu gửi JSON { prompt, image_paths } ---
+    else:
+        data = request.get_json()
+        prompt = data.get("prompt", "").strip()
+        image_paths = data.get("image_paths", [])
+
+        for path in image_paths:
+            try:
+                with open(path, "rb") as f:
+                    image_blobs.append(f.read())
+            except Exception as e:
+                logger.warning(f"Không mở được ảnh {path}: {e}")
+
+    return prompt, image_blobs
+
 @app.route('/generate', methods=['POST'])
 def generate_text():
     try:
-        pil_images = []
+        prompt, image_blobs = read_generate_request()
+        if not prompt:
+            return jsonify({"error": "Prompt is empty"}), 400
 
-        # --- Nếu gửi FormData ---
-        if request.content_type.startswith("multipart/form-data"):
-            prompt = request.form.get("prompt", "").strip()
-            files = request.files.getlist("image")
-            for f in files:
-                pil_images.append(Image.open(io.BytesIO(f.read())).convert("RGB"))
+        decoded = "".join(chunk for chunk in stream_chunks(prompt, image_blobs) if isinstance(chunk, str))
+        return jsonify({"response": decoded, "generated_text": decoded, "input_prompt": prompt}), 200
 
-        # --- Nếu gửi JSON { prompt, image_paths } ---
-        else:
-            data = request.get_json()
-            prompt = data.get("prompt", "").strip()
-            image_paths = data.get("image_paths", [])
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
 
-            for path in image_paths:
-                try:
-                    pil_images.append(Image.open(path).convert("RGB"))
-                except Exception as e:
-                    logger.warning(f"Không mở được ảnh {path}: {e}")
+# ----------------------
+# Streaming endpoint (Server-Sent Events)
+# ----------------------
+def sse(event):
+    return f"data: {json.dumps(event, ensure_ascii=False)}\n\n"
 
-        if not prompt:
-            return jsonify({"error": "Prompt is empty"}), 400
+@app.route('/generate_stream', methods=['POST'])
+def generate_stream():
+    try:
+        prompt, image_blobs = read_generate_request()
+    except Exception as e:
+        return jsonify({"error": str(e)}), 400
+    if not prompt:
+        return jsonify({"error": "Prompt is empty"}), 400
 
-        # --- Build messages và generate ---
-        messages = [
-            {"role": "system", "content": [{"type": "text", "text": "Bạn là một chuyên gia hỗ trợ y tế cho bác sĩ."}]},
-            {"role": "user", "content": [{"type": "text", "text": prompt}] + [{"type": "image", "image": img} for img in pil_images]}
-        ]
+    def events():
+        start = time.perf_counter()
+        first_token = None
+        try:
+            # Werkzeug closes this generator when the client goes away; closing() passes that on
+            with closing(stream_chunks(prompt, image_blobs)) as chunks:
+                for chunk in chunks:
+                    if isinstance(chunk, str):
+                        first_token = first_token or time.perf_counter()
+                        yield sse({"type": "token", "content": chunk})
+                        continue
 
-        inputs = processor.apply_chat_template(
-            messages, add_generation_prompt=True, tokenize=True,
-            return_dict=True, return_tensors="pt"
-        ).to(model.device, dtype=torch.bfloat16 if device=="cuda" else torch.float32)
+                    total = time.perf_counter() - start
+                    decode_time = total - (first_token - start) if first_token else 0
+                    yield sse({
+                        "type": "usage",
+                        "input_tokens": chunk["input_tokens"],
+                        "output_tokens": chunk["output_tokens"],
+                        "time_to_first_token_s": round(first_token - start, 3) if first_token else None,
+                        "total_time_s": round(total, 3),
+                        "tokens_per_s": round(chunk["output_tokens"] / decode_time, 2) if decode_time > 0 else None
+                    })
+        except Exception as e:
+            yield sse({"type": "error", "error": str(e)})
+        yield "data: [DONE]\n\n"
 
-        input_len = inputs["input_ids"].shape[-1]
+    return Response(
+        stream_with_context(events()),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
 
-        with torch.inference_mode():
-            outputs = model.generate(**inputs, max_new_tokens=1024, do_sample=False)
-            outputs = outputs[0][input_len:]
+# ----------------------
+# Batch endpoint (many independent prompts in one call)
+# ----------------------
+MAX_BATCH_ITEMS = int(os.getenv("MEDGEMMA_BATCH_MAX_ITEMS", "256"))
 
-        decoded = processor.decode(outputs, skip_special_tokens=True)
-        return jsonify({"response": decoded, "generated_text": decoded, "input_prompt": prompt}), 200
+async def collect(chunks):
+    text = ""
+    async for chunk in chunks:
+        if isinstance(chunk, str):
+            text += chunk
+        else:
+            return {"response": text, "input_tokens": chunk["input_tokens"], "output_tokens": chunk["output_tokens"]}
 
-    except Exception as e:
-        return jsonify({"error": str(e)}), 500
+async def generate_all(jobs, max_new_tokens):
+    """Submit every job at once; the engine packs them into padded batches sized to free memory"""
+    def start(messages):
+        if inference_client is not None:
+            return inference_client.generate(messages, SYSTEM_PROMPT, temperature=0.0, max_new_tokens=max_new_tokens)
+        return engine.agenerate(messages, SYSTEM_PROMPT, temperature=0.0, max_new_tokens=max_new_tokens)
+    return await asyncio.gather(*(collect(start(messages)) for messages in jobs), return_exceptions=True)
+
+@app.route('/generate_batch', methods=['POST'])
+def generate_batch():
+    data = request.get_json(silent=True) or {}
+    items = data.get("items")
+    if not isinstance(items, list) or not items:
+        return jsonify({"error": "items must be a non-empty list"}), 400
+    if len(items) > MAX_BATCH_ITEMS:
+        return jsonify({"error": f"At most {MAX_BATCH_ITEMS} items per call"}), 400
+    max_new_tokens = data.get("max_new_tokens", 1024)
+    if isinstance(max_new_tokens, bool) or not isinstance(max_new_tokens, int) or max_new_tokens < 1:
+        return jsonify({"error": "max_new_tokens must be a positive integer"}), 400
+    max_new_tokens = min(max_new_tokens, 1024)
 
+    # Items that cannot run (empty prompt, unreadable image) get their error without failing the call
+    results = [None] * len(items)
+    jobs, job_indexes = [], []
+    for index, item in enumerate(items):
+        item_id = item.get("id", index) if isinstance(item, dict) else index
+        try:
+            prompt = item.get("prompt", "").strip()
+            if not prompt:
+                raise ValueError("Prompt is empty")
+            image_blobs = []
+            for path in item.get("image_paths", []):
+                with open(path, "rb") as f:
+                    image_blobs.append(f.read())
+        except Exception as e:
+            results[index] = {"id": item_id, "error": str(e)}
+            continue
+        jobs.append(build_messages(prompt, image_blobs))
+        job_indexes.append((index, item_id))
 
+    start = time.perf_counter()
+    if jobs:
+        if inference_client is not None:
+            outputs = run_on_inference_loop(generate_all(jobs, max_new_tokens))
+        else:
+            outputs = asyncio.run(generate_all(jobs, max_new_tokens))
+        for (index, item_id), output in zip(job_indexes, outputs):
+            if isinstance(output, Exception):
+                results[index] = {"id": item_id, "error": str(output)}
+            else:
+                results[index] = {"id": item_id, **output}
+
+    return jsonify({"results": results, "elapsed_s": round(time.perf_counter() - start, 3)}), 200
 
 # ----------------------
 # Model info endpoint
 # ----------------------
 @app.route('/model_info', methods=['GET'])
 def model_info():
-    if model is None:
+    if inference_client is not None:
+        try:
+            return jsonify(run_on_inference_loop(inference_client.info())), 200
+        except Exception as e:
+            return jsonify({"error": str(e)}), 503
+    if engine is None or not engine.loaded:
         return jsonify({"error": "Model not loaded"}), 503
-    return jsonify({
-        "model_name": "google/medgemma-4b-it",
-        "device": device,
-        "parameters": sum(p.numel() for p in model.parameters()),
-        "trainable_parameters": sum(p.numel() for p in model.parameters() if p.requires_grad)
-    }), 200
+    return jsonify(engine.info()), 200
 
 # ----------------------
 # Start server
 # ----------------------
 if __name__ == "__main__":
-    if load_model():
+    if INFERENCE_SOCKET:
+        start_inference_client()
+        logger.info("Starting MedGemma server on http://0.0.0.0:8001")
+        app.run(host='0.0.0.0', port=8001, debug=False, threaded=True)
+    elif load_model():
+        # Each request thread only waits on the engine; concurrent requests are collected
+        # into one padded batch (MEDGEMMA_MAX_BATCH_SIZE, MEDGEMMA_BATCH_WINDOW_MS)
         logger.info("Starting MedGemma server on http://0.0.0.0:8001")
-        app.run(host='0.0.0.0', port=8001, debug=False)
+        app.run(host='0.0.0.0', port=8001, debug=False, threaded=True)
     else:
         logger.error("Failed to load model. Exiting.")
         exit(1)
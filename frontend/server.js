@@ -54,7 +54,27 @@ app.post('/api/generate', async (req, res) => {
   }
 });
 
-// Serve React build
+// Proxy /api/generate_stream → backend MedGemma (Server-Sent Events)
+app.post('/api/generate_stream', async (req, res) => {
+  const controller = new AbortController();
+  // Trình duyệt đóng kết nối → hủy request tới Flask để dừng sinh token
+  res.on('close', () => controller.abort());
+
+  try {
+    const response = await axios.post('http://192.168.1.220:8001/generate_stream', req.body, {
+      headers: { 'Content-Type': 'application/json' },
+      responseType: 'stream',
+      signal: controller.signal
+    });
+    res.setHeader('Content-Type', 'text/event-stream');
+    res.setHeader('Cache-Control', 'no-cache');
+    response.data.pipe(res);
+  } catch (err) {
+    if (!res.headersSent) res.status(500).json({ error: err.message });
+  }
+});
+
+
 app.get('*', (req, res) => {
   res.sendFile(path.join(__dirname, 'build', 'index.html'));
 });
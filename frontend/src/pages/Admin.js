@@ -19,28 +19,35 @@ function Admin() {
     const fetchUsers = async () => {
       try {
         setLoading(true);
-        const response = await fetch(`${process.env.REACT_APP_FASTAPI_URL}/users`, {
-          method: 'GET',
-          credentials: 'include',
-          headers: {
-            'Content-Type': 'application/json',
-          },
-        });
-        
-        if (response.status === 401) {
-          if (!window.location.pathname.includes('/login') && !window.location.pathname.includes('/register')) {
-            window.location.href = '/login?expired=true';
+        const allUsers = [];
+        let cursor = null;
+        do {
+          const query = cursor ? `?cursor=${encodeURIComponent(cursor)}` : '';
+          const response = await fetch(`${process.env.REACT_APP_FASTAPI_URL}/users${query}`, {
+            method: 'GET',
+            credentials: 'include',
+            headers: {
+              'Content-Type': 'application/json',
+            },
+          });
+          
+          if (response.status === 401) {
+            if (!window.location.pathname.includes('/login') && !window.location.pathname.includes('/register')) {
+              window.location.href = '/login?expired=true';
+            }
+            return;
           }
-          return;
-        }
 
-        if (!response.ok) {
-          navigate("/", { state: { errorModal: "권한이 없습니다." } });
-          return;
-        }
+          if (!response.ok) {
+            navigate("/", { state: { errorModal: "권한이 없습니다." } });
+            return;
+          }
 
-        const data = await response.json();
-        setUsers(data);
+          const data = await response.json();
+          allUsers.push(...data.users);
+          cursor = data.next_cursor;
+        } while (cursor);
+        setUsers(allUsers);
         setLoading(false);
       } catch (err) {
         navigate("/", { state: { errorModal: "오류가 발생했습니다." } });
@@ -69,28 +76,35 @@ function Admin() {
   const fetchUserConversations = async (userId) => {
     try {
       setLoadingConversations(true);
-      const response = await fetch(`${process.env.REACT_APP_FASTAPI_URL}/conversations/${userId}`, {
-        method: 'GET',
-        credentials: 'include',
-        headers: {
-          'Content-Type': 'application/json',
-        },
-      });
-      
-      if (response.status === 401) {
-        if (!window.location.pathname.includes('/login') && !window.location.pathname.includes('/register')) {
-          window.location.href = '/login?expired=true';
+      const allConversations = [];
+      let cursor = null;
+      do {
+        const query = cursor ? `?cursor=${encodeURIComponent(cursor)}` : '';
+        const response = await fetch(`${process.env.REACT_APP_FASTAPI_URL}/conversations/${userId}${query}`, {
+          method: 'GET',
+          credentials: 'include',
+          headers: {
+            'Content-Type': 'application/json',
+          },
+        });
+        
+        if (response.status === 401) {
+          if (!window.location.pathname.includes('/login') && !window.location.pathname.includes('/register')) {
+            window.location.href = '/login?expired=true';
+          }
+          return;
         }
-        return;
-      }
 
-      if (!response.ok) {
-        const errorData = await response.json();
-        throw new Error(errorData.detail || '대화 내역을 불러오는데 실패했습니다.');
-      }
+        if (!response.ok) {
+          const errorData = await response.json();
+          throw new Error(errorData.detail || '대화 내역을 불러오는데 실패했습니다.');
+        }
 
-      const data = await response.json();
-      setConversations(data.conversations);
+        const data = await response.json();
+        allConversations.push(...data.conversations);
+        cursor = data.next_cursor;
+      } while (cursor);
+      setConversations(allConversations);
     } catch (err) {
       console.error('대화 내역 로딩 오류:', err);
     } finally {
@@ -51,7 +51,7 @@ const MedGemmaTest = () => {
         return;
       }
 
-      const result = await fetch(`${PROXY_BASE}/generate`, {
+      const result = await fetch(`${PROXY_BASE}/generate_stream`, {
         method: 'POST',
         headers: { 'Content-Type': 'application/json' },
         body: JSON.stringify({
@@ -64,8 +64,29 @@ const MedGemmaTest = () => {
       });
 
       if (!result.ok) throw new Error(`HTTP error! status: ${result.status}`);
-      const data = await result.json();
-      setResponse(data.response || data.generated_text);
+
+      // Server-Sent Events: show tokens as they arrive
+      const reader = result.body.getReader();
+      const decoder = new TextDecoder();
+      let buffer = '';
+      let text = '';
+      while (true) {
+        const { done, value } = await reader.read();
+        if (done) break;
+        buffer += decoder.decode(value, { stream: true });
+        const events = buffer.split('\n\n');
+        buffer = events.pop();
+        for (const event of events) {
+          if (!event.startsWith('data: ') || event === 'data: [DONE]') continue;
+          const data = JSON.parse(event.slice(6));
+          if (data.type === 'token') {
+            text += data.content;
+            setResponse(text);
+          } else if (data.type === 'error') {
+            throw new Error(data.error);
+          }
+        }
+      }
     } catch (err) {
       console.error('Error calling local MedGemma:', err);
       setError(`Error: ${err.message || 'Failed to generate response. Make sure the local model server is running.'}`);
@@ -20,11 +20,18 @@ function View() {
   useEffect(() => {
     const initializeChat = async () => {
       try {
-        const res = await axios.get(
-          `${process.env.REACT_APP_FASTAPI_URL}/conversation/${conversation_id}`,
-          { withCredentials: true }
-        );
-        const updatedMessages = res.data.messages.map((m) => {
+        // Pages come newest first; each one is prepended until the start of the conversation
+        let allMessages = [];
+        let cursor = null;
+        do {
+          const res = await axios.get(
+            `${process.env.REACT_APP_FASTAPI_URL}/conversation/${conversation_id}`,
+            { withCredentials: true, params: cursor ? { cursor } : {} }
+          );
+          allMessages = [...res.data.messages, ...allMessages];
+          cursor = res.data.next_cursor;
+        } while (cursor);
+        const updatedMessages = allMessages.map((m) => {
           const messageWithId = m.id ? m : { ...m, id: generateMessageId() };
           return m.role === "assistant" ? { ...messageWithId, isComplete: true } : messageWithId;
         });